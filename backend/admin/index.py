@@ -3,148 +3,1162 @@ API для админ-панели: управление пользовател
 """
 import json
 import os
+import bisect
+import functools
+import base64
+import hashlib
+import hmac
+import threading
+import time
+import traceback
+from collections import OrderedDict
 import psycopg2
+import psycopg2.extensions
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает сессию"""
+    pool = None
+    released_at = 0.0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.putconn(self)
+        else:
+            super().close()
+
+    def discard(self):
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Пул соединений уровня модуля, переживает теплые вызовы функции"""
+
+    def __init__(self, maxconn: int, timeout: float):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0, 'broken': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _checked_out(self) -> list:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.released_at < DB_POOL_PING_AFTER:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self.counters['hits'] += 1
+                    break
+                if self._size < self.maxconn:
+                    conn = None
+                    self._size += 1
+                    self.counters['misses'] += 1
+                    break
+                if not waited:
+                    waited = True
+                    self.counters['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout('Нет свободных соединений с базой')
+        
+        if conn is not None and not self._is_healthy(conn):
+            self.counters['broken'] += 1
+            conn.discard()
+            conn = None
+        
+        if conn is None:
+            try:
+                conn = psycopg2.connect(
+                    os.environ['DATABASE_URL'],
+                    connection_factory=PooledConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        
+        conn.pool = self
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn):
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.discard()
+        
+        with self._cond:
+            if conn.closed:
+                self.counters['broken'] += 1
+                self._size -= 1
+            else:
+                conn.released_at = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def release_all(self):
+        for conn in list(self._checked_out()):
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counters, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
 def get_db():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    return db_pool.getconn()
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+# Сколько секунд браузер может не повторять preflight для тех же метода и заголовков
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+
+def dumps(data) -> str:
+    """orjson, если установлен в окружении функции, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def respond(status: int, data, headers: dict = JSON_HEADERS) -> dict:
+    return {'statusCode': status, 'headers': headers, 'body': dumps(data), 'isBase64Encoded': False}
+
+@functools.lru_cache(maxsize=256)
+def error(status: int, message: str) -> dict:
+    """Ответ с ошибкой сериализуется один раз на пару (статус, текст) и дальше отдается готовым"""
+    return respond(status, {'error': message})
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.response = error(status, message)
+
+
+class Router:
+    """Таблица маршрутов (метод, action) -> route(event, params, body).
     
-    if method == 'OPTIONS':
-        return {
+    action берется из query string, у POST — из JSON тела; без точного совпадения
+    используется маршрут метода без action. Исключения из errors превращаются в готовые
+    ответы, hooks вызываются после каждого запроса с (маршрут, секунды, статус),
+    middleware оборачивают вызов маршрута: middleware(маршрут, event, body, call).
+    """
+
+    def __init__(self, allow_headers: str):
+        self.routes = {}
+        self.errors = {
+            PoolTimeout: error(503, 'Нет свободных соединений с базой'),
+            psycopg2.OperationalError: error(503, 'База данных недоступна'),
+            psycopg2.DataError: error(400, 'Некорректные параметры запроса')
+        }
+        self.hooks = []
+        self.middleware = []
+        self.preflight = {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': allow_headers,
+                'Access-Control-Max-Age': CORS_MAX_AGE
             },
             'body': '',
             'isBase64Encoded': False
         }
+
+    def route(self, method: str, action: str = None):
+        def register(fn):
+            self.routes[(method, action)] = fn
+            return fn
+        return register
+
+    def dispatch(self, event: dict) -> dict:
+        method = event.get('httpMethod', 'GET')
+        if method == 'OPTIONS':
+            return self.preflight
+        
+        started = time.perf_counter()
+        name = method
+        try:
+            params = event.get('queryStringParameters') or {}
+            body = {}
+            if method == 'POST':
+                try:
+                    body = json.loads(event.get('body') or '{}')
+                except ValueError:
+                    raise HttpError(400, 'Некорректный JSON')
+                if not isinstance(body, dict):
+                    raise HttpError(400, 'Некорректный JSON')
+            action = body.get('action') if method == 'POST' else params.get('action')
+            fn = self.routes.get((method, action)) or self.routes.get((method, None))
+            if fn is None:
+                response = error(405, 'Метод не поддерживается')
+            else:
+                name = fn.__name__
+                call = functools.partial(fn, event, params, body)
+                for middleware in self.middleware:
+                    call = functools.partial(middleware, name, event, body, call)
+                response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception as e:
+            response = self.handle_error(name, e)
+        
+        for hook in self.hooks:
+            hook(name, time.perf_counter() - started, response['statusCode'])
+        return response
+
+    def handle_error(self, route: str, exc: Exception) -> dict:
+        """Ответ из errors по ближайшему классу исключения, иначе 500; сбои сервера пишутся в журнал"""
+        response = next((self.errors[cls] for cls in type(exc).__mro__ if cls in self.errors), None)
+        if response is None:
+            response = respond(500, {'error': str(exc)})
+        if response['statusCode'] >= 500:
+            log_event(
+                event='error', route=route, status=response['statusCode'],
+                error=f'{type(exc).__name__}: {exc}'.strip(), traceback=traceback.format_exc(limit=8)
+            )
+        return response
+
+
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '60'))
+METRICS_LOG_REQUESTS = os.environ.get('METRICS_LOG_REQUESTS') == '1'
+METRICS_KEY = os.environ.get('METRICS_KEY')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def log_event(**fields):
+    """Одна JSON-строка в stdout — журнал функции"""
+    print(dumps(fields), flush=True)
+
+
+class Metrics:
+    """Метрики инстанса: гистограмма длительности по маршрутам, число SQL и время в базе на запрос.
     
-    try:
-        if method == 'GET':
-            admin_id = event.get('queryStringParameters', {}).get('admin_id')
-            
-            if not admin_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'admin_id обязателен'}),
-                    'isBase64Encoded': False
+    Счетчики запроса лежат в thread-local и сбрасываются в begin(); сводка пишется в журнал
+    раз в METRICS_LOG_INTERVAL секунд и отдается маршрутом GET ?action=metrics.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logged_at = time.monotonic()
+
+    def begin(self):
+        self.local.queries = 0
+        self.local.db_ms = 0.0
+        self.local.slow = []
+
+    def record_query(self, query, elapsed_ms: float):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        local.queries += 1
+        local.db_ms += elapsed_ms
+        if elapsed_ms >= SLOW_QUERY_MS:
+            local.slow.append((round(elapsed_ms, 1), ' '.join(str(query).split())[:300]))
+
+    def observe(self, route: str, seconds: float, status: int):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        elapsed_ms = seconds * 1000
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'queries': 0, 'db_ms': 0.0, 'slow_queries': 0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)
                 }
-            
+            stats['count'] += 1
+            stats['errors'] += status >= 500
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['queries'] += local.queries
+            stats['db_ms'] += local.db_ms
+            stats['slow_queries'] += len(local.slow)
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            due = METRICS_LOG_INTERVAL > 0 and time.monotonic() - self.logged_at >= METRICS_LOG_INTERVAL
+            if due:
+                self.logged_at = time.monotonic()
+        
+        for slow_ms, query in local.slow:
+            log_event(event='slow_query', route=route, ms=slow_ms, query=query)
+        if METRICS_LOG_REQUESTS:
+            log_event(
+                event='request', route=route, status=status, ms=round(elapsed_ms, 2),
+                queries=local.queries, db_ms=round(local.db_ms, 2)
+            )
+        if due:
+            log_event(event='metrics', routes=self.snapshot(), pool=db_pool.stats())
+        self.begin()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            routes = {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in self.routes.items()}
+        result = {}
+        for name, stats in routes.items():
+            count = stats['count']
+            result[name] = {
+                'count': count,
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total_ms'] / count, 2),
+                'p50_ms': self.percentile(stats, 0.50),
+                'p95_ms': self.percentile(stats, 0.95),
+                'p99_ms': self.percentile(stats, 0.99),
+                'max_ms': round(stats['max_ms'], 2),
+                'queries_per_request': round(stats['queries'] / count, 2),
+                'db_ms_per_request': round(stats['db_ms'] / count, 2),
+                'slow_queries': stats['slow_queries']
+            }
+        return result
+
+    @staticmethod
+    def percentile(stats: dict, pct: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль, но не больше максимума"""
+        needed = pct * stats['count']
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS_MS, stats['buckets']):
+            seen += hits
+            if seen >= needed:
+                return min(bound, round(stats['max_ms'], 2))
+        return round(stats['max_ms'], 2)
+
+
+metrics = Metrics()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Курсор соединений пула: считает запросы и время в базе для текущего запроса"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+def install_metrics(router):
+    router.hooks.append(metrics.observe)
+    
+    @router.route('GET', 'metrics')
+    def metrics_dump(event: dict, params: dict, body: dict) -> dict:
+        key = get_header(event, 'X-Metrics-Key') or ''
+        if not METRICS_KEY or not hmac.compare_digest(key.encode('utf-8', 'surrogatepass'), METRICS_KEY.encode()):
+            return error(404, 'Не найдено')
+        return respond(200, {'routes': metrics.snapshot(), 'pool': db_pool.stats()})
+
+def execute_prepared(cur, name: str, query: str, types: str, args: tuple):
+    """PREPARE выполняется один раз на соединение из пула, дальше только EXECUTE без планирования"""
+    conn = cur.connection
+    if getattr(conn, 'prepared', None) is None:
+        conn.prepared = set()
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} ({types}) AS {query}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', '5'))
+
+QUEST_WRITE_BEHIND = os.environ.get('QUEST_WRITE_BEHIND') == '1'
+QUEST_FLUSH_INTERVAL = float(os.environ.get('QUEST_FLUSH_INTERVAL', '10'))
+QUEST_FLUSH_BATCH = int(os.environ.get('QUEST_FLUSH_BATCH', '500'))
+
+QUEST_EVENTS = {
+    'chat_message': ('chat_messages', 'add'),
+    'buy_title': ('buy_title', 'add'),
+    'sell_title': ('sell_title', 'add'),
+    'admin_coins': ('admin_coins', 'add'),
+    'daily_streak': ('daily_streak', 'set'),
+    'coins_changed': ('coins_earned', 'max'),
+    'online_users': ('online_users', 'max'),
+    'time_spent': ('time_spent', 'max'),
+    'weekly_time': ('weekly_time', 'max'),
+}
+
+QUEST_UPSERT = """
+    WITH e (user_id, quest_id, amount, target, mode) AS (
+        SELECT * FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::text[])
+    )
+    INSERT INTO user_quests AS uq (user_id, quest_id, progress, completed, completed_at)
+    SELECT user_id, quest_id, amount, amount >= target, CASE WHEN amount >= target THEN NOW() END
+    FROM e
+    ON CONFLICT (user_id, quest_id) DO UPDATE SET (progress, completed, completed_at) = (
+        SELECT p.progress,
+               uq.completed OR p.progress >= e.target,
+               COALESCE(uq.completed_at, CASE WHEN p.progress >= e.target THEN NOW() END)
+        FROM e
+        CROSS JOIN LATERAL (
+            SELECT CASE e.mode
+                       WHEN 'add' THEN uq.progress + e.amount
+                       WHEN 'max' THEN GREATEST(uq.progress, e.amount)
+                       ELSE e.amount
+                   END AS progress
+        ) p
+        WHERE e.user_id = EXCLUDED.user_id AND e.quest_id = EXCLUDED.quest_id
+    )
+"""
+
+QUEST_FOLD = """
+    WITH moved AS (
+        DELETE FROM quest_events
+        WHERE id IN (
+            SELECT id FROM quest_events
+            WHERE %(user_id)s::int IS NULL OR user_id = %(user_id)s
+            ORDER BY id
+            LIMIT %(batch)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING user_id, quest_type, amount
+    ),
+    totals AS (
+        SELECT m.user_id, q.id AS quest_id, q.target_value AS target, SUM(m.amount)::int AS amount
+        FROM moved m
+        JOIN quests q ON q.quest_type = m.quest_type
+        GROUP BY m.user_id, q.id, q.target_value
+    ),
+    folded AS (
+        INSERT INTO user_quests AS uq (user_id, quest_id, progress, completed, completed_at)
+        SELECT user_id, quest_id, amount, amount >= target, CASE WHEN amount >= target THEN NOW() END
+        FROM totals
+        ON CONFLICT (user_id, quest_id) DO UPDATE SET (progress, completed, completed_at) = (
+            SELECT uq.progress + EXCLUDED.progress,
+                   uq.completed OR uq.progress + EXCLUDED.progress >= t.target,
+                   COALESCE(uq.completed_at, CASE WHEN uq.progress + EXCLUDED.progress >= t.target THEN NOW() END)
+            FROM totals t
+            WHERE t.user_id = EXCLUDED.user_id AND t.quest_id = EXCLUDED.quest_id
+        )
+    )
+    SELECT COUNT(*) FROM moved
+"""
+
+
+class QuestEngine:
+    """Переводит типизированные события в прогресс квестов одним пакетным upsert.
+    
+    В режиме QUEST_WRITE_BEHIND счетчики (события с режимом add) дописываются в quest_events
+    и сворачиваются в user_quests пачками по размеру или по времени.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.quests_by_type = {}
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def index(self, cur) -> dict:
+        if self.version is not None and time.monotonic() - self.checked_at < CATALOG_CHECK_INTERVAL:
+            return self.quests_by_type
+        with self.lock:
+            cur.execute("SELECT version FROM catalog_version")
+            version = cur.fetchone()[0]
+            if version != self.version:
+                cur.execute("SELECT id, quest_type, target_value FROM quests ORDER BY id")
+                quests_by_type = {}
+                for quest_id, quest_type, target in cur.fetchall():
+                    quests_by_type.setdefault(quest_type, []).append((quest_id, target))
+                self.quests_by_type = quests_by_type
+                self.version = version
+            self.checked_at = time.monotonic()
+        return self.quests_by_type
+
+    def emit(self, cur, user_id, *events):
+        self.emit_batch(cur, [(user_id, event_type, value) for event_type, value in events])
+
+    def emit_batch(self, cur, events):
+        """events: список (user_id, event_type, value); повторы одного квеста сливаются до записи"""
+        quests_by_type = self.index(cur)
+        rows = {}
+        deferred = ([], [], [])
+        for user_id, event_type, value in events:
+            quest_type, mode = QUEST_EVENTS[event_type]
+            if QUEST_WRITE_BEHIND and mode == 'add':
+                for column, item in zip(deferred, (int(user_id), quest_type, value)):
+                    column.append(item)
+                continue
+            for quest_id, target in quests_by_type.get(quest_type, ()):
+                key = (int(user_id), quest_id)
+                amount = value
+                if key in rows and mode == 'add':
+                    amount = rows[key][0] + value
+                elif key in rows and mode == 'max':
+                    amount = max(rows[key][0], value)
+                rows[key] = (amount, target, mode)
+        if rows:
+            execute_prepared(
+                cur, 'quest_upsert', QUEST_UPSERT, 'int[], int[], int[], int[], text[]',
+                (
+                    [key[0] for key in rows],
+                    [key[1] for key in rows],
+                    [row[0] for row in rows.values()],
+                    [row[1] for row in rows.values()],
+                    [row[2] for row in rows.values()]
+                )
+            )
+        if deferred[0]:
+            cur.execute(
+                "INSERT INTO quest_events (user_id, quest_type, amount) SELECT * FROM unnest(%s::int[], %s::text[], %s::int[])",
+                deferred
+            )
+            self.pending += len(deferred[0])
+
+    def due(self) -> bool:
+        if not QUEST_WRITE_BEHIND:
+            return False
+        return self.pending >= QUEST_FLUSH_BATCH or time.monotonic() - self.flushed_at >= QUEST_FLUSH_INTERVAL
+
+    def maybe_flush(self, conn):
+        if self.due():
+            self.flush(conn)
+
+    def flush(self, conn) -> int:
+        """Сворачивает очередь пачками по QUEST_FLUSH_BATCH, пока неполная пачка не покажет, что она пуста"""
+        cur = conn.cursor()
+        folded = 0
+        while True:
+            cur.execute(QUEST_FOLD, {'batch': QUEST_FLUSH_BATCH, 'user_id': None})
+            moved = cur.fetchone()[0]
+            conn.commit()
+            folded += moved
+            if moved < QUEST_FLUSH_BATCH:
+                break
+        cur.close()
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        return folded
+
+    def fold_user(self, cur, user_id: int) -> int:
+        """Сворачивает все отложенные события пользователя в текущей транзакции"""
+        if not QUEST_WRITE_BEHIND:
+            return 0
+        cur.execute(QUEST_FOLD, {'batch': None, 'user_id': user_id})
+        return cur.fetchone()[0]
+
+
+quest_engine = QuestEngine()
+
+ADMIN_BATCH_MAX = 10000
+ADMIN_PAGE_SIZE = 100
+ADMIN_PAGE_MAX = 500
+ADMIN_DELTA_MAX = 1000
+ADMIN_DELTA_OVERLAP = int(os.environ.get('ADMIN_DELTA_OVERLAP', '5'))
+ONLINE_WINDOW = "INTERVAL '5 minutes'"
+# То же выражение, что в idx_users_last_seen: по нему идут и сортировка, и курсор, и online_only
+LAST_SEEN = "COALESCE(last_login, '-infinity'::timestamp)"
+BATCH_FILTERS = {
+    'online': f"{LAST_SEEN} > LOCALTIMESTAMP - {ONLINE_WINDOW}",
+    'all': "TRUE",
+}
+CHAT_RETENTION_MONTHS = int(os.environ.get('CHAT_RETENTION_MONTHS', '3'))
+# Обслуживанию партиций нужна ACCESS EXCLUSIVE блокировка chat_messages; пока она ждет в очереди,
+# за ней стоят все чтения и записи чата, поэтому дольше этого она не ждет
+CHAT_MAINTENANCE_LOCK_TIMEOUT = os.environ.get('CHAT_MAINTENANCE_LOCK_TIMEOUT', '2s')
+
+def make_cursor(row) -> str:
+    """Курсор страницы — позиция последней строки: last_login и id"""
+    return f"{row[3].isoformat() if row[3] else '-infinity'}|{row[0]}"
+
+def parse_cursor(cursor):
+    if not cursor:
+        return None
+    last_seen, _, user_id = cursor.rpartition('|')
+    if not last_seen:
+        raise ValueError('bad cursor')
+    if last_seen != '-infinity':
+        datetime.fromisoformat(last_seen)
+    return last_seen, int(user_id)
+
+def parse_int(value) -> int:
+    """Целое из JSON: число без дробной части или строка из цифр, иначе ValueError"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('not an integer')
+    return int(value)
+
+def get_header(event: dict, name: str):
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+# Только явный секрет: ключ, выведенный из DATABASE_URL, подделал бы любой, кто знает строку
+# подключения. Без SESSION_SECRET токены не выпускаются и не принимаются
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '').encode()
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '43200'))
+SESSION_REVOCATION_CHECK = float(os.environ.get('SESSION_REVOCATION_CHECK', '30'))
+# Доверие к присланному клиентом user_id/admin_id — только на время перехода клиентов на токены,
+# после него функции запускаются с AUTH_ALLOW_LEGACY=0
+AUTH_ALLOW_LEGACY = os.environ.get('AUTH_ALLOW_LEGACY', '1') == '1'
+
+if not SESSION_SECRET:
+    log_event(event='config_error', error='SESSION_SECRET не задан: сессионные токены отключены')
+
+
+class InvalidSession(Exception):
+    pass
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def session_signature(payload: str) -> str:
+    if not SESSION_SECRET:
+        raise InvalidSession()
+    return b64url(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+class Revocations:
+    """Отозванные сессии: user_id -> момент отзыва в мс, все токены выпущенные раньше недействительны.
+    
+    Список перечитывается не чаще раза в SESSION_REVOCATION_CHECK секунд, проверка токена в базу не ходит.
+    """
+
+    def __init__(self):
+        self.revoked = {}
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def reload(self):
+        with self.lock:
+            if self.checked_at is not None and time.monotonic() - self.checked_at < SESSION_REVOCATION_CHECK:
+                return
             conn = get_db()
             cur = conn.cursor()
-            
-            cur.execute("SELECT is_admin FROM users WHERE id = %s", (admin_id,))
-            admin = cur.fetchone()
-            
-            if not admin or not admin[0]:
-                cur.close()
-                conn.close()
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Доступ запрещен'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("""
-                SELECT id, username, coins, last_login, time_spent_minutes,
-                       CASE WHEN last_login > NOW() - INTERVAL '5 minutes' THEN TRUE ELSE FALSE END as is_online
-                FROM users
-                ORDER BY is_online DESC, last_login DESC
-            """)
-            
-            users = [{
-                'id': u[0],
-                'username': u[1],
-                'coins': u[2],
-                'last_login': u[3].isoformat() if u[3] else None,
-                'time_spent_minutes': u[4],
-                'is_online': u[5]
-            } for u in cur.fetchall()]
-            
+            cur.execute(
+                "SELECT user_id, revoked_before FROM session_revocations WHERE revoked_before > %s",
+                (int(time.time() * 1000) - SESSION_TTL * 1000,)
+            )
+            self.revoked = dict(cur.fetchall())
             cur.close()
             conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'users': users}),
-                'isBase64Encoded': False
-            }
+            self.checked_at = time.monotonic()
+
+    def is_revoked(self, session: dict) -> bool:
+        if self.checked_at is None or time.monotonic() - self.checked_at >= SESSION_REVOCATION_CHECK:
+            self.reload()
+        return session['iat'] < self.revoked.get(session['uid'], 0)
+
+
+revocations = Revocations()
+
+def read_session(event: dict):
+    """Сессия из заголовка X-Session-Token: {'uid', 'name', 'adm', 'iat', 'exp'} или None без токена"""
+    token = get_header(event, 'X-Session-Token')
+    if not token:
+        return None
+    # Настоящий токен — base64url, всегда ASCII; compare_digest на str с другими символами бросает TypeError
+    if not token.isascii():
+        raise InvalidSession()
+    payload, _, signature = token.partition('.')
+    if not signature or not hmac.compare_digest(signature, session_signature(payload)):
+        raise InvalidSession()
+    try:
+        session = json.loads(b64url_decode(payload))
+    except ValueError:
+        raise InvalidSession()
+    if session['exp'] < time.time() * 1000 or revocations.is_revoked(session):
+        raise InvalidSession()
+    return session
+
+def session_user_id(session, claimed):
+    """id из токена; без токена — присланный клиентом, пока разрешен AUTH_ALLOW_LEGACY"""
+    if session:
+        return session['uid']
+    if not AUTH_ALLOW_LEGACY:
+        raise InvalidSession()
+    return claimed
+
+def check_admin(cur, session, admin_id) -> bool:
+    """С токеном флаг админа берется из него, без токена — прежняя проверка по базе"""
+    if session:
+        return bool(session['adm'])
+    cur.execute("SELECT is_admin FROM users WHERE id = %s", (admin_id,))
+    admin = cur.fetchone()
+    return bool(admin and admin[0])
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_PENDING_TTL = 60
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024'))
+IDEMPOTENCY_SWEEP_INTERVAL = float(os.environ.get('IDEMPOTENCY_SWEEP_INTERVAL', '600'))
+IDEMPOTENCY_SWEEP_BATCH = 5000
+REPLAY_HEADERS = dict(JSON_HEADERS, **{'Idempotency-Replayed': 'true', 'Access-Control-Expose-Headers': 'Idempotency-Replayed'})
+
+# Резерв ключа на время выполнения запроса; просроченную запись можно занять заново
+IDEMPOTENCY_RESERVE = """
+    INSERT INTO idempotency_keys AS k (key, fingerprint, expires_at)
+    VALUES (%s, %s, LOCALTIMESTAMP + make_interval(secs => %s))
+    ON CONFLICT (key) DO UPDATE SET
+        fingerprint = EXCLUDED.fingerprint, status = NULL, body = NULL, expires_at = EXCLUDED.expires_at
+    WHERE k.expires_at <= LOCALTIMESTAMP
+    RETURNING key
+"""
+
+IDEMPOTENCY_SWEEP = """
+    DELETE FROM idempotency_keys
+    WHERE key IN (
+        SELECT key FROM idempotency_keys
+        WHERE expires_at <= LOCALTIMESTAMP
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+class IdempotencyStore:
+    """Повтор POST с тем же Idempotency-Key получает первый ответ, маршрут второй раз не выполняется.
+    
+    Ответы живут IDEMPOTENCY_TTL в idempotency_keys, перед таблицей — LRU на инстанс: повтор
+    на тот же инстанс не ходит в базу, на другой — одно чтение по ключу. 5xx и 429 не сохраняются,
+    такой запрос можно повторить; просроченные ключи удаляются пачками.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.cache = OrderedDict()
+        self.counters = {'hits': 0, 'db_hits': 0, 'stored': 0, 'conflicts': 0, 'swept': 0}
+        self.swept_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _remember(self, key: bytes, entry: tuple):
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def _cached(self, key: bytes):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry
+
+    def _replay(self, entry: tuple, fingerprint: bytes) -> dict:
+        if entry[1] != fingerprint:
+            return error(422, 'Idempotency-Key уже использован для другого запроса')
+        return {'statusCode': entry[2], 'headers': REPLAY_HEADERS, 'body': entry[3], 'isBase64Encoded': False}
+
+    def middleware(self, route: str, event: dict, body: dict, call):
+        key = get_header(event, 'Idempotency-Key')
+        if event.get('httpMethod') != 'POST' or not key:
+            return call()
+        if len(key) > 255:
+            raise HttpError(400, 'Idempotency-Key длиннее 255 символов')
         
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            admin_id = body.get('admin_id')
-            target_user_id = body.get('user_id')
-            coins_amount = body.get('coins', 0)
-            
-            if not admin_id or not target_user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'admin_id и user_id обязательны'}),
-                    'isBase64Encoded': False
-                }
-            
+        session = read_session(event)
+        owner = session['uid'] if session else body.get('user_id') or body.get('admin_id')
+        key = hashlib.sha256(f'{route}\0{owner}\0{key}'.encode()).digest()[:16]
+        fingerprint = hashlib.sha256((event.get('body') or '').encode()).digest()[:16]
+        
+        entry = self._cached(key)
+        if entry is not None:
+            self.counters['hits'] += 1
+            return self._replay(entry, fingerprint)
+        
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT fingerprint, status, body, EXTRACT(EPOCH FROM expires_at - LOCALTIMESTAMP) FROM idempotency_keys "
+            "WHERE key = %s AND expires_at > LOCALTIMESTAMP",
+            (key,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(IDEMPOTENCY_RESERVE, (key, fingerprint, IDEMPOTENCY_PENDING_TTL))
+            row = None if cur.fetchone() else (fingerprint, None)
+            conn.commit()
+        cur.close()
+        conn.close()
+        if row is not None:
+            if row[1] is None:
+                self.counters['conflicts'] += 1
+                return error(409, 'Запрос с этим Idempotency-Key еще выполняется')
+            entry = (time.monotonic() + float(row[3]), bytes(row[0]), row[1], row[2])
+            self._remember(key, entry)
+            self.counters['db_hits'] += 1
+            return self._replay(entry, fingerprint)
+        
+        # Резерв уже закоммичен, поэтому маршрут выполняется без нашего соединения:
+        # иначе каждый запрос с ключом держал бы два соединения пула
+        # Соединения, которые маршрут не вернул (исключение посреди транзакции), освобождаются
+        # до записи результата, иначе при маленьком пуле запись ждала бы саму себя
+        try:
+            response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception:
+            db_pool.release_all()
+            self.release(key)
+            raise
+        db_pool.release_all()
+        
+        conn = get_db()
+        cur = conn.cursor()
+        status = response['statusCode']
+        if status >= 500 or status == 429:
+            cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+        else:
+            cur.execute(
+                "UPDATE idempotency_keys SET status = %s, body = %s, expires_at = LOCALTIMESTAMP + make_interval(secs => %s) "
+                "WHERE key = %s",
+                (status, response['body'], IDEMPOTENCY_TTL, key)
+            )
+            self._remember(key, (time.monotonic() + IDEMPOTENCY_TTL, fingerprint, status, response['body']))
+            self.counters['stored'] += 1
+        conn.commit()
+        self.maybe_sweep(cur)
+        cur.close()
+        conn.close()
+        return response
+
+    def release(self, key: bytes):
+        """Снимает резерв после сбоя маршрута, чтобы повтор не получал 409; сбой здесь только пишется
+        в журнал и не подменяет исключение маршрута — резерв тогда истечет через IDEMPOTENCY_PENDING_TTL"""
+        try:
             conn = get_db()
             cur = conn.cursor()
-            
-            cur.execute("SELECT is_admin FROM users WHERE id = %s", (admin_id,))
-            admin = cur.fetchone()
-            
-            if not admin or not admin[0]:
-                cur.close()
-                conn.close()
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Доступ запрещен'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("UPDATE users SET coins = coins + %s WHERE id = %s", (coins_amount, target_user_id))
-            
-            if coins_amount > 0:
-                cur.execute("""
-                    UPDATE user_quests SET progress = progress + %s 
-                    WHERE user_id = %s AND quest_id IN (SELECT id FROM quests WHERE quest_type = 'admin_coins')
-                """, (coins_amount, target_user_id))
-            
+            cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
             conn.commit()
-            
-            cur.execute("SELECT username, coins FROM users WHERE id = %s", (target_user_id,))
-            user = cur.fetchone()
-            
             cur.close()
             conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'message': f'Пользователю {user[0]} {"выдано" if coins_amount > 0 else "списано"} {abs(coins_amount)} ТитулКоинов',
-                    'new_coins': user[1]
-                }),
-                'isBase64Encoded': False
-            }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
-        
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        except Exception as e:
+            log_event(event='idempotency_release_failed', error=f'{type(e).__name__}: {e}'.strip())
+
+    def maybe_sweep(self, cur) -> int:
+        if time.monotonic() - self.swept_at < IDEMPOTENCY_SWEEP_INTERVAL:
+            return 0
+        self.swept_at = time.monotonic()
+        cur.execute(IDEMPOTENCY_SWEEP, (IDEMPOTENCY_SWEEP_BATCH,))
+        swept = cur.rowcount
+        cur.connection.commit()
+        self.counters['swept'] += swept
+        return swept
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE)
+
+router = Router('Content-Type, X-Session-Token, Idempotency-Key')
+router.errors[InvalidSession] = error(401, 'Требуется вход')
+install_metrics(router)
+router.middleware.append(idempotency.middleware)
+
+@router.route('GET')
+def list_users(event: dict, params: dict, body: dict) -> dict:
+    session = read_session(event)
+    admin_id = session_user_id(session, params.get('admin_id'))
+    
+    if not admin_id:
+        return error(400, 'admin_id обязателен')
+    
+    try:
+        limit = min(max(int(params.get('limit') or ADMIN_PAGE_SIZE), 1), ADMIN_PAGE_MAX)
+        after = parse_cursor(params.get('cursor'))
+    except ValueError:
+        return error(400, 'Неверные параметры выборки')
+    search = (params.get('search') or '').strip()
+    online_only = params.get('online_only') in ('1', 'true')
+    changed_since = params.get('changed_since')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    if not check_admin(cur, session, admin_id):
+        cur.close()
+        conn.close()
+        return error(403, 'Доступ запрещен')
+    
+    conditions = []
+    args = {'limit': limit + 1}
+    
+    if search:
+        conditions.append("username LIKE %(search)s")
+        args['search'] = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    if online_only:
+        conditions.append(f"{LAST_SEEN} > LOCALTIMESTAMP - {ONLINE_WINDOW}")
+    
+    if changed_since:
+        # Дельта: строки, изменённые после прошлого опроса, плюс те, у кого
+        # за это время истекло окно онлайна (сама строка при этом не менялась)
+        conditions.append(f"""(
+            updated_at > %(since)s::timestamp - INTERVAL '{ADMIN_DELTA_OVERLAP} seconds'
+            OR {LAST_SEEN} BETWEEN %(since)s::timestamp - {ONLINE_WINDOW} - INTERVAL '{ADMIN_DELTA_OVERLAP} seconds'
+                                AND LOCALTIMESTAMP - {ONLINE_WINDOW}
+        )""")
+        args['since'] = changed_since
+        args['limit'] = ADMIN_DELTA_MAX + 1
+    elif after:
+        conditions.append(f"({LAST_SEEN}, id) < (%(after_ts)s::timestamp, %(after_id)s)")
+        args['after_ts'], args['after_id'] = after
+    
+    try:
+        cur.execute(f"""
+            SELECT id, username, coins, last_login, time_spent_minutes,
+                   {LAST_SEEN} > LOCALTIMESTAMP - {ONLINE_WINDOW} AS is_online,
+                   LOCALTIMESTAMP
+            FROM users
+            WHERE {' AND '.join(conditions) or 'TRUE'}
+            ORDER BY {LAST_SEEN} DESC, id DESC
+            LIMIT %(limit)s
+        """, args)
+    except psycopg2.DataError:
+        conn.rollback()
+        cur.close()
+        conn.close()
+        return error(400, 'Неверный changed_since')
+    rows = cur.fetchall()
+    if rows:
+        server_time = rows[0][6]
+    else:
+        cur.execute("SELECT LOCALTIMESTAMP")
+        server_time = cur.fetchone()[0]
+    
+    cur.close()
+    conn.close()
+    
+    page_size = args['limit'] - 1
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    
+    users = [{
+        'id': u[0],
+        'username': u[1],
+        'coins': u[2],
+        'last_login': u[3].isoformat() if u[3] else None,
+        'time_spent_minutes': u[4],
+        'is_online': u[5]
+    } for u in rows]
+    
+    result = {'users': users, 'server_time': server_time.isoformat()}
+    if changed_since:
+        # Слишком много изменений: клиенту проще перечитать список с начала
+        result['delta'] = True
+        result['truncated'] = has_more
+    else:
+        result['next_cursor'] = make_cursor(rows[-1]) if has_more else None
+    
+    return respond(200, result)
+
+@router.route('POST', 'grant_batch')
+def grant_batch(event: dict, params: dict, body: dict) -> dict:
+    session = read_session(event)
+    admin_id = session_user_id(session, body.get('admin_id'))
+    
+    grants = body.get('grants') or []
+    user_filter = body.get('filter')
+    
+    if not isinstance(grants, list) or not all(isinstance(grant, dict) for grant in grants):
+        return error(400, 'Некорректные параметры запроса')
+    
+    if not admin_id or (not grants and not (isinstance(user_filter, str) and user_filter in BATCH_FILTERS)):
+        return error(400, 'admin_id и grants или filter обязательны')
+    
+    if len(grants) > ADMIN_BATCH_MAX:
+        return error(400, f'Не больше {ADMIN_BATCH_MAX} начислений за раз')
+    
+    totals = {}
+    try:
+        for grant in grants:
+            user_id = parse_int(grant['user_id'])
+            totals[user_id] = totals.get(user_id, 0) + parse_int(grant.get('coins', 0))
+        amount = parse_int(body.get('coins', 0))
+    except (KeyError, ValueError):
+        return error(400, 'Некорректные параметры запроса')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    if not check_admin(cur, session, admin_id):
+        cur.close()
+        conn.close()
+        return error(403, 'Доступ запрещен')
+    
+    if totals:
+        cur.execute("""
+            UPDATE users u SET coins = u.coins + g.amount, version = u.version + 1
+            FROM unnest(%s::int[], %s::int[]) AS g(user_id, amount)
+            WHERE u.id = g.user_id
+            RETURNING u.id, u.username, u.coins, g.amount
+        """, (list(totals), list(totals.values())))
+    else:
+        cur.execute(f"""
+            UPDATE users SET coins = coins + %s, version = version + 1
+            WHERE {BATCH_FILTERS[user_filter]}
+            RETURNING id, username, coins, %s
+        """, (amount, amount))
+    updated = cur.fetchall()
+    
+    quest_engine.emit_batch(cur, [
+        item
+        for user_id, _, new_coins, amount in updated if amount > 0
+        for item in ((user_id, 'admin_coins', amount), (user_id, 'coins_changed', new_coins))
+    ])
+    
+    conn.commit()
+    quest_engine.maybe_flush(conn)
+    cur.close()
+    conn.close()
+    
+    found = {u[0] for u in updated}
+    results = [{
+        'user_id': u[0],
+        'username': u[1],
+        'coins': u[3],
+        'new_coins': u[2],
+        'status': 'ok'
+    } for u in updated]
+    results += [{'user_id': user_id, 'status': 'not_found'} for user_id in totals if user_id not in found]
+    
+    return respond(200, {'updated': len(updated), 'results': results})
+
+@router.route('POST')
+def grant(event: dict, params: dict, body: dict) -> dict:
+    session = read_session(event)
+    admin_id = session_user_id(session, body.get('admin_id'))
+    
+    target_user_id = body.get('user_id')
+    coins_amount = body.get('coins', 0)
+    
+    if not admin_id or not target_user_id:
+        return error(400, 'admin_id и user_id обязательны')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    if not check_admin(cur, session, admin_id):
+        cur.close()
+        conn.close()
+        return error(403, 'Доступ запрещен')
+    
+    cur.execute(
+        "UPDATE users SET coins = coins + %s, version = version + 1 WHERE id = %s RETURNING username, coins",
+        (coins_amount, target_user_id)
+    )
+    user = cur.fetchone()
+    
+    if not user:
+        cur.close()
+        conn.close()
+        return error(404, 'Пользователь не найден')
+    
+    if coins_amount > 0:
+        quest_engine.emit(cur, target_user_id, ('admin_coins', coins_amount), ('coins_changed', user[1]))
+    
+    conn.commit()
+    quest_engine.maybe_flush(conn)
+    cur.close()
+    conn.close()
+    
+    return respond(200, {
+        'message': f'Пользователю {user[0]} {"выдано" if coins_amount > 0 else "списано"} {abs(coins_amount)} ТитулКоинов',
+        'new_coins': user[1]
+    })
+
+@router.route('POST', 'maintain_chat')
+def maintain_chat(event: dict, params: dict, body: dict) -> dict:
+    """Партиции чата на месяц вперед и архив месяцев старше CHAT_RETENTION_MONTHS.
+    
+    Запускается по расписанию или администратором, не чаще раза в день: раньше это делала отправка
+    сообщения, и блокировки DDL останавливали весь чат посреди чужого запроса.
+    """
+    session = read_session(event)
+    admin_id = session_user_id(session, body.get('admin_id'))
+    
+    if not admin_id:
+        return error(400, 'admin_id обязателен')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    if not check_admin(cur, session, admin_id):
+        cur.close()
+        conn.close()
+        return error(403, 'Доступ запрещен')
+    
+    cur.execute("SELECT set_config('lock_timeout', %s, TRUE)", (CHAT_MAINTENANCE_LOCK_TIMEOUT,))
+    try:
+        cur.execute("SELECT chat_messages_maintain(%s, 1)", (CHAT_RETENTION_MONTHS,))
+    except psycopg2.errors.LockNotAvailable:
+        conn.rollback()
+        cur.close()
+        conn.close()
+        return error(503, 'Чат занят, повторите обслуживание позже')
+    archived = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    conn.close()
+    
+    if archived:
+        log_event(event='chat_archive', messages=archived, keep_months=CHAT_RETENTION_MONTHS)
+    
+    return respond(200, {'archived': archived})
+
+def handler(event: dict, context) -> dict:
+    try:
+        return router.dispatch(event)
+    finally:
+        db_pool.release_all()
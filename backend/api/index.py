@@ -3,347 +3,1566 @@
 """
 import json
 import os
+import bisect
+import functools
+import base64
+import hashlib
+import hmac
+import threading
+import time
+import traceback
+from collections import OrderedDict
 import psycopg2
+import psycopg2.extensions
 from datetime import datetime, date, timedelta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает сессию"""
+    pool = None
+    released_at = 0.0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.putconn(self)
+        else:
+            super().close()
+
+    def discard(self):
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Пул соединений уровня модуля, переживает теплые вызовы функции"""
+
+    def __init__(self, maxconn: int, timeout: float):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0, 'broken': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _checked_out(self) -> list:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.released_at < DB_POOL_PING_AFTER:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self.counters['hits'] += 1
+                    break
+                if self._size < self.maxconn:
+                    conn = None
+                    self._size += 1
+                    self.counters['misses'] += 1
+                    break
+                if not waited:
+                    waited = True
+                    self.counters['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout('Нет свободных соединений с базой')
+        
+        if conn is not None and not self._is_healthy(conn):
+            self.counters['broken'] += 1
+            conn.discard()
+            conn = None
+        
+        if conn is None:
+            try:
+                conn = psycopg2.connect(
+                    os.environ['DATABASE_URL'],
+                    connection_factory=PooledConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        
+        conn.pool = self
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn):
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.discard()
+        
+        with self._cond:
+            if conn.closed:
+                self.counters['broken'] += 1
+                self._size -= 1
+            else:
+                conn.released_at = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def release_all(self):
+        for conn in list(self._checked_out()):
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counters, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
 def get_db():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    return db_pool.getconn()
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    path = event.get('queryStringParameters', {}).get('action', '')
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+# Сколько секунд браузер может не повторять preflight для тех же метода и заголовков
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+
+def dumps(data) -> str:
+    """orjson, если установлен в окружении функции, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def respond(status: int, data, headers: dict = JSON_HEADERS) -> dict:
+    return {'statusCode': status, 'headers': headers, 'body': dumps(data), 'isBase64Encoded': False}
+
+@functools.lru_cache(maxsize=256)
+def error(status: int, message: str) -> dict:
+    """Ответ с ошибкой сериализуется один раз на пару (статус, текст) и дальше отдается готовым"""
+    return respond(status, {'error': message})
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.response = error(status, message)
+
+
+class Router:
+    """Таблица маршрутов (метод, action) -> route(event, params, body).
     
-    if method == 'OPTIONS':
-        return {
+    action берется из query string, у POST — из JSON тела; без точного совпадения
+    используется маршрут метода без action. Исключения из errors превращаются в готовые
+    ответы, hooks вызываются после каждого запроса с (маршрут, секунды, статус),
+    middleware оборачивают вызов маршрута: middleware(маршрут, event, body, call).
+    """
+
+    def __init__(self, allow_headers: str):
+        self.routes = {}
+        self.errors = {
+            PoolTimeout: error(503, 'Нет свободных соединений с базой'),
+            psycopg2.OperationalError: error(503, 'База данных недоступна'),
+            psycopg2.DataError: error(400, 'Некорректные параметры запроса')
+        }
+        self.hooks = []
+        self.middleware = []
+        self.preflight = {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': allow_headers,
+                'Access-Control-Max-Age': CORS_MAX_AGE
             },
             'body': '',
             'isBase64Encoded': False
         }
+
+    def route(self, method: str, action: str = None):
+        def register(fn):
+            self.routes[(method, action)] = fn
+            return fn
+        return register
+
+    def dispatch(self, event: dict) -> dict:
+        method = event.get('httpMethod', 'GET')
+        if method == 'OPTIONS':
+            return self.preflight
+        
+        started = time.perf_counter()
+        name = method
+        try:
+            params = event.get('queryStringParameters') or {}
+            body = {}
+            if method == 'POST':
+                try:
+                    body = json.loads(event.get('body') or '{}')
+                except ValueError:
+                    raise HttpError(400, 'Некорректный JSON')
+                if not isinstance(body, dict):
+                    raise HttpError(400, 'Некорректный JSON')
+            action = body.get('action') if method == 'POST' else params.get('action')
+            fn = self.routes.get((method, action)) or self.routes.get((method, None))
+            if fn is None:
+                response = error(405, 'Метод не поддерживается')
+            else:
+                name = fn.__name__
+                call = functools.partial(fn, event, params, body)
+                for middleware in self.middleware:
+                    call = functools.partial(middleware, name, event, body, call)
+                response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception as e:
+            response = self.handle_error(name, e)
+        
+        for hook in self.hooks:
+            hook(name, time.perf_counter() - started, response['statusCode'])
+        return response
+
+    def handle_error(self, route: str, exc: Exception) -> dict:
+        """Ответ из errors по ближайшему классу исключения, иначе 500; сбои сервера пишутся в журнал"""
+        response = next((self.errors[cls] for cls in type(exc).__mro__ if cls in self.errors), None)
+        if response is None:
+            response = respond(500, {'error': str(exc)})
+        if response['statusCode'] >= 500:
+            log_event(
+                event='error', route=route, status=response['statusCode'],
+                error=f'{type(exc).__name__}: {exc}'.strip(), traceback=traceback.format_exc(limit=8)
+            )
+        return response
+
+
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '60'))
+METRICS_LOG_REQUESTS = os.environ.get('METRICS_LOG_REQUESTS') == '1'
+METRICS_KEY = os.environ.get('METRICS_KEY')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def log_event(**fields):
+    """Одна JSON-строка в stdout — журнал функции"""
+    print(dumps(fields), flush=True)
+
+
+class Metrics:
+    """Метрики инстанса: гистограмма длительности по маршрутам, число SQL и время в базе на запрос.
     
-    try:
-        if method == 'GET' and path == 'profile':
-            user_id = event.get('queryStringParameters', {}).get('user_id')
-            
-            if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            conn = get_db()
-            cur = conn.cursor()
-            
-            cur.execute("SELECT id, username, coins, is_admin, time_spent_minutes FROM users WHERE id = %s", (user_id,))
-            user = cur.fetchone()
-            
-            if not user:
-                cur.close()
-                conn.close()
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Пользователь не найден'}),
-                    'isBase64Encoded': False
+    Счетчики запроса лежат в thread-local и сбрасываются в begin(); сводка пишется в журнал
+    раз в METRICS_LOG_INTERVAL секунд и отдается маршрутом GET ?action=metrics.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logged_at = time.monotonic()
+
+    def begin(self):
+        self.local.queries = 0
+        self.local.db_ms = 0.0
+        self.local.slow = []
+
+    def record_query(self, query, elapsed_ms: float):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        local.queries += 1
+        local.db_ms += elapsed_ms
+        if elapsed_ms >= SLOW_QUERY_MS:
+            local.slow.append((round(elapsed_ms, 1), ' '.join(str(query).split())[:300]))
+
+    def observe(self, route: str, seconds: float, status: int):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        elapsed_ms = seconds * 1000
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'queries': 0, 'db_ms': 0.0, 'slow_queries': 0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)
                 }
-            
-            cur.execute("""
-                SELECT t.id, t.name, t.price, t.color, t.is_limited, 
-                       CASE WHEN ut.id IS NOT NULL THEN TRUE ELSE FALSE END as owned
-                FROM titles t
-                LEFT JOIN user_titles ut ON t.id = ut.title_id AND ut.user_id = %s
-                ORDER BY t.display_order
-            """, (user_id,))
-            titles = [{'id': t[0], 'name': t[1], 'price': t[2], 'color': t[3], 'is_limited': t[4], 'owned': t[5]} for t in cur.fetchall()]
-            
-            cur.execute("""
-                SELECT q.id, q.title, q.description, q.reward, q.quest_type, q.target_value,
-                       COALESCE(uq.progress, 0) as progress, COALESCE(uq.completed, FALSE) as completed
-                FROM quests q
-                LEFT JOIN user_quests uq ON q.id = uq.quest_id AND uq.user_id = %s
-                ORDER BY q.display_order
-            """, (user_id,))
-            quests = [{
-                'id': q[0], 
-                'title': q[1], 
-                'description': q[2], 
-                'reward': q[3], 
-                'quest_type': q[4],
-                'target_value': q[5],
-                'progress': min(100, int((q[6] / q[5] * 100) if q[5] > 0 else 0)),
-                'completed': q[7]
-            } for q in cur.fetchall()]
-            
-            cur.execute("""
-                SELECT day_streak, login_date, reward_claimed
-                FROM daily_logins
-                WHERE user_id = %s
-                ORDER BY login_date DESC
-                LIMIT 1
-            """, (user_id,))
-            daily_login = cur.fetchone()
-            current_streak = 0
-            can_claim_daily = False
-            
-            if daily_login:
-                current_streak = daily_login[0]
-                last_login_date = daily_login[1]
-                today = date.today()
-                
-                if last_login_date < today:
-                    if last_login_date == today - timedelta(days=1):
-                        can_claim_daily = True
-                    else:
-                        current_streak = 0
-                        can_claim_daily = True
-            else:
-                can_claim_daily = True
-            
-            cur.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'user': {
-                        'id': user[0],
-                        'username': user[1],
-                        'coins': user[2],
-                        'is_admin': user[3],
-                        'time_spent_minutes': user[4]
-                    },
-                    'titles': titles,
-                    'quests': quests,
-                    'daily_streak': current_streak,
-                    'can_claim_daily': can_claim_daily
-                }),
-                'isBase64Encoded': False
+            stats['count'] += 1
+            stats['errors'] += status >= 500
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['queries'] += local.queries
+            stats['db_ms'] += local.db_ms
+            stats['slow_queries'] += len(local.slow)
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            due = METRICS_LOG_INTERVAL > 0 and time.monotonic() - self.logged_at >= METRICS_LOG_INTERVAL
+            if due:
+                self.logged_at = time.monotonic()
+        
+        for slow_ms, query in local.slow:
+            log_event(event='slow_query', route=route, ms=slow_ms, query=query)
+        if METRICS_LOG_REQUESTS:
+            log_event(
+                event='request', route=route, status=status, ms=round(elapsed_ms, 2),
+                queries=local.queries, db_ms=round(local.db_ms, 2)
+            )
+        if due:
+            log_event(event='metrics', routes=self.snapshot(), pool=db_pool.stats())
+        self.begin()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            routes = {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in self.routes.items()}
+        result = {}
+        for name, stats in routes.items():
+            count = stats['count']
+            result[name] = {
+                'count': count,
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total_ms'] / count, 2),
+                'p50_ms': self.percentile(stats, 0.50),
+                'p95_ms': self.percentile(stats, 0.95),
+                'p99_ms': self.percentile(stats, 0.99),
+                'max_ms': round(stats['max_ms'], 2),
+                'queries_per_request': round(stats['queries'] / count, 2),
+                'db_ms_per_request': round(stats['db_ms'] / count, 2),
+                'slow_queries': stats['slow_queries']
             }
+        return result
+
+    @staticmethod
+    def percentile(stats: dict, pct: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль, но не больше максимума"""
+        needed = pct * stats['count']
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS_MS, stats['buckets']):
+            seen += hits
+            if seen >= needed:
+                return min(bound, round(stats['max_ms'], 2))
+        return round(stats['max_ms'], 2)
+
+
+metrics = Metrics()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Курсор соединений пула: считает запросы и время в базе для текущего запроса"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+def install_metrics(router):
+    router.hooks.append(metrics.observe)
+    
+    @router.route('GET', 'metrics')
+    def metrics_dump(event: dict, params: dict, body: dict) -> dict:
+        key = get_header(event, 'X-Metrics-Key') or ''
+        if not METRICS_KEY or not hmac.compare_digest(key.encode('utf-8', 'surrogatepass'), METRICS_KEY.encode()):
+            return error(404, 'Не найдено')
+        return respond(200, {'routes': metrics.snapshot(), 'pool': db_pool.stats()})
+
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', '5'))
+
+
+class Catalog:
+    """Кэш справочников titles и quests на инстанс, перечитывается при смене catalog_version"""
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.titles = []
+        self.titles_by_id = {}
+        self.titles_by_name = {}
+        self.quests = []
+        self.daily_rewards = {}
+        self.lock = threading.Lock()
+
+    def load(self, cur, version: int):
+        cur.execute("SELECT id, name, price, color, is_limited FROM titles ORDER BY display_order")
+        self.titles = [{'id': t[0], 'name': t[1], 'price': t[2], 'color': t[3], 'is_limited': t[4]} for t in cur.fetchall()]
+        self.titles_by_id = {t['id']: t for t in self.titles}
+        self.titles_by_name = {t['name']: t for t in self.titles}
         
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'buy_title':
-                user_id = body.get('user_id')
-                title_id = body.get('title_id')
-                
-                conn = get_db()
-                cur = conn.cursor()
-                
-                cur.execute("SELECT coins FROM users WHERE id = %s", (user_id,))
-                user = cur.fetchone()
-                
-                cur.execute("SELECT id, name, price FROM titles WHERE id = %s", (title_id,))
-                title = cur.fetchone()
-                
-                cur.execute("SELECT id FROM user_titles WHERE user_id = %s AND title_id = %s", (user_id, title_id))
-                if cur.fetchone():
-                    cur.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Титул уже куплен'}),
-                        'isBase64Encoded': False
-                    }
-                
-                if user[0] < title[2]:
-                    cur.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Недостаточно ТитулКоинов'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute("UPDATE users SET coins = coins - %s WHERE id = %s", (title[2], user_id))
-                cur.execute("INSERT INTO user_titles (user_id, title_id) VALUES (%s, %s)", (user_id, title_id))
-                cur.execute("""
-                    UPDATE user_quests SET progress = progress + 1 
-                    WHERE user_id = %s AND quest_id IN (SELECT id FROM quests WHERE quest_type = 'buy_title')
-                """, (user_id,))
-                
-                conn.commit()
-                cur.execute("SELECT coins FROM users WHERE id = %s", (user_id,))
-                new_coins = cur.fetchone()[0]
-                cur.close()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': f'Титул {title[1]} успешно куплен!', 'new_coins': new_coins}),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'sell_title':
-                user_id = body.get('user_id')
-                title_id = body.get('title_id')
-                
+        cur.execute("""
+            SELECT id, title, description, reward, quest_type, target_value
+            FROM quests
+            ORDER BY display_order
+        """)
+        self.quests = [{
+            'id': q[0],
+            'title': q[1],
+            'description': q[2],
+            'reward': q[3],
+            'quest_type': q[4],
+            'target_value': q[5]
+        } for q in cur.fetchall()]
+        
+        cur.execute("SELECT day_streak, coins, title_id FROM daily_rewards")
+        self.daily_rewards = {
+            r[0]: {'coins': r[1], 'title': self.titles_by_id.get(r[2])} for r in cur.fetchall()
+        }
+        self.version = version
+
+    def sync(self, cur, version: int):
+        with self.lock:
+            if version != self.version:
+                self.load(cur, version)
+            self.checked_at = time.monotonic()
+        return self
+
+    def ensure(self, cur):
+        if self.version is not None and time.monotonic() - self.checked_at < CATALOG_CHECK_INTERVAL:
+            return self
+        cur.execute("SELECT version FROM catalog_version")
+        return self.sync(cur, cur.fetchone()[0])
+
+
+catalog = Catalog()
+
+QUEST_WRITE_BEHIND = os.environ.get('QUEST_WRITE_BEHIND') == '1'
+QUEST_FLUSH_INTERVAL = float(os.environ.get('QUEST_FLUSH_INTERVAL', '10'))
+QUEST_FLUSH_BATCH = int(os.environ.get('QUEST_FLUSH_BATCH', '500'))
+
+QUEST_EVENTS = {
+    'chat_message': ('chat_messages', 'add'),
+    'buy_title': ('buy_title', 'add'),
+    'sell_title': ('sell_title', 'add'),
+    'admin_coins': ('admin_coins', 'add'),
+    'daily_streak': ('daily_streak', 'set'),
+    'coins_changed': ('coins_earned', 'max'),
+    'online_users': ('online_users', 'max'),
+    'time_spent': ('time_spent', 'max'),
+    'weekly_time': ('weekly_time', 'max'),
+}
+
+QUEST_UPSERT = """
+    WITH e (user_id, quest_id, amount, target, mode) AS (
+        SELECT * FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::text[])
+    )
+    INSERT INTO user_quests AS uq (user_id, quest_id, progress, completed, completed_at)
+    SELECT user_id, quest_id, amount, amount >= target, CASE WHEN amount >= target THEN NOW() END
+    FROM e
+    ON CONFLICT (user_id, quest_id) DO UPDATE SET (progress, completed, completed_at) = (
+        SELECT p.progress,
+               uq.completed OR p.progress >= e.target,
+               COALESCE(uq.completed_at, CASE WHEN p.progress >= e.target THEN NOW() END)
+        FROM e
+        CROSS JOIN LATERAL (
+            SELECT CASE e.mode
+                       WHEN 'add' THEN uq.progress + e.amount
+                       WHEN 'max' THEN GREATEST(uq.progress, e.amount)
+                       ELSE e.amount
+                   END AS progress
+        ) p
+        WHERE e.user_id = EXCLUDED.user_id AND e.quest_id = EXCLUDED.quest_id
+    )
+"""
+
+QUEST_FOLD = """
+    WITH moved AS (
+        DELETE FROM quest_events
+        WHERE id IN (
+            SELECT id FROM quest_events
+            WHERE %(user_id)s::int IS NULL OR user_id = %(user_id)s
+            ORDER BY id
+            LIMIT %(batch)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING user_id, quest_type, amount
+    ),
+    totals AS (
+        SELECT m.user_id, q.id AS quest_id, q.target_value AS target, SUM(m.amount)::int AS amount
+        FROM moved m
+        JOIN quests q ON q.quest_type = m.quest_type
+        GROUP BY m.user_id, q.id, q.target_value
+    ),
+    folded AS (
+        INSERT INTO user_quests AS uq (user_id, quest_id, progress, completed, completed_at)
+        SELECT user_id, quest_id, amount, amount >= target, CASE WHEN amount >= target THEN NOW() END
+        FROM totals
+        ON CONFLICT (user_id, quest_id) DO UPDATE SET (progress, completed, completed_at) = (
+            SELECT uq.progress + EXCLUDED.progress,
+                   uq.completed OR uq.progress + EXCLUDED.progress >= t.target,
+                   COALESCE(uq.completed_at, CASE WHEN uq.progress + EXCLUDED.progress >= t.target THEN NOW() END)
+            FROM totals t
+            WHERE t.user_id = EXCLUDED.user_id AND t.quest_id = EXCLUDED.quest_id
+        )
+    )
+    SELECT COUNT(*) FROM moved
+"""
+
+
+class QuestEngine:
+    """Переводит типизированные события в прогресс квестов одним пакетным upsert.
+    
+    В режиме QUEST_WRITE_BEHIND счетчики (события с режимом add) дописываются в quest_events
+    и сворачиваются в user_quests пачками по размеру или по времени.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.quests_by_type = {}
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def index(self, cur) -> dict:
+        if self.version is not None and time.monotonic() - self.checked_at < CATALOG_CHECK_INTERVAL:
+            return self.quests_by_type
+        with self.lock:
+            cur.execute("SELECT version FROM catalog_version")
+            version = cur.fetchone()[0]
+            if version != self.version:
+                cur.execute("SELECT id, quest_type, target_value FROM quests ORDER BY id")
+                quests_by_type = {}
+                for quest_id, quest_type, target in cur.fetchall():
+                    quests_by_type.setdefault(quest_type, []).append((quest_id, target))
+                self.quests_by_type = quests_by_type
+                self.version = version
+            self.checked_at = time.monotonic()
+        return self.quests_by_type
+
+    def emit(self, cur, user_id, *events):
+        self.emit_batch(cur, [(user_id, event_type, value) for event_type, value in events])
+
+    def emit_batch(self, cur, events):
+        """events: список (user_id, event_type, value); повторы одного квеста сливаются до записи"""
+        quests_by_type = self.index(cur)
+        rows = {}
+        deferred = ([], [], [])
+        for user_id, event_type, value in events:
+            quest_type, mode = QUEST_EVENTS[event_type]
+            if QUEST_WRITE_BEHIND and mode == 'add':
+                for column, item in zip(deferred, (int(user_id), quest_type, value)):
+                    column.append(item)
+                continue
+            for quest_id, target in quests_by_type.get(quest_type, ()):
+                key = (int(user_id), quest_id)
+                amount = value
+                if key in rows and mode == 'add':
+                    amount = rows[key][0] + value
+                elif key in rows and mode == 'max':
+                    amount = max(rows[key][0], value)
+                rows[key] = (amount, target, mode)
+        if rows:
+            execute_prepared(
+                cur, 'quest_upsert', QUEST_UPSERT, 'int[], int[], int[], int[], text[]',
+                (
+                    [key[0] for key in rows],
+                    [key[1] for key in rows],
+                    [row[0] for row in rows.values()],
+                    [row[1] for row in rows.values()],
+                    [row[2] for row in rows.values()]
+                )
+            )
+        if deferred[0]:
+            cur.execute(
+                "INSERT INTO quest_events (user_id, quest_type, amount) SELECT * FROM unnest(%s::int[], %s::text[], %s::int[])",
+                deferred
+            )
+            self.pending += len(deferred[0])
+
+    def due(self) -> bool:
+        if not QUEST_WRITE_BEHIND:
+            return False
+        return self.pending >= QUEST_FLUSH_BATCH or time.monotonic() - self.flushed_at >= QUEST_FLUSH_INTERVAL
+
+    def maybe_flush(self, conn):
+        if self.due():
+            self.flush(conn)
+
+    def flush(self, conn) -> int:
+        """Сворачивает очередь пачками по QUEST_FLUSH_BATCH, пока неполная пачка не покажет, что она пуста"""
+        cur = conn.cursor()
+        folded = 0
+        while True:
+            cur.execute(QUEST_FOLD, {'batch': QUEST_FLUSH_BATCH, 'user_id': None})
+            moved = cur.fetchone()[0]
+            conn.commit()
+            folded += moved
+            if moved < QUEST_FLUSH_BATCH:
+                break
+        cur.close()
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        return folded
+
+    def fold_user(self, cur, user_id: int) -> int:
+        """Сворачивает все отложенные события пользователя в текущей транзакции"""
+        if not QUEST_WRITE_BEHIND:
+            return 0
+        cur.execute(QUEST_FOLD, {'batch': None, 'user_id': user_id})
+        return cur.fetchone()[0]
+
+
+quest_engine = QuestEngine()
+
+LEADERBOARD_TTL = float(os.environ.get('LEADERBOARD_TTL', '10'))
+LEADERBOARD_SIZE = 100
+
+LEADERBOARD_QUERIES = {
+    'coins': """
+        SELECT id, username, coins
+        FROM users
+        ORDER BY coins DESC, id
+        LIMIT %(limit)s
+    """,
+    'titles': """
+        SELECT s.user_id, u.username, s.titles_owned
+        FROM user_stats s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.titles_owned > 0
+        ORDER BY s.titles_owned DESC, s.user_id
+        LIMIT %(limit)s
+    """,
+    'chat': """
+        SELECT s.user_id, u.username, s.chat_messages
+        FROM user_stats s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.chat_messages > 0
+        ORDER BY s.chat_messages DESC, s.user_id
+        LIMIT %(limit)s
+    """,
+    'streak': """
+        SELECT s.user_id, u.username, s.day_streak
+        FROM user_stats s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.day_streak > 0 AND s.last_claim_date >= %(today)s - 1
+        ORDER BY s.day_streak DESC, s.user_id
+        LIMIT %(limit)s
+    """,
+}
+
+ONLINE_COUNT_QUERY = """
+    SELECT COUNT(*) FROM users
+    WHERE COALESCE(last_login, '-infinity'::timestamp) > LOCALTIMESTAMP - INTERVAL '5 minutes'
+"""
+
+
+class Leaderboards:
+    """Кэш таблиц лидеров и счетчика онлайна на инстанс с коротким TTL.
+    
+    Топ каждой таблицы читается из user_stats по индексу целиком (LEADERBOARD_SIZE строк),
+    запросы с меньшим limit отдаются срезом из кэша.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def cached(self, key, load, cur=None):
+        entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[0] < LEADERBOARD_TTL:
+            return entry[1]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[0] < LEADERBOARD_TTL:
+                return entry[1]
+            if cur is None:
                 conn = get_db()
-                cur = conn.cursor()
-                
-                cur.execute("SELECT id FROM user_titles WHERE user_id = %s AND title_id = %s", (user_id, title_id))
-                if not cur.fetchone():
-                    cur.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Титул не куплен'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute("SELECT id, name, price FROM titles WHERE id = %s", (title_id,))
-                title = cur.fetchone()
-                
-                if title[1] == '[NEWBIE]':
-                    cur.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Нельзя продать стартовый титул'}),
-                        'isBase64Encoded': False
-                    }
-                
-                sell_price = title[2] // 2
-                
-                cur.execute("DELETE FROM user_titles WHERE user_id = %s AND title_id = %s", (user_id, title_id))
-                cur.execute("UPDATE users SET coins = coins + %s WHERE id = %s", (sell_price, user_id))
-                cur.execute("""
-                    UPDATE user_quests SET progress = progress + 1 
-                    WHERE user_id = %s AND quest_id IN (SELECT id FROM quests WHERE quest_type = 'sell_title')
-                """, (user_id,))
-                
-                conn.commit()
-                cur.execute("SELECT coins FROM users WHERE id = %s", (user_id,))
-                new_coins = cur.fetchone()[0]
-                cur.close()
+                own_cur = conn.cursor()
+                value = load(own_cur)
+                own_cur.close()
                 conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': f'Титул {title[1]} продан за {sell_price} ТитулКоинов!', 'new_coins': new_coins}),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'claim_daily':
-                user_id = body.get('user_id')
-                
-                conn = get_db()
-                cur = conn.cursor()
-                
-                today = date.today()
-                
-                cur.execute("""
-                    SELECT day_streak, login_date, reward_claimed
-                    FROM daily_logins
-                    WHERE user_id = %s
-                    ORDER BY login_date DESC
-                    LIMIT 1
-                """, (user_id,))
-                
-                last_login = cur.fetchone()
-                current_streak = 1
-                
-                if last_login:
-                    last_date = last_login[1]
-                    
-                    if last_date == today:
-                        if last_login[2]:
-                            cur.close()
-                            conn.close()
-                            return {
-                                'statusCode': 400,
-                                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                                'body': json.dumps({'error': 'Награда уже получена сегодня'}),
-                                'isBase64Encoded': False
-                            }
-                        current_streak = last_login[0]
-                    elif last_date == today - timedelta(days=1):
-                        current_streak = last_login[0] + 1
-                
-                rewards = {
-                    1: {'coins': 50, 'title': None},
-                    2: {'coins': 100, 'title': None},
-                    3: {'coins': 0, 'title': '[Третий]'},
-                    4: {'coins': 150, 'title': None},
-                    5: {'coins': 500, 'title': None},
-                    6: {'coins': 750, 'title': None},
-                    7: {'coins': 0, 'title': '[Ежедневный]'}
-                }
-                
-                reward = rewards.get(current_streak, {'coins': 0, 'title': None})
-                
-                if reward['coins'] > 0:
-                    cur.execute("UPDATE users SET coins = coins + %s WHERE id = %s", (reward['coins'], user_id))
-                
-                if reward['title']:
-                    cur.execute("SELECT id FROM titles WHERE name = %s", (reward['title'],))
-                    title = cur.fetchone()
-                    if title:
-                        cur.execute(
-                            "INSERT INTO user_titles (user_id, title_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                            (user_id, title[0])
-                        )
-                
-                cur.execute(
-                    "INSERT INTO daily_logins (user_id, login_date, day_streak, reward_claimed) VALUES (%s, %s, %s, TRUE) ON CONFLICT (user_id, login_date) DO UPDATE SET reward_claimed = TRUE",
-                    (user_id, today, current_streak)
+            else:
+                value = load(cur)
+            self.entries[key] = (time.monotonic(), value)
+        return value
+
+    def top(self, board: str, cur=None) -> list:
+        def load(cur):
+            cur.execute(LEADERBOARD_QUERIES[board], {'limit': LEADERBOARD_SIZE, 'today': date.today()})
+            return [{
+                'rank': rank,
+                'user_id': row[0],
+                'username': row[1],
+                'value': row[2]
+            } for rank, row in enumerate(cur.fetchall(), 1)]
+        return self.cached(board, load, cur)
+
+    def online_count(self, cur=None) -> int:
+        def load(cur):
+            cur.execute(ONLINE_COUNT_QUERY)
+            return cur.fetchone()[0]
+        return self.cached('online', load, cur)
+
+
+leaderboards = Leaderboards()
+
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '30'))
+PRESENCE_FLUSH_BATCH = int(os.environ.get('PRESENCE_FLUSH_BATCH', '1000'))
+
+# Минуты засчитываются не больше, чем прошло с прошлой отметки в last_login (с запасом 10 с на
+# сетевой разброс): дубли heartbeat-ов с разных инстансов и частые вызовы время не накручивают.
+# Строки блокируются по порядку id, чтобы параллельные сбросы не ловили взаимную блокировку
+PRESENCE_FLUSH = """
+    WITH beats AS (
+        SELECT b.user_id, b.beats, b.seen,
+               GREATEST(0, LEAST(
+                   b.beats,
+                   FLOOR((EXTRACT(EPOCH FROM b.seen - COALESCE(u.last_login, b.seen - INTERVAL '1 hour')) + 10) / 60)
+               ))::int AS minutes
+        FROM unnest($1::int[], $2::int[], $3::timestamp[]) AS b (user_id, beats, seen)
+        JOIN users u ON u.id = b.user_id
+        ORDER BY b.user_id
+        FOR UPDATE OF u
+    ),
+    touched AS (
+        UPDATE users u SET
+            time_spent_minutes = COALESCE(u.time_spent_minutes, 0) + b.minutes,
+            last_login = GREATEST(u.last_login, b.seen),
+            version = u.version + 1
+        FROM beats b
+        WHERE u.id = b.user_id
+        RETURNING u.id, u.time_spent_minutes, b.minutes
+    ),
+    week AS (
+        INSERT INTO user_stats AS s (user_id, week_start, week_minutes)
+        SELECT id, $4, minutes FROM touched
+        ON CONFLICT (user_id) DO UPDATE SET
+            week_minutes = CASE WHEN s.week_start = EXCLUDED.week_start
+                                THEN s.week_minutes + EXCLUDED.week_minutes
+                                ELSE EXCLUDED.week_minutes END,
+            week_start = EXCLUDED.week_start
+        RETURNING user_id, week_minutes
+    )
+    SELECT t.id, t.time_spent_minutes, w.week_minutes, t.minutes
+    FROM touched t
+    JOIN week w ON w.user_id = t.id
+"""
+
+
+class Presence:
+    """Heartbeat-ы онлайна копятся в памяти и пишутся одним пакетным UPDATE раз в интервал.
+    
+    Число записей в базу растет с числом сбросов, а не с числом пользователей онлайн;
+    при заморозке инстанса теряется не больше одного интервала присутствия.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def beat(self, user_id: int):
+        with self.lock:
+            entry = self.pending.get(user_id)
+            if entry is None:
+                entry = self.pending[user_id] = [0, None]
+            entry[0] += 1
+            entry[1] = datetime.now()
+
+    def due(self) -> bool:
+        return bool(self.pending) and (
+            len(self.pending) >= PRESENCE_FLUSH_BATCH
+            or time.monotonic() - self.flushed_at >= PRESENCE_FLUSH_INTERVAL
+        )
+
+    def flush(self, conn) -> int:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.monotonic()
+        if not pending:
+            return 0
+        user_ids = sorted(pending)
+        today = date.today()
+        cur = conn.cursor()
+        try:
+            execute_prepared(
+                cur, 'presence_flush', PRESENCE_FLUSH, 'int[], int[], timestamp[], date',
+                (
+                    user_ids,
+                    [pending[user_id][0] for user_id in user_ids],
+                    [pending[user_id][1] for user_id in user_ids],
+                    today - timedelta(days=today.weekday())
                 )
-                
-                cur.execute("""
-                    UPDATE user_quests SET progress = %s 
-                    WHERE user_id = %s AND quest_id IN (SELECT id FROM quests WHERE quest_type = 'daily_streak')
-                """, (current_streak, user_id))
-                
-                conn.commit()
-                cur.execute("SELECT coins FROM users WHERE id = %s", (user_id,))
-                new_coins = cur.fetchone()[0]
-                cur.close()
-                conn.close()
-                
-                message = f'День {current_streak}! '
-                if reward['coins'] > 0:
-                    message += f'Получено {reward["coins"]} ТитулКоинов!'
-                if reward['title']:
-                    message += f' Получен титул {reward["title"]}!'
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'message': message,
-                        'day_streak': current_streak,
-                        'coins_reward': reward['coins'],
-                        'title_reward': reward['title'],
-                        'new_coins': new_coins
-                    }),
-                    'isBase64Encoded': False
-                }
+            )
+            rows = cur.fetchall()
+            online_now = leaderboards.online_count(cur)
+            events = []
+            for user_id, total, week, minutes in rows:
+                events.append((user_id, 'online_users', online_now))
+                if minutes:
+                    events.append((user_id, 'time_spent', total))
+                    events.append((user_id, 'weekly_time', week))
+            quest_engine.emit_batch(cur, events)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with self.lock:
+                for user_id, (beats, seen) in pending.items():
+                    entry = self.pending.setdefault(user_id, [0, seen])
+                    entry[0] += beats
+                    entry[1] = max(entry[1], seen)
+            raise
+        finally:
+            cur.close()
+        return len(rows)
+
+
+presence = Presence()
+
+PROFILE_QUERY = """
+    SELECT u.id, u.username, u.coins, u.is_admin, u.time_spent_minutes,
+           (SELECT version FROM catalog_version),
+           ARRAY(SELECT title_id FROM user_titles WHERE user_id = $1),
+           ARRAY(
+               SELECT ARRAY[quest_id, progress, completed::int, (claimed_at IS NOT NULL)::int]
+               FROM user_quests
+               WHERE user_id = $1
+           ),
+           ARRAY(
+               SELECT ARRAY[quest_type, SUM(amount)::text]
+               FROM quest_events
+               WHERE user_id = $1
+               GROUP BY quest_type
+           ),
+           CASE WHEN s.last_claim_date >= $2 - 1 THEN s.day_streak ELSE 0 END,
+           s.last_claim_date IS NULL OR s.last_claim_date < $2,
+           u.version
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.id
+    WHERE u.id = $1
+"""
+
+# Проверка If-None-Match: версия пользователя и справочников без чтения титулов и квестов
+PROFILE_VERSION_QUERY = "SELECT version, (SELECT version FROM catalog_version) FROM users WHERE id = $1"
+
+DAILY_LOGIN_HISTORY = os.environ.get('DAILY_LOGIN_HISTORY', '1') == '1'
+
+# Серия продлевается, если вчера награда была получена, иначе начинается заново; повторный вызов
+# в тот же день не проходит условие WHERE и ничего не возвращает. История в daily_logins — по флагу $3.
+# Строка users блокируется до user_stats — в том же порядке, что у сброса присутствия, покупок и чата
+CLAIM_DAILY_QUERY = """
+    WITH claimant AS (
+        SELECT id FROM users WHERE id = $1 FOR UPDATE
+    ),
+    claim AS (
+        INSERT INTO user_stats AS s (user_id, day_streak, last_claim_date)
+        SELECT id, 1, $2 FROM claimant
+        ON CONFLICT (user_id) DO UPDATE SET
+            day_streak = CASE WHEN s.last_claim_date = $2 - 1 THEN s.day_streak + 1 ELSE 1 END,
+            last_claim_date = $2
+        WHERE s.last_claim_date IS NULL OR s.last_claim_date < $2
+        RETURNING user_id, day_streak
+    ),
+    history AS (
+        INSERT INTO daily_logins (user_id, login_date, day_streak, reward_claimed)
+        SELECT user_id, $2, day_streak, TRUE FROM claim WHERE $3
+        ON CONFLICT (user_id, login_date) DO NOTHING
+    )
+    SELECT day_streak FROM claim
+"""
+
+# Выплата всех выполненных и еще не оплаченных квестов одним оператором. Строки блокируются,
+# и при параллельном вызове условие claimed_at IS NULL перепроверяется на свежей версии строки:
+# второй вызов не находит ничего и ничего не начисляет
+CLAIM_QUESTS_QUERY = """
+    WITH ready AS (
+        SELECT uq.id
+        FROM user_quests uq
+        JOIN quests q ON q.id = uq.quest_id
+        WHERE uq.user_id = $1
+          AND uq.claimed_at IS NULL
+          AND q.target_value > 0
+          AND (uq.completed OR uq.progress >= q.target_value)
+        FOR UPDATE OF uq
+    ),
+    claimed AS (
+        UPDATE user_quests uq SET
+            claimed_at = NOW(),
+            completed = TRUE,
+            completed_at = COALESCE(uq.completed_at, NOW())
+        FROM ready r, quests q
+        WHERE uq.id = r.id AND q.id = uq.quest_id
+        RETURNING q.id, q.title, q.reward
+    ),
+    paid AS (
+        UPDATE users SET coins = coins + (SELECT SUM(reward) FROM claimed), version = version + 1
+        WHERE id = $1 AND EXISTS (SELECT 1 FROM claimed)
+        RETURNING coins
+    )
+    SELECT EXISTS (SELECT 1 FROM users WHERE id = $1),
+           COALESCE((SELECT coins FROM paid), (SELECT coins FROM users WHERE id = $1)),
+           ARRAY(SELECT ARRAY[id::text, title, reward::text] FROM claimed ORDER BY id)
+"""
+
+BUY_TITLE_QUERY = """
+    WITH owned AS (
+        INSERT INTO user_titles (user_id, title_id)
+        SELECT id, $2 FROM users WHERE id = $1
+        ON CONFLICT (user_id, title_id) DO NOTHING
+        RETURNING id
+    ),
+    debit AS (
+        UPDATE users u SET coins = u.coins - t.price, version = u.version + 1
+        FROM titles t
+        WHERE u.id = $1 AND t.id = $2
+          AND u.coins >= t.price
+          AND EXISTS (SELECT 1 FROM owned)
+        RETURNING u.coins
+    )
+    SELECT EXISTS (SELECT 1 FROM users WHERE id = $1),
+           EXISTS (SELECT 1 FROM owned),
+           (SELECT coins FROM debit)
+"""
+
+# Продажа одним оператором: начисление идет только за реально удаленную строку, поэтому из двух
+# параллельных продаж одного титула вторая ничего не находит. users обновляется до триггера
+# user_titles, который трогает user_stats в конце оператора — тот же порядок блокировок, что у покупки
+SELL_TITLE_QUERY = """
+    WITH sold AS (
+        DELETE FROM user_titles ut
+        USING titles t
+        WHERE ut.user_id = $1 AND ut.title_id = $2 AND t.id = ut.title_id
+        RETURNING t.price / 2 AS amount
+    ),
+    credit AS (
+        UPDATE users u SET coins = u.coins + s.amount, version = u.version + 1
+        FROM sold s
+        WHERE u.id = $1
+        RETURNING u.coins, s.amount
+    )
+    SELECT coins, amount FROM credit
+"""
+
+def execute_prepared(cur, name: str, query: str, types: str, args: tuple):
+    """PREPARE выполняется один раз на соединение из пула, дальше только EXECUTE без планирования"""
+    conn = cur.connection
+    if getattr(conn, 'prepared', None) is None:
+        conn.prepared = set()
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} ({types}) AS {query}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+
+def get_header(event: dict, name: str):
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+# Только явный секрет: ключ, выведенный из DATABASE_URL, подделал бы любой, кто знает строку
+# подключения. Без SESSION_SECRET токены не выпускаются и не принимаются
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '').encode()
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '43200'))
+SESSION_REVOCATION_CHECK = float(os.environ.get('SESSION_REVOCATION_CHECK', '30'))
+# Доверие к присланному клиентом user_id/admin_id — только на время перехода клиентов на токены,
+# после него функции запускаются с AUTH_ALLOW_LEGACY=0
+AUTH_ALLOW_LEGACY = os.environ.get('AUTH_ALLOW_LEGACY', '1') == '1'
+
+if not SESSION_SECRET:
+    log_event(event='config_error', error='SESSION_SECRET не задан: сессионные токены отключены')
+
+
+class InvalidSession(Exception):
+    pass
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def session_signature(payload: str) -> str:
+    if not SESSION_SECRET:
+        raise InvalidSession()
+    return b64url(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+class Revocations:
+    """Отозванные сессии: user_id -> момент отзыва в мс, все токены выпущенные раньше недействительны.
+    
+    Список перечитывается не чаще раза в SESSION_REVOCATION_CHECK секунд, проверка токена в базу не ходит.
+    """
+
+    def __init__(self):
+        self.revoked = {}
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def reload(self):
+        with self.lock:
+            if self.checked_at is not None and time.monotonic() - self.checked_at < SESSION_REVOCATION_CHECK:
+                return
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT user_id, revoked_before FROM session_revocations WHERE revoked_before > %s",
+                (int(time.time() * 1000) - SESSION_TTL * 1000,)
+            )
+            self.revoked = dict(cur.fetchall())
+            cur.close()
+            conn.close()
+            self.checked_at = time.monotonic()
+
+    def is_revoked(self, session: dict) -> bool:
+        if self.checked_at is None or time.monotonic() - self.checked_at >= SESSION_REVOCATION_CHECK:
+            self.reload()
+        return session['iat'] < self.revoked.get(session['uid'], 0)
+
+
+revocations = Revocations()
+
+def read_session(event: dict):
+    """Сессия из заголовка X-Session-Token: {'uid', 'name', 'adm', 'iat', 'exp'} или None без токена"""
+    token = get_header(event, 'X-Session-Token')
+    if not token:
+        return None
+    # Настоящий токен — base64url, всегда ASCII; compare_digest на str с другими символами бросает TypeError
+    if not token.isascii():
+        raise InvalidSession()
+    payload, _, signature = token.partition('.')
+    if not signature or not hmac.compare_digest(signature, session_signature(payload)):
+        raise InvalidSession()
+    try:
+        session = json.loads(b64url_decode(payload))
+    except ValueError:
+        raise InvalidSession()
+    if session['exp'] < time.time() * 1000 or revocations.is_revoked(session):
+        raise InvalidSession()
+    return session
+
+def session_user_id(session, claimed):
+    """id из токена; без токена — присланный клиентом, пока разрешен AUTH_ALLOW_LEGACY"""
+    if session:
+        return session['uid']
+    if not AUTH_ALLOW_LEGACY:
+        raise InvalidSession()
+    return claimed
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_PENDING_TTL = 60
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024'))
+IDEMPOTENCY_SWEEP_INTERVAL = float(os.environ.get('IDEMPOTENCY_SWEEP_INTERVAL', '600'))
+IDEMPOTENCY_SWEEP_BATCH = 5000
+REPLAY_HEADERS = dict(JSON_HEADERS, **{'Idempotency-Replayed': 'true', 'Access-Control-Expose-Headers': 'Idempotency-Replayed'})
+
+# Резерв ключа на время выполнения запроса; просроченную запись можно занять заново
+IDEMPOTENCY_RESERVE = """
+    INSERT INTO idempotency_keys AS k (key, fingerprint, expires_at)
+    VALUES (%s, %s, LOCALTIMESTAMP + make_interval(secs => %s))
+    ON CONFLICT (key) DO UPDATE SET
+        fingerprint = EXCLUDED.fingerprint, status = NULL, body = NULL, expires_at = EXCLUDED.expires_at
+    WHERE k.expires_at <= LOCALTIMESTAMP
+    RETURNING key
+"""
+
+IDEMPOTENCY_SWEEP = """
+    DELETE FROM idempotency_keys
+    WHERE key IN (
+        SELECT key FROM idempotency_keys
+        WHERE expires_at <= LOCALTIMESTAMP
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+class IdempotencyStore:
+    """Повтор POST с тем же Idempotency-Key получает первый ответ, маршрут второй раз не выполняется.
+    
+    Ответы живут IDEMPOTENCY_TTL в idempotency_keys, перед таблицей — LRU на инстанс: повтор
+    на тот же инстанс не ходит в базу, на другой — одно чтение по ключу. 5xx и 429 не сохраняются,
+    такой запрос можно повторить; просроченные ключи удаляются пачками.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.cache = OrderedDict()
+        self.counters = {'hits': 0, 'db_hits': 0, 'stored': 0, 'conflicts': 0, 'swept': 0}
+        self.swept_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _remember(self, key: bytes, entry: tuple):
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def _cached(self, key: bytes):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry
+
+    def _replay(self, entry: tuple, fingerprint: bytes) -> dict:
+        if entry[1] != fingerprint:
+            return error(422, 'Idempotency-Key уже использован для другого запроса')
+        return {'statusCode': entry[2], 'headers': REPLAY_HEADERS, 'body': entry[3], 'isBase64Encoded': False}
+
+    def middleware(self, route: str, event: dict, body: dict, call):
+        key = get_header(event, 'Idempotency-Key')
+        if event.get('httpMethod') != 'POST' or not key:
+            return call()
+        if len(key) > 255:
+            raise HttpError(400, 'Idempotency-Key длиннее 255 символов')
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
+        session = read_session(event)
+        owner = session['uid'] if session else body.get('user_id') or body.get('admin_id')
+        key = hashlib.sha256(f'{route}\0{owner}\0{key}'.encode()).digest()[:16]
+        fingerprint = hashlib.sha256((event.get('body') or '').encode()).digest()[:16]
+        
+        entry = self._cached(key)
+        if entry is not None:
+            self.counters['hits'] += 1
+            return self._replay(entry, fingerprint)
         
-    except Exception as e:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT fingerprint, status, body, EXTRACT(EPOCH FROM expires_at - LOCALTIMESTAMP) FROM idempotency_keys "
+            "WHERE key = %s AND expires_at > LOCALTIMESTAMP",
+            (key,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(IDEMPOTENCY_RESERVE, (key, fingerprint, IDEMPOTENCY_PENDING_TTL))
+            row = None if cur.fetchone() else (fingerprint, None)
+            conn.commit()
+        cur.close()
+        conn.close()
+        if row is not None:
+            if row[1] is None:
+                self.counters['conflicts'] += 1
+                return error(409, 'Запрос с этим Idempotency-Key еще выполняется')
+            entry = (time.monotonic() + float(row[3]), bytes(row[0]), row[1], row[2])
+            self._remember(key, entry)
+            self.counters['db_hits'] += 1
+            return self._replay(entry, fingerprint)
+        
+        # Резерв уже закоммичен, поэтому маршрут выполняется без нашего соединения:
+        # иначе каждый запрос с ключом держал бы два соединения пула
+        # Соединения, которые маршрут не вернул (исключение посреди транзакции), освобождаются
+        # до записи результата, иначе при маленьком пуле запись ждала бы саму себя
+        try:
+            response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception:
+            db_pool.release_all()
+            self.release(key)
+            raise
+        db_pool.release_all()
+        
+        conn = get_db()
+        cur = conn.cursor()
+        status = response['statusCode']
+        if status >= 500 or status == 429:
+            cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+        else:
+            cur.execute(
+                "UPDATE idempotency_keys SET status = %s, body = %s, expires_at = LOCALTIMESTAMP + make_interval(secs => %s) "
+                "WHERE key = %s",
+                (status, response['body'], IDEMPOTENCY_TTL, key)
+            )
+            self._remember(key, (time.monotonic() + IDEMPOTENCY_TTL, fingerprint, status, response['body']))
+            self.counters['stored'] += 1
+        conn.commit()
+        self.maybe_sweep(cur)
+        cur.close()
+        conn.close()
+        return response
+
+    def release(self, key: bytes):
+        """Снимает резерв после сбоя маршрута, чтобы повтор не получал 409; сбой здесь только пишется
+        в журнал и не подменяет исключение маршрута — резерв тогда истечет через IDEMPOTENCY_PENDING_TTL"""
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+            conn.commit()
+            cur.close()
+            conn.close()
+        except Exception as e:
+            log_event(event='idempotency_release_failed', error=f'{type(e).__name__}: {e}'.strip())
+
+    def maybe_sweep(self, cur) -> int:
+        if time.monotonic() - self.swept_at < IDEMPOTENCY_SWEEP_INTERVAL:
+            return 0
+        self.swept_at = time.monotonic()
+        cur.execute(IDEMPOTENCY_SWEEP, (IDEMPOTENCY_SWEEP_BATCH,))
+        swept = cur.rowcount
+        cur.connection.commit()
+        self.counters['swept'] += swept
+        return swept
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE)
+
+router = Router('Content-Type, If-None-Match, X-Session-Token, Idempotency-Key')
+router.errors[InvalidSession] = error(401, 'Требуется вход')
+install_metrics(router)
+router.middleware.append(idempotency.middleware)
+
+def profile_etag(user_id, version: int, catalog_version: int, today: date, online_floor) -> str:
+    """Версия пользователя, справочников и дня (серия и can_claim_daily меняются в полночь).
+    
+    online_floor — наименьший прогресс незакрытых квестов online_users: пока онлайн не выше него,
+    профиль не устарел; x — таких квестов нет.
+    """
+    online = 'x' if online_floor is None else online_floor
+    return f'"profile-{user_id}-{version}-{catalog_version}-{today:%Y%m%d}-{online}"'
+
+def profile_not_modified(cur, etag: str, user_id, today: date) -> bool:
+    execute_prepared(cur, 'profile_version', PROFILE_VERSION_QUERY, 'int', (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return False
+    prefix = profile_etag(user_id, row[0], row[1], today, None)[:-2]
+    if not etag.startswith(prefix) or not etag.endswith('"'):
+        return False
+    online_floor = etag[len(prefix):-1]
+    if online_floor == 'x':
+        return True
+    return online_floor.isdigit() and leaderboards.online_count(cur) <= int(online_floor)
+
+@router.route('GET', 'profile')
+def profile(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), params.get('user_id'))
+    
+    if not user_id:
+        return error(400, 'user_id обязателен')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    today = date.today()
+    
+    etag = get_header(event, 'If-None-Match')
+    if etag and profile_not_modified(cur, etag, user_id, today):
+        cur.close()
+        conn.close()
         return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
+            'statusCode': 304,
+            'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
             'isBase64Encoded': False
         }
+    
+    execute_prepared(cur, 'profile', PROFILE_QUERY, 'int, date', (user_id, today))
+    user = cur.fetchone()
+    
+    if not user:
+        cur.close()
+        conn.close()
+        return error(404, 'Пользователь не найден')
+    
+    catalog.sync(cur, user[5])
+    owned = set(user[6])
+    progress = {q[0]: q[1:] for q in user[7]}
+    pending = {q[0]: int(q[1]) for q in user[8]}
+    
+    # Квест «онлайн одновременно с N игроками» сохраняет сброс присутствия (heartbeat); профиль
+    # только читает и показывает текущий онлайн, если он выше сохраненного прогресса
+    open_online = [
+        q['id'] for q in catalog.quests
+        if q['quest_type'] == 'online_users' and not progress.get(q['id'], (0, 0, 0))[1]
+    ]
+    if open_online:
+        online_now = leaderboards.online_count(cur)
+        for quest_id in open_online:
+            value, completed, claimed = progress.get(quest_id, (0, 0, 0))
+            progress[quest_id] = (max(value, online_now), completed, claimed)
+    
+    cur.close()
+    conn.close()
+    
+    online_floor = min((progress.get(quest_id, (0, 0, 0))[0] for quest_id in open_online), default=None)
+    etag = profile_etag(user[0], user[11], user[5], today, online_floor)
+    
+    titles = [dict(t, owned=t['id'] in owned) for t in catalog.titles]
+    quests = []
+    for q in catalog.quests:
+        value, completed, claimed = progress.get(q['id'], (0, 0, 0))
+        value += pending.get(q['quest_type'], 0)
+        quests.append(dict(
+            q,
+            progress=min(100, value * 100 // q['target_value']) if q['target_value'] > 0 else 0,
+            completed=bool(completed) or (q['target_value'] > 0 and value >= q['target_value']),
+            claimed=bool(claimed)
+        ))
+    
+    return respond(200, {
+        'user': {
+            'id': user[0],
+            'username': user[1],
+            'coins': user[2],
+            'is_admin': user[3],
+            'time_spent_minutes': user[4]
+        },
+        'titles': titles,
+        'quests': quests,
+        'daily_streak': user[9],
+        'can_claim_daily': user[10]
+    }, dict(JSON_HEADERS, ETag=etag, **{'Access-Control-Expose-Headers': 'ETag'}))
+
+@router.route('GET', 'leaderboard')
+def leaderboard(event: dict, params: dict, body: dict) -> dict:
+    board = params.get('board', 'coins')
+    
+    if board not in LEADERBOARD_QUERIES:
+        return error(400, f'Доступные таблицы: {", ".join(LEADERBOARD_QUERIES)}')
+    
+    try:
+        limit = min(max(int(params.get('limit') or 10), 1), LEADERBOARD_SIZE)
+    except ValueError:
+        limit = 10
+    
+    return respond(200, {
+        'board': board,
+        'entries': leaderboards.top(board)[:limit],
+        'online_now': leaderboards.online_count()
+    })
+
+@router.route('GET', 'online')
+def online(event: dict, params: dict, body: dict) -> dict:
+    return respond(200, {'online_now': leaderboards.online_count()})
+
+@router.route('POST', 'heartbeat')
+def heartbeat(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), body.get('user_id'))
+    
+    if not user_id:
+        return error(400, 'user_id обязателен')
+    
+    if not str(user_id).isdigit():
+        return error(400, 'Некорректные параметры запроса')
+    
+    presence.beat(int(user_id))
+    
+    if presence.due():
+        conn = get_db()
+        presence.flush(conn)
+        conn.close()
+    
+    return respond(200, {'online_now': leaderboards.online_count()})
+
+@router.route('POST', 'buy_title')
+def buy_title(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), body.get('user_id'))
+    title_id = body.get('title_id')
+    
+    if not str(title_id).isdigit():
+        return error(400, 'Некорректные параметры запроса')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    title = catalog.ensure(cur).titles_by_id.get(int(title_id))
+    if not title:
+        cur.close()
+        conn.close()
+        return error(404, 'Титул не найден')
+    
+    execute_prepared(cur, 'buy_title', BUY_TITLE_QUERY, 'int, int', (user_id, title['id']))
+    user_exists, inserted, new_coins = cur.fetchone()
+    
+    if not user_exists or not inserted or new_coins is None:
+        conn.rollback()
+        cur.close()
+        conn.close()
+        if not user_exists:
+            return error(404, 'Пользователь не найден')
+        if not inserted:
+            return error(400, 'Титул уже куплен')
+        return error(400, 'Недостаточно ТитулКоинов')
+    
+    quest_engine.emit(cur, user_id, ('buy_title', 1))
+    
+    conn.commit()
+    quest_engine.maybe_flush(conn)
+    cur.close()
+    conn.close()
+    
+    return respond(200, {'message': f'Титул {title["name"]} успешно куплен!', 'new_coins': new_coins})
+
+@router.route('POST', 'sell_title')
+def sell_title(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), body.get('user_id'))
+    title_id = body.get('title_id')
+    
+    if not str(title_id).isdigit():
+        return error(400, 'Некорректные параметры запроса')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    title = catalog.ensure(cur).titles_by_id.get(int(title_id))
+    if not title:
+        cur.close()
+        conn.close()
+        return error(404, 'Титул не найден')
+    
+    if title['name'] == '[NEWBIE]':
+        cur.close()
+        conn.close()
+        return error(400, 'Нельзя продать стартовый титул')
+    
+    execute_prepared(cur, 'sell_title', SELL_TITLE_QUERY, 'int, int', (user_id, title['id']))
+    sold = cur.fetchone()
+    
+    if not sold:
+        conn.rollback()
+        cur.close()
+        conn.close()
+        return error(400, 'Титул не куплен')
+    
+    new_coins, sell_price = sold
+    quest_engine.emit(cur, user_id, ('sell_title', 1), ('coins_changed', new_coins))
+    
+    conn.commit()
+    quest_engine.maybe_flush(conn)
+    cur.close()
+    conn.close()
+    
+    return respond(200, {'message': f'Титул {title["name"]} продан за {sell_price} ТитулКоинов!', 'new_coins': new_coins})
+
+@router.route('POST', 'claim_quests')
+def claim_quests(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), body.get('user_id'))
+    
+    if not user_id:
+        return error(400, 'user_id обязателен')
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    quest_engine.fold_user(cur, user_id)
+    execute_prepared(cur, 'claim_quests', CLAIM_QUESTS_QUERY, 'int', (user_id,))
+    exists, new_coins, rows = cur.fetchone()
+    
+    if not exists:
+        cur.close()
+        conn.close()
+        return error(404, 'Пользователь не найден')
+    
+    claimed = [{'id': int(r[0]), 'title': r[1], 'reward': int(r[2])} for r in rows]
+    total = sum(q['reward'] for q in claimed)
+    
+    if claimed:
+        quest_engine.emit(cur, user_id, ('coins_changed', new_coins))
+    
+    conn.commit()
+    quest_engine.maybe_flush(conn)
+    cur.close()
+    conn.close()
+    
+    return respond(200, {
+        'message': f'Получено {total} ТитулКоинов за квесты: {len(claimed)}' if claimed else 'Нет выполненных квестов для получения награды',
+        'claimed': claimed,
+        'total_reward': total,
+        'new_coins': new_coins
+    })
+
+@router.route('POST', 'claim_daily')
+def claim_daily(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), body.get('user_id'))
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    execute_prepared(cur, 'claim_daily', CLAIM_DAILY_QUERY, 'int, date, boolean', (user_id, date.today(), DAILY_LOGIN_HISTORY))
+    claimed = cur.fetchone()
+    
+    if not claimed:
+        cur.execute("SELECT 1 FROM users WHERE id = %s", (user_id,))
+        exists = cur.fetchone()
+        cur.close()
+        conn.close()
+        if not exists:
+            return error(404, 'Пользователь не найден')
+        return error(400, 'Награда уже получена сегодня')
+    
+    current_streak = claimed[0]
+    reward = catalog.ensure(cur).daily_rewards.get(current_streak, {'coins': 0, 'title': None})
+    
+    if reward['title']:
+        cur.execute(
+            "INSERT INTO user_titles (user_id, title_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (user_id, reward['title']['id'])
+        )
+    
+    cur.execute(
+        "UPDATE users SET coins = coins + %s, version = version + 1 WHERE id = %s RETURNING coins",
+        (reward['coins'], user_id)
+    )
+    new_coins = cur.fetchone()[0]
+    
+    quest_engine.emit(cur, user_id, ('daily_streak', current_streak), ('coins_changed', new_coins))
+    
+    conn.commit()
+    quest_engine.maybe_flush(conn)
+    cur.close()
+    conn.close()
+    
+    message = f'День {current_streak}! '
+    if reward['coins'] > 0:
+        message += f'Получено {reward["coins"]} ТитулКоинов!'
+    if reward['title']:
+        message += f' Получен титул {reward["title"]["name"]}!'
+    
+    return respond(200, {
+        'message': message,
+        'day_streak': current_streak,
+        'coins_reward': reward['coins'],
+        'title_reward': reward['title']['name'] if reward['title'] else None,
+        'new_coins': new_coins
+    })
+
+def handler(event: dict, context) -> dict:
+    try:
+        return router.dispatch(event)
+    finally:
+        db_pool.release_all()
@@ -3,167 +3,775 @@ API для регистрации, входа и управления польз
 """
 import json
 import os
+import bisect
+import functools
+import base64
 import hashlib
+import hmac
+import secrets
+import threading
+import time
+import traceback
 import psycopg2
+import psycopg2.extensions
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает сессию"""
+    pool = None
+    released_at = 0.0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.putconn(self)
+        else:
+            super().close()
+
+    def discard(self):
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Пул соединений уровня модуля, переживает теплые вызовы функции"""
+
+    def __init__(self, maxconn: int, timeout: float):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0, 'broken': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _checked_out(self) -> list:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.released_at < DB_POOL_PING_AFTER:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self.counters['hits'] += 1
+                    break
+                if self._size < self.maxconn:
+                    conn = None
+                    self._size += 1
+                    self.counters['misses'] += 1
+                    break
+                if not waited:
+                    waited = True
+                    self.counters['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout('Нет свободных соединений с базой')
+        
+        if conn is not None and not self._is_healthy(conn):
+            self.counters['broken'] += 1
+            conn.discard()
+            conn = None
+        
+        if conn is None:
+            try:
+                conn = psycopg2.connect(
+                    os.environ['DATABASE_URL'],
+                    connection_factory=PooledConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        
+        conn.pool = self
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn):
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.discard()
+        
+        with self._cond:
+            if conn.closed:
+                self.counters['broken'] += 1
+                self._size -= 1
+            else:
+                conn.released_at = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def release_all(self):
+        for conn in list(self._checked_out()):
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counters, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
 def get_db():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    return db_pool.getconn()
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+# Сколько секунд браузер может не повторять preflight для тех же метода и заголовков
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
+def dumps(data) -> str:
+    """orjson, если установлен в окружении функции, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def respond(status: int, data, headers: dict = JSON_HEADERS) -> dict:
+    return {'statusCode': status, 'headers': headers, 'body': dumps(data), 'isBase64Encoded': False}
+
+@functools.lru_cache(maxsize=256)
+def error(status: int, message: str) -> dict:
+    """Ответ с ошибкой сериализуется один раз на пару (статус, текст) и дальше отдается готовым"""
+    return respond(status, {'error': message})
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.response = error(status, message)
+
+
+class Router:
+    """Таблица маршрутов (метод, action) -> route(event, params, body).
     
-    if method == 'OPTIONS':
-        return {
+    action берется из query string, у POST — из JSON тела; без точного совпадения
+    используется маршрут метода без action. Исключения из errors превращаются в готовые
+    ответы, hooks вызываются после каждого запроса с (маршрут, секунды, статус),
+    middleware оборачивают вызов маршрута: middleware(маршрут, event, body, call).
+    """
+
+    def __init__(self, allow_headers: str):
+        self.routes = {}
+        self.errors = {
+            PoolTimeout: error(503, 'Нет свободных соединений с базой'),
+            psycopg2.OperationalError: error(503, 'База данных недоступна'),
+            psycopg2.DataError: error(400, 'Некорректные параметры запроса')
+        }
+        self.hooks = []
+        self.middleware = []
+        self.preflight = {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': allow_headers,
+                'Access-Control-Max-Age': CORS_MAX_AGE
             },
             'body': '',
             'isBase64Encoded': False
         }
+
+    def route(self, method: str, action: str = None):
+        def register(fn):
+            self.routes[(method, action)] = fn
+            return fn
+        return register
+
+    def dispatch(self, event: dict) -> dict:
+        method = event.get('httpMethod', 'GET')
+        if method == 'OPTIONS':
+            return self.preflight
+        
+        started = time.perf_counter()
+        name = method
+        try:
+            params = event.get('queryStringParameters') or {}
+            body = {}
+            if method == 'POST':
+                try:
+                    body = json.loads(event.get('body') or '{}')
+                except ValueError:
+                    raise HttpError(400, 'Некорректный JSON')
+                if not isinstance(body, dict):
+                    raise HttpError(400, 'Некорректный JSON')
+            action = body.get('action') if method == 'POST' else params.get('action')
+            fn = self.routes.get((method, action)) or self.routes.get((method, None))
+            if fn is None:
+                response = error(405, 'Метод не поддерживается')
+            else:
+                name = fn.__name__
+                call = functools.partial(fn, event, params, body)
+                for middleware in self.middleware:
+                    call = functools.partial(middleware, name, event, body, call)
+                response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception as e:
+            response = self.handle_error(name, e)
+        
+        for hook in self.hooks:
+            hook(name, time.perf_counter() - started, response['statusCode'])
+        return response
+
+    def handle_error(self, route: str, exc: Exception) -> dict:
+        """Ответ из errors по ближайшему классу исключения, иначе 500; сбои сервера пишутся в журнал"""
+        response = next((self.errors[cls] for cls in type(exc).__mro__ if cls in self.errors), None)
+        if response is None:
+            response = respond(500, {'error': str(exc)})
+        if response['statusCode'] >= 500:
+            log_event(
+                event='error', route=route, status=response['statusCode'],
+                error=f'{type(exc).__name__}: {exc}'.strip(), traceback=traceback.format_exc(limit=8)
+            )
+        return response
+
+
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '60'))
+METRICS_LOG_REQUESTS = os.environ.get('METRICS_LOG_REQUESTS') == '1'
+METRICS_KEY = os.environ.get('METRICS_KEY')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def log_event(**fields):
+    """Одна JSON-строка в stdout — журнал функции"""
+    print(dumps(fields), flush=True)
+
+
+class Metrics:
+    """Метрики инстанса: гистограмма длительности по маршрутам, число SQL и время в базе на запрос.
     
-    try:
-        if method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'register':
-                username = body.get('username', '').strip()
-                password = body.get('password', '')
-                
-                if not username or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Имя и пароль обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                if len(username) < 3:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Имя должно быть минимум 3 символа'}),
-                        'isBase64Encoded': False
-                    }
-                
-                conn = get_db()
-                cur = conn.cursor()
-                
-                cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-                if cur.fetchone():
-                    cur.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Пользователь уже существует'}),
-                        'isBase64Encoded': False
-                    }
-                
-                password_hash = hash_password(password)
-                cur.execute(
-                    "INSERT INTO users (username, password_hash, coins, last_login) VALUES (%s, %s, 50, %s) RETURNING id, username, coins, is_admin",
-                    (username, password_hash, datetime.now())
-                )
-                user = cur.fetchone()
-                
-                cur.execute("SELECT id FROM titles WHERE name = '[NEWBIE]'")
-                newbie_title = cur.fetchone()
-                if newbie_title:
-                    cur.execute("INSERT INTO user_titles (user_id, title_id) VALUES (%s, %s)", (user[0], newbie_title[0]))
-                
-                cur.execute(
-                    "INSERT INTO user_quests (user_id, quest_id, progress, completed) SELECT %s, id, 1, TRUE FROM quests WHERE quest_type = 'login' LIMIT 1",
-                    (user[0],)
-                )
-                
-                conn.commit()
-                cur.close()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'user': {
-                            'id': user[0],
-                            'username': user[1],
-                            'coins': user[2],
-                            'is_admin': user[3]
-                        }
-                    }),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'login':
-                username = body.get('username', '').strip()
-                password = body.get('password', '')
-                
-                if not username or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Имя и пароль обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                conn = get_db()
-                cur = conn.cursor()
-                
-                password_hash = hash_password(password)
-                cur.execute(
-                    "SELECT id, username, coins, is_admin FROM users WHERE username = %s AND password_hash = %s",
-                    (username, password_hash)
-                )
-                user = cur.fetchone()
-                
-                if not user:
-                    cur.close()
-                    conn.close()
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Неверное имя или пароль'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute("UPDATE users SET last_login = %s WHERE id = %s", (datetime.now(), user[0]))
-                conn.commit()
-                cur.close()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'user': {
-                            'id': user[0],
-                            'username': user[1],
-                            'coins': user[2],
-                            'is_admin': user[3]
-                        }
-                    }),
-                    'isBase64Encoded': False
+    Счетчики запроса лежат в thread-local и сбрасываются в begin(); сводка пишется в журнал
+    раз в METRICS_LOG_INTERVAL секунд и отдается маршрутом GET ?action=metrics.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logged_at = time.monotonic()
+
+    def begin(self):
+        self.local.queries = 0
+        self.local.db_ms = 0.0
+        self.local.slow = []
+
+    def record_query(self, query, elapsed_ms: float):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        local.queries += 1
+        local.db_ms += elapsed_ms
+        if elapsed_ms >= SLOW_QUERY_MS:
+            local.slow.append((round(elapsed_ms, 1), ' '.join(str(query).split())[:300]))
+
+    def observe(self, route: str, seconds: float, status: int):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        elapsed_ms = seconds * 1000
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'queries': 0, 'db_ms': 0.0, 'slow_queries': 0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)
                 }
+            stats['count'] += 1
+            stats['errors'] += status >= 500
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['queries'] += local.queries
+            stats['db_ms'] += local.db_ms
+            stats['slow_queries'] += len(local.slow)
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            due = METRICS_LOG_INTERVAL > 0 and time.monotonic() - self.logged_at >= METRICS_LOG_INTERVAL
+            if due:
+                self.logged_at = time.monotonic()
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
-        
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        for slow_ms, query in local.slow:
+            log_event(event='slow_query', route=route, ms=slow_ms, query=query)
+        if METRICS_LOG_REQUESTS:
+            log_event(
+                event='request', route=route, status=status, ms=round(elapsed_ms, 2),
+                queries=local.queries, db_ms=round(local.db_ms, 2)
+            )
+        if due:
+            log_event(event='metrics', routes=self.snapshot(), pool=db_pool.stats())
+        self.begin()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            routes = {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in self.routes.items()}
+        result = {}
+        for name, stats in routes.items():
+            count = stats['count']
+            result[name] = {
+                'count': count,
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total_ms'] / count, 2),
+                'p50_ms': self.percentile(stats, 0.50),
+                'p95_ms': self.percentile(stats, 0.95),
+                'p99_ms': self.percentile(stats, 0.99),
+                'max_ms': round(stats['max_ms'], 2),
+                'queries_per_request': round(stats['queries'] / count, 2),
+                'db_ms_per_request': round(stats['db_ms'] / count, 2),
+                'slow_queries': stats['slow_queries']
+            }
+        return result
+
+    @staticmethod
+    def percentile(stats: dict, pct: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль, но не больше максимума"""
+        needed = pct * stats['count']
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS_MS, stats['buckets']):
+            seen += hits
+            if seen >= needed:
+                return min(bound, round(stats['max_ms'], 2))
+        return round(stats['max_ms'], 2)
+
+
+metrics = Metrics()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Курсор соединений пула: считает запросы и время в базе для текущего запроса"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+def install_metrics(router):
+    router.hooks.append(metrics.observe)
+    
+    @router.route('GET', 'metrics')
+    def metrics_dump(event: dict, params: dict, body: dict) -> dict:
+        key = get_header(event, 'X-Metrics-Key') or ''
+        if not METRICS_KEY or not hmac.compare_digest(key.encode('utf-8', 'surrogatepass'), METRICS_KEY.encode()):
+            return error(404, 'Не найдено')
+        return respond(200, {'routes': metrics.snapshot(), 'pool': db_pool.stats()})
+
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', '16384'))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+KDF_WORKERS = int(os.environ.get('KDF_WORKERS', str(os.cpu_count() or 2)))
+KDF_QUEUE_MAX = int(os.environ.get('KDF_QUEUE_MAX', '64'))
+KDF_TIMEOUT = float(os.environ.get('KDF_TIMEOUT', '10'))
+
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', '5'))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', '30'))
+LOGIN_FAILURE_WINDOW = float(os.environ.get('LOGIN_FAILURE_WINDOW', '300'))
+LOGIN_THROTTLE_SIZE = 10000
+
+
+def scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+
+def hash_password(password: str) -> str:
+    """Формат: scrypt$n$r$p$соль$ключ, параметры хранятся в хеше и могут меняться без миграции"""
+    salt = secrets.token_bytes(16)
+    key = scrypt(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return '$'.join([
+        'scrypt', str(PASSWORD_SCRYPT_N), str(PASSWORD_SCRYPT_R), str(PASSWORD_SCRYPT_P),
+        base64.b64encode(salt).decode(), base64.b64encode(key).decode()
+    ])
+
+def verify_password(password: str, stored: str) -> tuple:
+    """Возвращает (пароль верен, хеш пора пересчитать с текущими параметрами)"""
+    if stored.startswith('scrypt$'):
+        _, n, r, p, salt, key = stored.split('$')
+        params = (int(n), int(r), int(p))
+        ok = hmac.compare_digest(scrypt(password, base64.b64decode(salt), *params), base64.b64decode(key))
+        return ok, ok and params != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    # Старый несоленый SHA-256: при успешном входе заменяется на scrypt
+    ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    return ok, ok
+
+
+class KdfBusy(Exception):
+    pass
+
+
+class KdfPool:
+    """Ограниченный пул потоков для KDF: hashlib.scrypt отпускает GIL, поэтому одновременно
+    считается не больше KDF_WORKERS хешей, а при переполненной очереди вход сразу получает 503.
+    """
+
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kdf')
+        self.queued = 0
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        with self.lock:
+            if self.queued >= KDF_QUEUE_MAX:
+                raise KdfBusy()
+            self.queued += 1
+        try:
+            return self.executor.submit(fn, *args).result(timeout=KDF_TIMEOUT)
+        except FutureTimeout:
+            raise KdfBusy()
+        finally:
+            with self.lock:
+                self.queued -= 1
+
+
+kdf_pool = KdfPool(KDF_WORKERS)
+
+
+class LoginThrottle:
+    """Неудачные попытки входа в памяти инстанса по имени и по IP, скользящее окно LOGIN_FAILURE_WINDOW.
+    
+    Проверка идет до хеширования, так что перебор пароля не тратит CPU на KDF.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def retry_after(self, key, limit: int) -> int:
+        with self.lock:
+            attempts = self.failures.get(key)
+            if not attempts:
+                return 0
+            now = time.monotonic()
+            while attempts and now - attempts[0] > LOGIN_FAILURE_WINDOW:
+                attempts.pop(0)
+            if len(attempts) < limit:
+                return 0
+            return int(LOGIN_FAILURE_WINDOW - (now - attempts[0])) + 1
+
+    def fail(self, key):
+        with self.lock:
+            self.failures.setdefault(key, []).append(time.monotonic())
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.size:
+                self.failures.popitem(last=False)
+
+    def reset(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+
+
+login_throttle = LoginThrottle(LOGIN_THROTTLE_SIZE)
+
+def get_header(event: dict, name: str):
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+# Только явный секрет: ключ, выведенный из DATABASE_URL, подделал бы любой, кто знает строку
+# подключения. Без SESSION_SECRET токены не выпускаются и не принимаются
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '').encode()
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '43200'))
+SESSION_REVOCATION_CHECK = float(os.environ.get('SESSION_REVOCATION_CHECK', '30'))
+# Доверие к присланному клиентом user_id/admin_id — только на время перехода клиентов на токены,
+# после него функции запускаются с AUTH_ALLOW_LEGACY=0
+AUTH_ALLOW_LEGACY = os.environ.get('AUTH_ALLOW_LEGACY', '1') == '1'
+
+if not SESSION_SECRET:
+    log_event(event='config_error', error='SESSION_SECRET не задан: сессионные токены отключены')
+
+
+class InvalidSession(Exception):
+    pass
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def session_signature(payload: str) -> str:
+    if not SESSION_SECRET:
+        raise InvalidSession()
+    return b64url(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+
+def sign_session(user_id: int, username: str, is_admin: bool) -> str:
+    if not SESSION_SECRET:
+        raise HttpError(503, 'Вход временно недоступен')
+    now = int(time.time() * 1000)
+    payload = b64url(json.dumps({
+        'uid': user_id,
+        'name': username,
+        'adm': bool(is_admin),
+        'iat': now,
+        'exp': now + SESSION_TTL * 1000
+    }, separators=(',', ':')).encode())
+    return f'{payload}.{session_signature(payload)}'
+
+
+class Revocations:
+    """Отозванные сессии: user_id -> момент отзыва в мс, все токены выпущенные раньше недействительны.
+    
+    Список перечитывается не чаще раза в SESSION_REVOCATION_CHECK секунд, проверка токена в базу не ходит.
+    """
+
+    def __init__(self):
+        self.revoked = {}
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def reload(self):
+        with self.lock:
+            if self.checked_at is not None and time.monotonic() - self.checked_at < SESSION_REVOCATION_CHECK:
+                return
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT user_id, revoked_before FROM session_revocations WHERE revoked_before > %s",
+                (int(time.time() * 1000) - SESSION_TTL * 1000,)
+            )
+            self.revoked = dict(cur.fetchall())
+            cur.close()
+            conn.close()
+            self.checked_at = time.monotonic()
+
+    def is_revoked(self, session: dict) -> bool:
+        if self.checked_at is None or time.monotonic() - self.checked_at >= SESSION_REVOCATION_CHECK:
+            self.reload()
+        return session['iat'] < self.revoked.get(session['uid'], 0)
+
+
+revocations = Revocations()
+
+def read_session(event: dict):
+    """Сессия из заголовка X-Session-Token: {'uid', 'name', 'adm', 'iat', 'exp'} или None без токена"""
+    token = get_header(event, 'X-Session-Token')
+    if not token:
+        return None
+    # Настоящий токен — base64url, всегда ASCII; compare_digest на str с другими символами бросает TypeError
+    if not token.isascii():
+        raise InvalidSession()
+    payload, _, signature = token.partition('.')
+    if not signature or not hmac.compare_digest(signature, session_signature(payload)):
+        raise InvalidSession()
+    try:
+        session = json.loads(b64url_decode(payload))
+    except ValueError:
+        raise InvalidSession()
+    if session['exp'] < time.time() * 1000 or revocations.is_revoked(session):
+        raise InvalidSession()
+    return session
+
+def session_user_id(session, claimed):
+    """id из токена; без токена — присланный клиентом, пока разрешен AUTH_ALLOW_LEGACY"""
+    if session:
+        return session['uid']
+    if not AUTH_ALLOW_LEGACY:
+        raise InvalidSession()
+    return claimed
+
+router = Router('Content-Type, X-Session-Token')
+router.errors[InvalidSession] = error(401, 'Требуется вход')
+router.errors[KdfBusy] = respond(503, {'error': 'Сервер перегружен, попробуйте позже'}, dict(JSON_HEADERS, **{'Retry-After': '1'}))
+install_metrics(router)
+
+@router.route('POST', 'register')
+def register(event: dict, params: dict, body: dict) -> dict:
+    username = body.get('username', '').strip()
+    password = body.get('password', '')
+    
+    if not username or not password:
+        return error(400, 'Имя и пароль обязательны')
+    
+    if len(username) < 3:
+        return error(400, 'Имя должно быть минимум 3 символа')
+    
+    password_hash = kdf_pool.run(hash_password, password)
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    cur.execute("SELECT id FROM users WHERE username = %s", (username,))
+    if cur.fetchone():
+        cur.close()
+        conn.close()
+        return error(400, 'Пользователь уже существует')
+    
+    cur.execute(
+        "INSERT INTO users (username, password_hash, coins, last_login) VALUES (%s, %s, 50, %s) RETURNING id, username, coins, is_admin",
+        (username, password_hash, datetime.now())
+    )
+    user = cur.fetchone()
+    
+    cur.execute("SELECT id FROM titles WHERE name = '[NEWBIE]'")
+    newbie_title = cur.fetchone()
+    if newbie_title:
+        cur.execute("INSERT INTO user_titles (user_id, title_id) VALUES (%s, %s)", (user[0], newbie_title[0]))
+    
+    cur.execute(
+        "INSERT INTO user_quests (user_id, quest_id, progress, completed) SELECT %s, id, 1, TRUE FROM quests WHERE quest_type = 'login' LIMIT 1",
+        (user[0],)
+    )
+    
+    conn.commit()
+    cur.close()
+    conn.close()
+    
+    return respond(200, {
+        'user': {
+            'id': user[0],
+            'username': user[1],
+            'coins': user[2],
+            'is_admin': user[3]
+        },
+        'token': sign_session(user[0], user[1], user[3])
+    })
+
+@router.route('POST', 'login')
+def login(event: dict, params: dict, body: dict) -> dict:
+    username = body.get('username', '').strip()
+    password = body.get('password', '')
+    
+    if not username or not password:
+        return error(400, 'Имя и пароль обязательны')
+    
+    user_key = ('user', username.lower())
+    ip_key = ('ip', (event.get('requestContext') or {}).get('identity', {}).get('sourceIp'))
+    retry_after = max(
+        login_throttle.retry_after(user_key, LOGIN_MAX_FAILURES),
+        login_throttle.retry_after(ip_key, LOGIN_MAX_FAILURES_PER_IP) if ip_key[1] else 0
+    )
+    if retry_after:
+        return respond(
+            429,
+            {'error': f'Слишком много попыток входа, попробуйте через {retry_after} с'},
+            dict(JSON_HEADERS, **{'Retry-After': str(retry_after)})
+        )
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    cur.execute(
+        "SELECT id, username, coins, is_admin, password_hash FROM users WHERE username = %s",
+        (username,)
+    )
+    user = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    if user:
+        valid, rehash = kdf_pool.run(verify_password, password, user[4])
+    else:
+        # Несуществующее имя стоит столько же, сколько неверный пароль
+        kdf_pool.run(hash_password, password)
+        valid, rehash = False, False
+    
+    if not valid:
+        login_throttle.fail(user_key)
+        if ip_key[1]:
+            login_throttle.fail(ip_key)
+        return error(401, 'Неверное имя или пароль')
+    
+    login_throttle.reset(user_key)
+    new_hash = kdf_pool.run(hash_password, password) if rehash else None
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    if new_hash:
+        cur.execute(
+            "UPDATE users SET last_login = %s, password_hash = %s WHERE id = %s",
+            (datetime.now(), new_hash, user[0])
+        )
+    else:
+        cur.execute("UPDATE users SET last_login = %s WHERE id = %s", (datetime.now(), user[0]))
+    conn.commit()
+    cur.close()
+    conn.close()
+    
+    return respond(200, {
+        'user': {
+            'id': user[0],
+            'username': user[1],
+            'coins': user[2],
+            'is_admin': user[3]
+        },
+        'token': sign_session(user[0], user[1], user[3])
+    })
+
+@router.route('POST', 'logout')
+def logout(event: dict, params: dict, body: dict) -> dict:
+    session = read_session(event)
+    if not session:
+        raise InvalidSession()
+    
+    revoked_before = int(time.time() * 1000)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO session_revocations (user_id, revoked_before) VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET revoked_before = EXCLUDED.revoked_before
+    """, (session['uid'], revoked_before))
+    conn.commit()
+    cur.close()
+    conn.close()
+    revocations.revoked[session['uid']] = revoked_before
+    
+    return respond(200, {'message': 'Все сессии завершены'})
+
+def handler(event: dict, context) -> dict:
+    try:
+        return router.dispatch(event)
+    finally:
+        db_pool.release_all()
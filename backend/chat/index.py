@@ -3,128 +3,1477 @@ API для чата в реальном времени
 """
 import json
 import os
+import bisect
+import functools
+import base64
+import hashlib
+import hmac
+import select
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
 import psycopg2
-from datetime import datetime
+import psycopg2.extensions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает сессию"""
+    pool = None
+    released_at = 0.0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.putconn(self)
+        else:
+            super().close()
+
+    def discard(self):
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Пул соединений уровня модуля, переживает теплые вызовы функции"""
+
+    def __init__(self, maxconn: int, timeout: float):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0, 'broken': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _checked_out(self) -> list:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.released_at < DB_POOL_PING_AFTER:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self.counters['hits'] += 1
+                    break
+                if self._size < self.maxconn:
+                    conn = None
+                    self._size += 1
+                    self.counters['misses'] += 1
+                    break
+                if not waited:
+                    waited = True
+                    self.counters['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout('Нет свободных соединений с базой')
+        
+        if conn is not None and not self._is_healthy(conn):
+            self.counters['broken'] += 1
+            conn.discard()
+            conn = None
+        
+        if conn is None:
+            try:
+                conn = psycopg2.connect(
+                    os.environ['DATABASE_URL'],
+                    connection_factory=PooledConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        
+        conn.pool = self
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn):
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.discard()
+        
+        with self._cond:
+            if conn.closed:
+                self.counters['broken'] += 1
+                self._size -= 1
+            else:
+                conn.released_at = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def release_all(self):
+        for conn in list(self._checked_out()):
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counters, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
 
 def get_db():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    return db_pool.getconn()
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+# Сколько секунд браузер может не повторять preflight для тех же метода и заголовков
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+
+def dumps(data) -> str:
+    """orjson, если установлен в окружении функции, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def respond(status: int, data, headers: dict = JSON_HEADERS) -> dict:
+    return {'statusCode': status, 'headers': headers, 'body': dumps(data), 'isBase64Encoded': False}
+
+@functools.lru_cache(maxsize=256)
+def error(status: int, message: str) -> dict:
+    """Ответ с ошибкой сериализуется один раз на пару (статус, текст) и дальше отдается готовым"""
+    return respond(status, {'error': message})
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.response = error(status, message)
+
+
+class Router:
+    """Таблица маршрутов (метод, action) -> route(event, params, body).
     
-    if method == 'OPTIONS':
-        return {
+    action берется из query string, у POST — из JSON тела; без точного совпадения
+    используется маршрут метода без action. Исключения из errors превращаются в готовые
+    ответы, hooks вызываются после каждого запроса с (маршрут, секунды, статус),
+    middleware оборачивают вызов маршрута: middleware(маршрут, event, body, call).
+    """
+
+    def __init__(self, allow_headers: str):
+        self.routes = {}
+        self.errors = {
+            PoolTimeout: error(503, 'Нет свободных соединений с базой'),
+            psycopg2.OperationalError: error(503, 'База данных недоступна'),
+            psycopg2.DataError: error(400, 'Некорректные параметры запроса')
+        }
+        self.hooks = []
+        self.middleware = []
+        self.preflight = {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': allow_headers,
+                'Access-Control-Max-Age': CORS_MAX_AGE
             },
             'body': '',
             'isBase64Encoded': False
         }
+
+    def route(self, method: str, action: str = None):
+        def register(fn):
+            self.routes[(method, action)] = fn
+            return fn
+        return register
+
+    def dispatch(self, event: dict) -> dict:
+        method = event.get('httpMethod', 'GET')
+        if method == 'OPTIONS':
+            return self.preflight
+        
+        started = time.perf_counter()
+        name = method
+        try:
+            params = event.get('queryStringParameters') or {}
+            body = {}
+            if method == 'POST':
+                try:
+                    body = json.loads(event.get('body') or '{}')
+                except ValueError:
+                    raise HttpError(400, 'Некорректный JSON')
+                if not isinstance(body, dict):
+                    raise HttpError(400, 'Некорректный JSON')
+            action = body.get('action') if method == 'POST' else params.get('action')
+            fn = self.routes.get((method, action)) or self.routes.get((method, None))
+            if fn is None:
+                response = error(405, 'Метод не поддерживается')
+            else:
+                name = fn.__name__
+                call = functools.partial(fn, event, params, body)
+                for middleware in self.middleware:
+                    call = functools.partial(middleware, name, event, body, call)
+                response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception as e:
+            response = self.handle_error(name, e)
+        
+        for hook in self.hooks:
+            hook(name, time.perf_counter() - started, response['statusCode'])
+        return response
+
+    def handle_error(self, route: str, exc: Exception) -> dict:
+        """Ответ из errors по ближайшему классу исключения, иначе 500; сбои сервера пишутся в журнал"""
+        response = next((self.errors[cls] for cls in type(exc).__mro__ if cls in self.errors), None)
+        if response is None:
+            response = respond(500, {'error': str(exc)})
+        if response['statusCode'] >= 500:
+            log_event(
+                event='error', route=route, status=response['statusCode'],
+                error=f'{type(exc).__name__}: {exc}'.strip(), traceback=traceback.format_exc(limit=8)
+            )
+        return response
+
+
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '60'))
+METRICS_LOG_REQUESTS = os.environ.get('METRICS_LOG_REQUESTS') == '1'
+METRICS_KEY = os.environ.get('METRICS_KEY')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def log_event(**fields):
+    """Одна JSON-строка в stdout — журнал функции"""
+    print(dumps(fields), flush=True)
+
+
+class Metrics:
+    """Метрики инстанса: гистограмма длительности по маршрутам, число SQL и время в базе на запрос.
     
-    try:
-        if method == 'GET':
-            limit = int(event.get('queryStringParameters', {}).get('limit', 50))
-            
+    Счетчики запроса лежат в thread-local и сбрасываются в begin(); сводка пишется в журнал
+    раз в METRICS_LOG_INTERVAL секунд и отдается маршрутом GET ?action=metrics.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logged_at = time.monotonic()
+
+    def begin(self):
+        self.local.queries = 0
+        self.local.db_ms = 0.0
+        self.local.slow = []
+
+    def record_query(self, query, elapsed_ms: float):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        local.queries += 1
+        local.db_ms += elapsed_ms
+        if elapsed_ms >= SLOW_QUERY_MS:
+            local.slow.append((round(elapsed_ms, 1), ' '.join(str(query).split())[:300]))
+
+    def observe(self, route: str, seconds: float, status: int):
+        local = self.local
+        if not hasattr(local, 'queries'):
+            self.begin()
+        elapsed_ms = seconds * 1000
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'queries': 0, 'db_ms': 0.0, 'slow_queries': 0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)
+                }
+            stats['count'] += 1
+            stats['errors'] += status >= 500
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['queries'] += local.queries
+            stats['db_ms'] += local.db_ms
+            stats['slow_queries'] += len(local.slow)
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            due = METRICS_LOG_INTERVAL > 0 and time.monotonic() - self.logged_at >= METRICS_LOG_INTERVAL
+            if due:
+                self.logged_at = time.monotonic()
+        
+        for slow_ms, query in local.slow:
+            log_event(event='slow_query', route=route, ms=slow_ms, query=query)
+        if METRICS_LOG_REQUESTS:
+            log_event(
+                event='request', route=route, status=status, ms=round(elapsed_ms, 2),
+                queries=local.queries, db_ms=round(local.db_ms, 2)
+            )
+        if due:
+            log_event(event='metrics', routes=self.snapshot(), pool=db_pool.stats())
+        self.begin()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            routes = {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in self.routes.items()}
+        result = {}
+        for name, stats in routes.items():
+            count = stats['count']
+            result[name] = {
+                'count': count,
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total_ms'] / count, 2),
+                'p50_ms': self.percentile(stats, 0.50),
+                'p95_ms': self.percentile(stats, 0.95),
+                'p99_ms': self.percentile(stats, 0.99),
+                'max_ms': round(stats['max_ms'], 2),
+                'queries_per_request': round(stats['queries'] / count, 2),
+                'db_ms_per_request': round(stats['db_ms'] / count, 2),
+                'slow_queries': stats['slow_queries']
+            }
+        return result
+
+    @staticmethod
+    def percentile(stats: dict, pct: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль, но не больше максимума"""
+        needed = pct * stats['count']
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS_MS, stats['buckets']):
+            seen += hits
+            if seen >= needed:
+                return min(bound, round(stats['max_ms'], 2))
+        return round(stats['max_ms'], 2)
+
+
+metrics = Metrics()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Курсор соединений пула: считает запросы и время в базе для текущего запроса"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+def install_metrics(router):
+    router.hooks.append(metrics.observe)
+    
+    @router.route('GET', 'metrics')
+    def metrics_dump(event: dict, params: dict, body: dict) -> dict:
+        key = get_header(event, 'X-Metrics-Key') or ''
+        if not METRICS_KEY or not hmac.compare_digest(key.encode('utf-8', 'surrogatepass'), METRICS_KEY.encode()):
+            return error(404, 'Не найдено')
+        return respond(200, {'routes': metrics.snapshot(), 'pool': db_pool.stats()})
+
+def execute_prepared(cur, name: str, query: str, types: str, args: tuple):
+    """PREPARE выполняется один раз на соединение из пула, дальше только EXECUTE без планирования"""
+    conn = cur.connection
+    if getattr(conn, 'prepared', None) is None:
+        conn.prepared = set()
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} ({types}) AS {query}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', '5'))
+
+QUEST_WRITE_BEHIND = os.environ.get('QUEST_WRITE_BEHIND') == '1'
+QUEST_FLUSH_INTERVAL = float(os.environ.get('QUEST_FLUSH_INTERVAL', '10'))
+QUEST_FLUSH_BATCH = int(os.environ.get('QUEST_FLUSH_BATCH', '500'))
+
+QUEST_EVENTS = {
+    'chat_message': ('chat_messages', 'add'),
+    'buy_title': ('buy_title', 'add'),
+    'sell_title': ('sell_title', 'add'),
+    'admin_coins': ('admin_coins', 'add'),
+    'daily_streak': ('daily_streak', 'set'),
+    'coins_changed': ('coins_earned', 'max'),
+    'online_users': ('online_users', 'max'),
+    'time_spent': ('time_spent', 'max'),
+    'weekly_time': ('weekly_time', 'max'),
+}
+
+QUEST_UPSERT = """
+    WITH e (user_id, quest_id, amount, target, mode) AS (
+        SELECT * FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::text[])
+    )
+    INSERT INTO user_quests AS uq (user_id, quest_id, progress, completed, completed_at)
+    SELECT user_id, quest_id, amount, amount >= target, CASE WHEN amount >= target THEN NOW() END
+    FROM e
+    ON CONFLICT (user_id, quest_id) DO UPDATE SET (progress, completed, completed_at) = (
+        SELECT p.progress,
+               uq.completed OR p.progress >= e.target,
+               COALESCE(uq.completed_at, CASE WHEN p.progress >= e.target THEN NOW() END)
+        FROM e
+        CROSS JOIN LATERAL (
+            SELECT CASE e.mode
+                       WHEN 'add' THEN uq.progress + e.amount
+                       WHEN 'max' THEN GREATEST(uq.progress, e.amount)
+                       ELSE e.amount
+                   END AS progress
+        ) p
+        WHERE e.user_id = EXCLUDED.user_id AND e.quest_id = EXCLUDED.quest_id
+    )
+"""
+
+QUEST_FOLD = """
+    WITH moved AS (
+        DELETE FROM quest_events
+        WHERE id IN (
+            SELECT id FROM quest_events
+            WHERE %(user_id)s::int IS NULL OR user_id = %(user_id)s
+            ORDER BY id
+            LIMIT %(batch)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING user_id, quest_type, amount
+    ),
+    totals AS (
+        SELECT m.user_id, q.id AS quest_id, q.target_value AS target, SUM(m.amount)::int AS amount
+        FROM moved m
+        JOIN quests q ON q.quest_type = m.quest_type
+        GROUP BY m.user_id, q.id, q.target_value
+    ),
+    folded AS (
+        INSERT INTO user_quests AS uq (user_id, quest_id, progress, completed, completed_at)
+        SELECT user_id, quest_id, amount, amount >= target, CASE WHEN amount >= target THEN NOW() END
+        FROM totals
+        ON CONFLICT (user_id, quest_id) DO UPDATE SET (progress, completed, completed_at) = (
+            SELECT uq.progress + EXCLUDED.progress,
+                   uq.completed OR uq.progress + EXCLUDED.progress >= t.target,
+                   COALESCE(uq.completed_at, CASE WHEN uq.progress + EXCLUDED.progress >= t.target THEN NOW() END)
+            FROM totals t
+            WHERE t.user_id = EXCLUDED.user_id AND t.quest_id = EXCLUDED.quest_id
+        )
+    )
+    SELECT COUNT(*) FROM moved
+"""
+
+
+class QuestEngine:
+    """Переводит типизированные события в прогресс квестов одним пакетным upsert.
+    
+    В режиме QUEST_WRITE_BEHIND счетчики (события с режимом add) дописываются в quest_events
+    и сворачиваются в user_quests пачками по размеру или по времени.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self.quests_by_type = {}
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def index(self, cur) -> dict:
+        if self.version is not None and time.monotonic() - self.checked_at < CATALOG_CHECK_INTERVAL:
+            return self.quests_by_type
+        with self.lock:
+            cur.execute("SELECT version FROM catalog_version")
+            version = cur.fetchone()[0]
+            if version != self.version:
+                cur.execute("SELECT id, quest_type, target_value FROM quests ORDER BY id")
+                quests_by_type = {}
+                for quest_id, quest_type, target in cur.fetchall():
+                    quests_by_type.setdefault(quest_type, []).append((quest_id, target))
+                self.quests_by_type = quests_by_type
+                self.version = version
+            self.checked_at = time.monotonic()
+        return self.quests_by_type
+
+    def emit(self, cur, user_id, *events):
+        self.emit_batch(cur, [(user_id, event_type, value) for event_type, value in events])
+
+    def emit_batch(self, cur, events):
+        """events: список (user_id, event_type, value); повторы одного квеста сливаются до записи"""
+        quests_by_type = self.index(cur)
+        rows = {}
+        deferred = ([], [], [])
+        for user_id, event_type, value in events:
+            quest_type, mode = QUEST_EVENTS[event_type]
+            if QUEST_WRITE_BEHIND and mode == 'add':
+                for column, item in zip(deferred, (int(user_id), quest_type, value)):
+                    column.append(item)
+                continue
+            for quest_id, target in quests_by_type.get(quest_type, ()):
+                key = (int(user_id), quest_id)
+                amount = value
+                if key in rows and mode == 'add':
+                    amount = rows[key][0] + value
+                elif key in rows and mode == 'max':
+                    amount = max(rows[key][0], value)
+                rows[key] = (amount, target, mode)
+        if rows:
+            execute_prepared(
+                cur, 'quest_upsert', QUEST_UPSERT, 'int[], int[], int[], int[], text[]',
+                (
+                    [key[0] for key in rows],
+                    [key[1] for key in rows],
+                    [row[0] for row in rows.values()],
+                    [row[1] for row in rows.values()],
+                    [row[2] for row in rows.values()]
+                )
+            )
+        if deferred[0]:
+            cur.execute(
+                "INSERT INTO quest_events (user_id, quest_type, amount) SELECT * FROM unnest(%s::int[], %s::text[], %s::int[])",
+                deferred
+            )
+            self.pending += len(deferred[0])
+
+    def due(self) -> bool:
+        if not QUEST_WRITE_BEHIND:
+            return False
+        return self.pending >= QUEST_FLUSH_BATCH or time.monotonic() - self.flushed_at >= QUEST_FLUSH_INTERVAL
+
+    def maybe_flush(self, conn):
+        if self.due():
+            self.flush(conn)
+
+    def flush(self, conn) -> int:
+        """Сворачивает очередь пачками по QUEST_FLUSH_BATCH, пока неполная пачка не покажет, что она пуста"""
+        cur = conn.cursor()
+        folded = 0
+        while True:
+            cur.execute(QUEST_FOLD, {'batch': QUEST_FLUSH_BATCH, 'user_id': None})
+            moved = cur.fetchone()[0]
+            conn.commit()
+            folded += moved
+            if moved < QUEST_FLUSH_BATCH:
+                break
+        cur.close()
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        return folded
+
+    def fold_user(self, cur, user_id: int) -> int:
+        """Сворачивает все отложенные события пользователя в текущей транзакции"""
+        if not QUEST_WRITE_BEHIND:
+            return 0
+        cur.execute(QUEST_FOLD, {'batch': None, 'user_id': user_id})
+        return cur.fetchone()[0]
+
+
+quest_engine = QuestEngine()
+
+CHAT_MAX_LIMIT = 200
+CHAT_CHANNEL = 'chat_messages'
+LONG_POLL_MAX_WAIT = float(os.environ.get('CHAT_LONG_POLL_MAX_WAIT', '25'))
+LISTENER_READY_TIMEOUT = 3.0
+LISTENER_PING_INTERVAL = float(os.environ.get('CHAT_LISTENER_PING_INTERVAL', '15'))
+CHAT_CACHE_SIZE = int(os.environ.get('CHAT_CACHE_SIZE', '200'))
+CHAT_ID_OVERLAP = int(os.environ.get('CHAT_ID_OVERLAP', '50'))
+CHAT_PARTITION_CHECK = float(os.environ.get('CHAT_PARTITION_CHECK', '60'))
+CHAT_PARTITION_SLACK = int(os.environ.get('CHAT_PARTITION_SLACK', '3600'))
+CHAT_GROUP_COMMIT_WINDOW = float(os.environ.get('CHAT_GROUP_COMMIT_WINDOW', '0'))
+CHAT_GROUP_COMMIT_MAX = int(os.environ.get('CHAT_GROUP_COMMIT_MAX', '100'))
+CHAT_RATE_LIMIT = float(os.environ.get('CHAT_RATE_LIMIT', '1'))
+CHAT_RATE_BURST = int(os.environ.get('CHAT_RATE_BURST', '5'))
+CHAT_RATE_USERS = 10000
+
+MESSAGE_SELECT = """
+    SELECT cm.id, cm.message, cm.created_at, cm.username, cm.user_id
+    FROM chat_messages cm
+"""
+
+# Пачка сообщений одним оператором. id выдаются заранее в порядке пачки, чтобы сопоставить строки
+# с запросами; авторы блокируются по порядку id (параллельные пачки не ловят взаимную блокировку),
+# их версия растет на число сообщений — прогресс квеста на сообщения виден в профиле.
+# Сообщения несуществующих пользователей пропускаются, NOTIFY один на пачку: 'наименьший:наибольший' id
+POST_MESSAGES_QUERY = """
+    WITH batch AS (
+        SELECT nextval('chat_messages_id_seq') AS id, LOCALTIMESTAMP AS created_at, m.*
+        FROM unnest($1::int[], $2::text[]) WITH ORDINALITY AS m (user_id, message, n)
+    ),
+    authors AS (
+        SELECT id, username FROM users
+        WHERE id IN (SELECT user_id FROM batch)
+        ORDER BY id
+        FOR UPDATE
+    ),
+    bumped AS (
+        UPDATE users u SET version = u.version + c.messages
+        FROM (
+            SELECT a.id, COUNT(*) AS messages
+            FROM authors a
+            JOIN batch b ON b.user_id = a.id
+            GROUP BY a.id
+        ) c
+        WHERE u.id = c.id
+    ),
+    inserted AS (
+        INSERT INTO chat_messages (id, user_id, username, message, created_at)
+        SELECT b.id, b.user_id, a.username, b.message, b.created_at
+        FROM batch b
+        JOIN authors a ON a.id = b.user_id
+        RETURNING id
+    )
+    SELECT b.n, b.id, b.created_at, a.username, (SELECT pg_notify($3, MIN(id) || ':' || MAX(id)) FROM inserted)
+    FROM batch b
+    JOIN authors a ON a.id = b.user_id
+"""
+
+# Граница самой новой месячной партиции и первый id, начиная с которого все сообщения лежат в ней.
+# Берется сообщение через CHAT_PARTITION_SLACK после начала месяца: сообщения с большим id
+# вставлены позже и при расхождении часов инстансов меньше этого запаса не могут попасть в прошлый месяц
+PARTITION_FLOOR = """
+    SELECT date_trunc('month', LOCALTIMESTAMP), (
+        SELECT id FROM chat_messages
+        WHERE created_at >= date_trunc('month', LOCALTIMESTAMP) + make_interval(secs => %s)
+        ORDER BY created_at
+        LIMIT 1
+    )
+"""
+
+
+class ChatPartitions:
+    """Чтение из самой новой партиции chat_messages.
+    
+    Запрос ограничивается по created_at, когда его ответ целиком лежит в новой партиции
+    (id не меньше first_id); иначе он повторяется по всей таблице. Партиции создает и архивирует
+    маршрут maintain_chat функции admin, а не отправка сообщений.
+    """
+
+    def __init__(self):
+        self.floor = None
+        self.first_id = None
+        self.checked_at = 0.0
+        self.counters = {'bounded': 0, 'full': 0}
+        self.lock = threading.Lock()
+
+    def bounds(self, cur):
+        if time.monotonic() - self.checked_at >= CHAT_PARTITION_CHECK:
+            cur.execute(PARTITION_FLOOR, (CHAT_PARTITION_SLACK,))
+            floor, first_id = cur.fetchone()
+            with self.lock:
+                self.floor, self.first_id = floor, first_id
+                self.checked_at = time.monotonic()
+        with self.lock:
+            return (self.floor, self.first_id) if self.first_id is not None else None
+
+    def fetch(self, cur, where: str, args: tuple, order: str, limit: int, after_id: int = None) -> list:
+        """Сообщения по условию where; after_id — нижняя граница id для выборок по возрастанию"""
+        bounds = self.bounds(cur)
+        if bounds is not None and (after_id is None or after_id + 1 >= bounds[1]):
+            cur.execute(
+                f"{MESSAGE_SELECT} WHERE {where} AND cm.created_at >= %s ORDER BY cm.id {order} LIMIT %s",
+                args + (bounds[0], limit)
+            )
+            rows = cur.fetchall()
+            if after_id is not None or (len(rows) == limit and rows[-1][0] >= bounds[1]):
+                self.counters['bounded'] += 1
+                return rows
+        self.counters['full'] += 1
+        cur.execute(f"{MESSAGE_SELECT} WHERE {where} ORDER BY cm.id {order} LIMIT %s", args + (limit,))
+        return cur.fetchall()
+
+    def latest_id(self, cur) -> int:
+        bounds = self.bounds(cur)
+        if bounds is not None:
+            cur.execute("SELECT MAX(id) FROM chat_messages WHERE created_at >= %s", (bounds[0],))
+            latest = cur.fetchone()[0]
+            if latest is not None and latest >= bounds[1]:
+                return latest
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM chat_messages")
+        return cur.fetchone()[0]
+
+
+chat_partitions = ChatPartitions()
+
+
+class ChatListener:
+    """Одно LISTEN-соединение на инстанс, общее для всех ожидающих long-poll клиентов.
+    
+    id выдаются до COMMIT, так что транзакции коммитятся не по порядку id: кроме наибольшего id
+    копится low_id — наименьший id, закоммиченный с последнего take_low. 0 после переподключения:
+    уведомления за время разрыва потеряны.
+    
+    Тихое соединение раз в LISTENER_PING_INTERVAL сверяется с базой; слушателю, от которого нет
+    вестей дольше двух интервалов, не верят — чтение идет в базу, пока он не переподключится.
+    """
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.latest_id = 0
+        self.low_id = None
+        self.seq = 0
+        self.lows = deque(maxlen=256)
+        self.heard_at = 0.0
+        self._cond = threading.Condition()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self) -> bool:
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return self._ready.wait(LISTENER_READY_TIMEOUT)
+
+    def _publish(self, low_id: int, high_id: int):
+        with self._cond:
+            if self.low_id is None or low_id < self.low_id:
+                self.low_id = low_id
+            self.seq += 1
+            self.lows.append((self.seq, low_id))
+            self.latest_id = max(self.latest_id, high_id)
+            self._cond.notify_all()
+
+    def take_low(self):
+        """Наименьший id, закоммиченный после прошлого вызова, или None, если новых сообщений нет"""
+        with self._cond:
+            low_id, self.low_id = self.low_id, None
+            return low_id
+
+    def restore_low(self, low_id):
+        if low_id is not None:
+            self._publish(low_id, 0)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(
+                    os.environ['DATABASE_URL'],
+                    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+                )
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {self.channel}")
+                self._publish(0, chat_partitions.latest_id(cur))
+                self.heard_at = time.monotonic()
+                self._ready.set()
+                
+                while True:
+                    if select.select([conn], [], [], LISTENER_PING_INTERVAL) == ([], [], []):
+                        # Тишина: проверяем соединение запросом; если в базе есть id новее
+                        # известного, уведомления терялись — перечитываем весь буфер
+                        latest_id = chat_partitions.latest_id(cur)
+                        if latest_id > self.latest_id:
+                            self._publish(0, latest_id)
+                    else:
+                        conn.poll()
+                    self.heard_at = time.monotonic()
+                    if conn.notifies:
+                        ranges = [n.payload.partition(':') for n in conn.notifies]
+                        self._publish(min(int(low) for low, _, _ in ranges), max(int(high or low) for low, _, high in ranges))
+                        conn.notifies.clear()
+            except Exception:
+                self._ready.clear()
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set() and time.monotonic() - self.heard_at < 2 * LISTENER_PING_INTERVAL
+
+    def wait_for_new(self, since_id: int, timeout: float) -> bool:
+        """Ждет сообщение новее since_id или опоздавшее сообщение в окне CHAT_ID_OVERLAP под ним"""
+        if not self.start() or not self.is_ready():
+            return True
+        with self._cond:
+            seq = self.seq
+            return self._cond.wait_for(
+                lambda: self.latest_id > since_id or any(
+                    n > seq and since_id - CHAT_ID_OVERLAP < low_id <= since_id for n, low_id in self.lows
+                ),
+                timeout
+            )
+
+
+chat_listener = ChatListener(CHAT_CHANNEL)
+
+
+class RecentMessages:
+    """Кольцевой буфер последних сообщений чата с уже подставленным username.
+    
+    В буфере лежат все сообщения с id в диапазоне (floor_id, top_id].
+    floor_id = None означает, что буфер еще не загружен. Сообщение может закоммититься позже
+    сообщения с большим id: refresh перечитывает диапазон от low_id и вставляет пропущенные по месту.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.messages = deque()
+        self.floor_id = None
+        self.top_id = 0
+        self.counters = {'hits': 0, 'misses': 0, 'refreshes': 0, 'reloads': 0, 'late': 0}
+        self.lock = threading.Lock()
+
+    def _append(self, message: dict):
+        if len(self.messages) >= self.size:
+            self.floor_id = self.messages.popleft()['id']
+        self.messages.append(message)
+        self.top_id = message['id']
+
+    def _reload(self, cur):
+        rows = chat_partitions.fetch(cur, 'TRUE', (), 'DESC', self.size)
+        self.messages = deque(serialize_message(m) for m in reversed(rows))
+        self.floor_id = rows[-1][0] - 1 if len(rows) == self.size else 0
+        self.top_id = rows[0][0] if rows else 0
+        self.counters['reloads'] += 1
+
+    def _merge(self, late: list):
+        messages = sorted(list(self.messages) + late, key=lambda m: m['id'])
+        self.messages = deque(messages)
+        while len(self.messages) > self.size:
+            self.floor_id = self.messages.popleft()['id']
+        self.counters['late'] += len(late)
+
+    def refresh(self, cur, last_id: int, low_id=None):
+        """low_id — наименьший id, закоммиченный с прошлого refresh; None — ничего кроме id > top_id"""
+        if self.floor_id is None:
+            self._reload(cur)
+        if last_id <= self.top_id and low_id is None:
+            return
+        after_id = self.top_id if low_id is None else max(self.floor_id, min(self.top_id, low_id - 1))
+        rows = chat_partitions.fetch(cur, 'cm.id > %s', (after_id,), 'ASC', self.size + 1, after_id=after_id)
+        if len(rows) > self.size:
+            self._reload(cur)
+            return
+        top_id = self.top_id
+        known = {m['id'] for m in self.messages} if after_id < top_id else ()
+        late = [serialize_message(m) for m in rows if m[0] <= top_id and m[0] not in known]
+        for m in rows:
+            if m[0] > top_id:
+                self._append(serialize_message(m))
+        if late:
+            self._merge(late)
+        self.top_id = max(self.top_id, last_id)
+        self.counters['refreshes'] += 1
+
+    def add(self, message: dict):
+        if self.floor_id is not None and message['id'] == self.top_id + 1:
+            self._append(message)
+
+    def _hit(self, result):
+        self.counters['hits' if result is not None else 'misses'] += 1
+        return result
+
+    def latest(self, limit: int):
+        if self.floor_id != 0 and len(self.messages) < limit:
+            return self._hit(None)
+        return self._hit(list(self.messages)[-limit:])
+
+    def since(self, since_id: int, limit: int):
+        if since_id < self.floor_id:
+            return self._hit(None)
+        return self._hit([m for m in self.messages if m['id'] > since_id][:limit])
+
+    def before(self, before_id: int, limit: int):
+        older = [m for m in self.messages if m['id'] < before_id]
+        if self.floor_id != 0 and len(older) <= limit:
+            return self._hit(None)
+        return self._hit(older[-(limit + 1):])
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return dict(
+                self.counters,
+                size=len(self.messages),
+                capacity=self.size,
+                hit_rate=round(self.counters['hits'] / lookups, 4) if lookups else 0.0
+            )
+
+
+recent_messages = RecentMessages(CHAT_CACHE_SIZE)
+
+def get_header(event: dict, name: str):
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def serialize_message(m) -> dict:
+    return {
+        'id': m[0],
+        'message': m[1],
+        'created_at': m[2].isoformat(),
+        'username': m[3],
+        'user_id': m[4]
+    }
+
+
+class RateLimiter:
+    """Token bucket на пользователя в памяти инстанса: rate сообщений в секунду, запас до burst.
+    
+    Поток сообщений отсекается до похода в базу; хранятся только последние size пользователей.
+    """
+
+    def __init__(self, rate: float, burst: int, size: int):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def retry_after(self, key) -> int:
+        """0, если токен взят, иначе через сколько секунд появится следующий"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                self.buckets.move_to_end(key)
+                while len(self.buckets) > self.size:
+                    self.buckets.popitem(last=False)
+                return 0
+            return int((1 - tokens) / self.rate) + 1
+
+
+chat_rate_limiter = RateLimiter(CHAT_RATE_LIMIT, CHAT_RATE_BURST, CHAT_RATE_USERS)
+
+
+class ChatIngest:
+    """Group commit сообщений: параллельные отправки собираются в одну вставку и один COMMIT.
+    
+    Первый поток без лидера становится лидером и записывает всю очередь; остальные ждут свой результат.
+    Пока идет запись предыдущей пачки, лидер ждет до window секунд (или пока пачка не наберет max_batch),
+    без параллельных записей пишет сразу. При window = 0 каждое сообщение пишется своей транзакцией.
+    Если пачка не записалась из-за данных, сообщения повторяются по одному, чтобы одно плохое
+    не роняло соседей; done выставляется в любом случае, ожидающие не зависают.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = []
+        self.leading = False
+        self.writing = 0
+        self.full = threading.Event()
+        self.counters = {'messages': 0, 'batches': 0}
+        self.lock = threading.Lock()
+
+    def post(self, user_id: int, message: str):
+        """(id, created_at, username) или None, если пользователя нет"""
+        slot = {'args': (user_id, message), 'done': threading.Event(), 'result': None, 'error': None}
+        if self.window <= 0:
+            self.write([slot])
+        else:
+            with self.lock:
+                self.queue.append(slot)
+                lead = not self.leading
+                self.leading = True
+                if len(self.queue) >= self.max_batch:
+                    self.full.set()
+            if lead:
+                if self.writing:
+                    self.full.wait(self.window)
+                with self.lock:
+                    batch, self.queue = self.queue, []
+                    self.leading = False
+                    self.full.clear()
+                self.write(batch)
+            slot['done'].wait()
+        if slot['error'] is not None:
+            raise slot['error']
+        return slot['result']
+
+    def write(self, batch: list):
+        with self.lock:
+            self.writing += 1
+        try:
+            try:
+                self.insert(batch)
+            except (PoolTimeout, psycopg2.OperationalError) as e:
+                for slot in batch:
+                    slot['error'] = e
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0]['error'] = e
+                else:
+                    for slot in batch:
+                        try:
+                            self.insert([slot])
+                        except Exception as e:
+                            slot['error'] = e
+        finally:
+            with self.lock:
+                self.writing -= 1
+            for slot in batch:
+                slot['done'].set()
+        
+        # Соединение берется, только если сброс квестов действительно пора запускать: обычно нет,
+        # и лидер не должен ждать пул ради пустой проверки
+        if not quest_engine.due():
+            return
+        try:
             conn = get_db()
-            cur = conn.cursor()
-            
-            cur.execute("""
-                SELECT cm.id, cm.message, cm.created_at, u.username, u.id as user_id
-                FROM chat_messages cm
-                JOIN users u ON cm.user_id = u.id
-                ORDER BY cm.created_at DESC
-                LIMIT %s
-            """, (limit,))
-            
-            messages = [{
-                'id': m[0],
-                'message': m[1],
-                'created_at': m[2].isoformat(),
-                'username': m[3],
-                'user_id': m[4]
-            } for m in cur.fetchall()]
-            
-            messages.reverse()
-            
+            try:
+                quest_engine.flush(conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            # Сообщения уже записаны: сбой сброса не должен превращать их отправку в ошибку
+            log_event(event='quest_flush_error', error=f'{type(e).__name__}: {e}'.strip())
+
+    def insert(self, batch: list):
+        """Одна транзакция на пачку; результаты слотов выставляются только после COMMIT"""
+        conn = get_db()
+        cur = conn.cursor()
+        try:
+            execute_prepared(
+                cur, 'post_messages', POST_MESSAGES_QUERY, 'int[], text[], text',
+                ([slot['args'][0] for slot in batch], [slot['args'][1] for slot in batch], CHAT_CHANNEL)
+            )
+            rows = cur.fetchall()
+            quest_engine.emit_batch(cur, [(batch[row[0] - 1]['args'][0], 'chat_message', 1) for row in rows])
+            conn.commit()
+        finally:
             cur.close()
             conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'messages': messages}),
-                'isBase64Encoded': False
-            }
         
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            message = body.get('message', '').strip()
-            
-            if not user_id or not message:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id и message обязательны'}),
-                    'isBase64Encoded': False
-                }
-            
-            if len(message) > 500:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Сообщение слишком длинное (макс. 500 символов)'}),
-                    'isBase64Encoded': False
-                }
-            
+        posted = []
+        for n, message_id, created_at, username, _ in rows:
+            user_id, message = batch[n - 1]['args']
+            batch[n - 1]['result'] = (message_id, created_at, username)
+            posted.append(serialize_message((message_id, message, created_at, username, int(user_id))))
+        with recent_messages.lock:
+            for message in sorted(posted, key=lambda m: m['id']):
+                recent_messages.add(message)
+        with self.lock:
+            self.counters['messages'] += len(posted)
+            self.counters['batches'] += 1
+
+
+chat_ingest = ChatIngest(CHAT_GROUP_COMMIT_WINDOW, CHAT_GROUP_COMMIT_MAX)
+
+# Только явный секрет: ключ, выведенный из DATABASE_URL, подделал бы любой, кто знает строку
+# подключения. Без SESSION_SECRET токены не выпускаются и не принимаются
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '').encode()
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '43200'))
+SESSION_REVOCATION_CHECK = float(os.environ.get('SESSION_REVOCATION_CHECK', '30'))
+# Доверие к присланному клиентом user_id/admin_id — только на время перехода клиентов на токены,
+# после него функции запускаются с AUTH_ALLOW_LEGACY=0
+AUTH_ALLOW_LEGACY = os.environ.get('AUTH_ALLOW_LEGACY', '1') == '1'
+
+if not SESSION_SECRET:
+    log_event(event='config_error', error='SESSION_SECRET не задан: сессионные токены отключены')
+
+
+class InvalidSession(Exception):
+    pass
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def session_signature(payload: str) -> str:
+    if not SESSION_SECRET:
+        raise InvalidSession()
+    return b64url(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+class Revocations:
+    """Отозванные сессии: user_id -> момент отзыва в мс, все токены выпущенные раньше недействительны.
+    
+    Список перечитывается не чаще раза в SESSION_REVOCATION_CHECK секунд, проверка токена в базу не ходит.
+    """
+
+    def __init__(self):
+        self.revoked = {}
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def reload(self):
+        with self.lock:
+            if self.checked_at is not None and time.monotonic() - self.checked_at < SESSION_REVOCATION_CHECK:
+                return
             conn = get_db()
             cur = conn.cursor()
-            
             cur.execute(
-                "INSERT INTO chat_messages (user_id, message, created_at) VALUES (%s, %s, %s) RETURNING id, created_at",
-                (user_id, message, datetime.now())
+                "SELECT user_id, revoked_before FROM session_revocations WHERE revoked_before > %s",
+                (int(time.time() * 1000) - SESSION_TTL * 1000,)
+            )
+            self.revoked = dict(cur.fetchall())
+            cur.close()
+            conn.close()
+            self.checked_at = time.monotonic()
+
+    def is_revoked(self, session: dict) -> bool:
+        if self.checked_at is None or time.monotonic() - self.checked_at >= SESSION_REVOCATION_CHECK:
+            self.reload()
+        return session['iat'] < self.revoked.get(session['uid'], 0)
+
+
+revocations = Revocations()
+
+def read_session(event: dict):
+    """Сессия из заголовка X-Session-Token: {'uid', 'name', 'adm', 'iat', 'exp'} или None без токена"""
+    token = get_header(event, 'X-Session-Token')
+    if not token:
+        return None
+    # Настоящий токен — base64url, всегда ASCII; compare_digest на str с другими символами бросает TypeError
+    if not token.isascii():
+        raise InvalidSession()
+    payload, _, signature = token.partition('.')
+    if not signature or not hmac.compare_digest(signature, session_signature(payload)):
+        raise InvalidSession()
+    try:
+        session = json.loads(b64url_decode(payload))
+    except ValueError:
+        raise InvalidSession()
+    if session['exp'] < time.time() * 1000 or revocations.is_revoked(session):
+        raise InvalidSession()
+    return session
+
+def session_user_id(session, claimed):
+    """id из токена; без токена — присланный клиентом, пока разрешен AUTH_ALLOW_LEGACY"""
+    if session:
+        return session['uid']
+    if not AUTH_ALLOW_LEGACY:
+        raise InvalidSession()
+    return claimed
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_PENDING_TTL = 60
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024'))
+IDEMPOTENCY_SWEEP_INTERVAL = float(os.environ.get('IDEMPOTENCY_SWEEP_INTERVAL', '600'))
+IDEMPOTENCY_SWEEP_BATCH = 5000
+REPLAY_HEADERS = dict(JSON_HEADERS, **{'Idempotency-Replayed': 'true', 'Access-Control-Expose-Headers': 'Idempotency-Replayed'})
+
+# Резерв ключа на время выполнения запроса; просроченную запись можно занять заново
+IDEMPOTENCY_RESERVE = """
+    INSERT INTO idempotency_keys AS k (key, fingerprint, expires_at)
+    VALUES (%s, %s, LOCALTIMESTAMP + make_interval(secs => %s))
+    ON CONFLICT (key) DO UPDATE SET
+        fingerprint = EXCLUDED.fingerprint, status = NULL, body = NULL, expires_at = EXCLUDED.expires_at
+    WHERE k.expires_at <= LOCALTIMESTAMP
+    RETURNING key
+"""
+
+IDEMPOTENCY_SWEEP = """
+    DELETE FROM idempotency_keys
+    WHERE key IN (
+        SELECT key FROM idempotency_keys
+        WHERE expires_at <= LOCALTIMESTAMP
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+class IdempotencyStore:
+    """Повтор POST с тем же Idempotency-Key получает первый ответ, маршрут второй раз не выполняется.
+    
+    Ответы живут IDEMPOTENCY_TTL в idempotency_keys, перед таблицей — LRU на инстанс: повтор
+    на тот же инстанс не ходит в базу, на другой — одно чтение по ключу. 5xx и 429 не сохраняются,
+    такой запрос можно повторить; просроченные ключи удаляются пачками.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.cache = OrderedDict()
+        self.counters = {'hits': 0, 'db_hits': 0, 'stored': 0, 'conflicts': 0, 'swept': 0}
+        self.swept_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _remember(self, key: bytes, entry: tuple):
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def _cached(self, key: bytes):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry
+
+    def _replay(self, entry: tuple, fingerprint: bytes) -> dict:
+        if entry[1] != fingerprint:
+            return error(422, 'Idempotency-Key уже использован для другого запроса')
+        return {'statusCode': entry[2], 'headers': REPLAY_HEADERS, 'body': entry[3], 'isBase64Encoded': False}
+
+    def middleware(self, route: str, event: dict, body: dict, call):
+        key = get_header(event, 'Idempotency-Key')
+        if event.get('httpMethod') != 'POST' or not key:
+            return call()
+        if len(key) > 255:
+            raise HttpError(400, 'Idempotency-Key длиннее 255 символов')
+        
+        session = read_session(event)
+        owner = session['uid'] if session else body.get('user_id') or body.get('admin_id')
+        key = hashlib.sha256(f'{route}\0{owner}\0{key}'.encode()).digest()[:16]
+        fingerprint = hashlib.sha256((event.get('body') or '').encode()).digest()[:16]
+        
+        entry = self._cached(key)
+        if entry is not None:
+            self.counters['hits'] += 1
+            return self._replay(entry, fingerprint)
+        
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT fingerprint, status, body, EXTRACT(EPOCH FROM expires_at - LOCALTIMESTAMP) FROM idempotency_keys "
+            "WHERE key = %s AND expires_at > LOCALTIMESTAMP",
+            (key,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(IDEMPOTENCY_RESERVE, (key, fingerprint, IDEMPOTENCY_PENDING_TTL))
+            row = None if cur.fetchone() else (fingerprint, None)
+            conn.commit()
+        cur.close()
+        conn.close()
+        if row is not None:
+            if row[1] is None:
+                self.counters['conflicts'] += 1
+                return error(409, 'Запрос с этим Idempotency-Key еще выполняется')
+            entry = (time.monotonic() + float(row[3]), bytes(row[0]), row[1], row[2])
+            self._remember(key, entry)
+            self.counters['db_hits'] += 1
+            return self._replay(entry, fingerprint)
+        
+        # Резерв уже закоммичен, поэтому маршрут выполняется без нашего соединения:
+        # иначе каждый запрос с ключом держал бы два соединения пула
+        # Соединения, которые маршрут не вернул (исключение посреди транзакции), освобождаются
+        # до записи результата, иначе при маленьком пуле запись ждала бы саму себя
+        try:
+            response = call()
+        except HttpError as e:
+            response = e.response
+        except Exception:
+            db_pool.release_all()
+            self.release(key)
+            raise
+        db_pool.release_all()
+        
+        conn = get_db()
+        cur = conn.cursor()
+        status = response['statusCode']
+        if status >= 500 or status == 429:
+            cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+        else:
+            cur.execute(
+                "UPDATE idempotency_keys SET status = %s, body = %s, expires_at = LOCALTIMESTAMP + make_interval(secs => %s) "
+                "WHERE key = %s",
+                (status, response['body'], IDEMPOTENCY_TTL, key)
             )
-            msg = cur.fetchone()
-            
-            cur.execute("""
-                UPDATE user_quests SET progress = progress + 1 
-                WHERE user_id = %s AND quest_id IN (SELECT id FROM quests WHERE quest_type = 'chat_messages')
-            """, (user_id,))
-            
-            cur.execute("SELECT username FROM users WHERE id = %s", (user_id,))
-            username = cur.fetchone()[0]
-            
+            self._remember(key, (time.monotonic() + IDEMPOTENCY_TTL, fingerprint, status, response['body']))
+            self.counters['stored'] += 1
+        conn.commit()
+        self.maybe_sweep(cur)
+        cur.close()
+        conn.close()
+        return response
+
+    def release(self, key: bytes):
+        """Снимает резерв после сбоя маршрута, чтобы повтор не получал 409; сбой здесь только пишется
+        в журнал и не подменяет исключение маршрута — резерв тогда истечет через IDEMPOTENCY_PENDING_TTL"""
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
             conn.commit()
             cur.close()
             conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'id': msg[0],
-                    'message': message,
-                    'created_at': msg[1].isoformat(),
-                    'username': username,
-                    'user_id': user_id
-                }),
-                'isBase64Encoded': False
-            }
+        except Exception as e:
+            log_event(event='idempotency_release_failed', error=f'{type(e).__name__}: {e}'.strip())
+
+    def maybe_sweep(self, cur) -> int:
+        if time.monotonic() - self.swept_at < IDEMPOTENCY_SWEEP_INTERVAL:
+            return 0
+        self.swept_at = time.monotonic()
+        cur.execute(IDEMPOTENCY_SWEEP, (IDEMPOTENCY_SWEEP_BATCH,))
+        swept = cur.rowcount
+        cur.connection.commit()
+        self.counters['swept'] += swept
+        return swept
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE)
+
+router = Router('Content-Type, If-None-Match, X-Session-Token, Idempotency-Key')
+router.errors[InvalidSession] = error(401, 'Требуется вход')
+install_metrics(router)
+router.middleware.append(idempotency.middleware)
+
+@router.route('GET')
+def list_messages(event: dict, params: dict, body: dict) -> dict:
+    try:
+        limit = max(1, min(int(params.get('limit', 50)), CHAT_MAX_LIMIT))
+        since_id = int(params['since_id']) if params.get('since_id') else None
+        before_id = int(params['before_id']) if params.get('before_id') else None
+        wait = min(float(params.get('wait', 0)), LONG_POLL_MAX_WAIT)
+    except ValueError:
+        return error(400, 'Некорректные параметры запроса')
+    
+    if since_id is not None and wait > 0 and not chat_listener.wait_for_new(since_id, wait):
+        return respond(200, {'messages': [], 'last_id': since_id, 'has_more': False})
+    
+    # Сообщения с меньшим id могут закоммититься после уже отданных: в режиме since_id отдаются
+    # и последние CHAT_ID_OVERLAP id перед курсором, клиент убирает повторы по id
+    overlap_id = max(0, since_id - CHAT_ID_OVERLAP) if since_id is not None else None
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    with recent_messages.lock:
+        if chat_listener.is_ready():
+            last_id = chat_listener.latest_id
+            low_id = chat_listener.take_low()
+        else:
+            last_id = chat_partitions.latest_id(cur)
+            low_id = recent_messages.top_id - CHAT_ID_OVERLAP + 1
+        try:
+            recent_messages.refresh(cur, last_id, low_id)
+        except Exception:
+            chat_listener.restore_low(low_id)
+            raise
+        if before_id is not None:
+            cached = recent_messages.before(before_id, limit)
+        elif since_id is not None:
+            cached = recent_messages.since(overlap_id, limit + since_id - overlap_id)
+        else:
+            cached = recent_messages.latest(limit)
+    
+    if before_id is not None:
+        if cached is not None:
+            rows = cached
+        else:
+            rows = chat_partitions.fetch(cur, 'cm.id < %s', (before_id,), 'DESC', limit + 1)
+            rows = [serialize_message(m) for m in reversed(rows)]
+        cur.close()
+        conn.close()
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
+        has_more = len(rows) > limit
+        messages = rows[-limit:]
         
-    except Exception as e:
+        return respond(200, {
+            'messages': messages,
+            'has_more': has_more,
+            'first_id': messages[0]['id'] if messages else before_id
+        })
+    
+    if cached is not None:
+        messages = cached
+    elif since_id is not None:
+        rows = chat_partitions.fetch(cur, 'cm.id > %s', (overlap_id,), 'ASC', limit + since_id - overlap_id, after_id=overlap_id)
+        messages = [serialize_message(m) for m in rows]
+    else:
+        rows = chat_partitions.fetch(cur, 'TRUE', (), 'DESC', limit)
+        messages = [serialize_message(m) for m in reversed(rows)]
+    
+    cur.close()
+    conn.close()
+    
+    # Окно задается первым и последним id и числом сообщений: опоздавшее сообщение внутри окна
+    # сдвигает первый id или меняет число, даже когда наибольший id тот же
+    etag = f'"chat-{messages[0]["id"] if messages else 0}-{messages[-1]["id"] if messages else 0}-{len(messages)}"'
+    
+    if since_id is None and get_header(event, 'If-None-Match') == etag:
         return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
+            'statusCode': 304,
+            'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
             'isBase64Encoded': False
         }
+    
+    fresh = len(messages) if since_id is None else sum(1 for m in messages if m['id'] > since_id)
+    
+    return respond(200, {
+        'messages': messages,
+        'last_id': max(messages[-1]['id'] if messages else 0, since_id or 0),
+        'has_more': since_id is not None and fresh == limit
+    }, JSON_HEADERS if since_id is not None else dict(JSON_HEADERS, ETag=etag, **{'Access-Control-Expose-Headers': 'ETag'}))
+
+@router.route('POST')
+def post_message(event: dict, params: dict, body: dict) -> dict:
+    user_id = session_user_id(read_session(event), body.get('user_id'))
+    message = body.get('message') or ''
+    
+    if not isinstance(message, str):
+        return error(400, 'Некорректные параметры запроса')
+    
+    message = message.strip()
+    
+    if not user_id or not message:
+        return error(400, 'user_id и message обязательны')
+    
+    if len(message) > 500:
+        return error(400, 'Сообщение слишком длинное (макс. 500 символов)')
+    
+    if not str(user_id).isdigit() or '\x00' in message:
+        return error(400, 'Некорректные параметры запроса')
+    
+    retry_after = chat_rate_limiter.retry_after(int(user_id))
+    if retry_after:
+        return respond(
+            429,
+            {'error': f'Слишком много сообщений, попробуйте через {retry_after} с'},
+            dict(JSON_HEADERS, **{'Retry-After': str(retry_after)})
+        )
+    
+    msg = chat_ingest.post(int(user_id), message)
+    
+    if not msg:
+        return error(404, 'Пользователь не найден')
+    
+    return respond(200, {
+        'id': msg[0],
+        'message': message,
+        'created_at': msg[1].isoformat(),
+        'username': msg[2],
+        'user_id': user_id
+    })
+
+def handler(event: dict, context) -> dict:
+    try:
+        return router.dispatch(event)
+    finally:
+        db_pool.release_all()
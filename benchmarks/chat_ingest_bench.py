@@ -0,0 +1,95 @@
+"""
+Бенчмарк отправки сообщений в чат: сообщений в секунду при 1, 10 и 100 одновременных отправителях,
+каждое сообщение своей транзакцией и с group commit (CHAT_GROUP_COMMIT_WINDOW).
+
+Отправители пишут от разных пользователей, лимит сообщений на пользователя на время замера
+выключен: меряется запись, а не token bucket. Пул соединений один на оба режима (--pool).
+
+Запуск: DATABASE_URL=... python benchmarks/chat_ingest_bench.py --senders 1 10 100 --duration 10 \
+            --window 0.005 --pool 20
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from common import load_handler, make_event, seed, summarize
+
+
+def ingest_rate(chat, user_ids: list, senders: int, duration: float, window: float) -> dict:
+    chat.chat_ingest.window = window
+    chat.chat_ingest.counters = {'messages': 0, 'batches': 0}
+    samples = []
+    statuses = {}
+    lock = threading.Lock()
+    barrier = threading.Barrier(senders)
+
+    def work(index: int):
+        users = user_ids[index::senders] or user_ids
+        local_samples = []
+        local_statuses = {}
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+        n = 0
+        while time.perf_counter() < deadline:
+            event = make_event('POST', body={'user_id': users[n % len(users)], 'message': f'bench {index} {n}'})
+            t0 = time.perf_counter()
+            status = chat.handler(event, None)['statusCode']
+            local_samples.append(time.perf_counter() - t0)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            n += 1
+        with lock:
+            samples.extend(local_samples)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    pool = [threading.Thread(target=work, args=(i,)) for i in range(senders)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    result = summarize(samples, time.perf_counter() - started)
+    counters = chat.chat_ingest.counters
+    result['statuses'] = statuses
+    result['messages_per_commit'] = round(counters['messages'] / counters['batches'], 2) if counters['batches'] else 0.0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--senders', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--window', type=float, default=0.005)
+    parser.add_argument('--pool', type=int, default=20)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DB_POOL_SIZE', str(args.pool))
+    os.environ.setdefault('METRICS_LOG_INTERVAL', '0')
+    user_ids = seed(args.users, titles_per_user=1, prefix=f'chat_bench_{args.users}_')
+    chat = load_handler('chat')
+    chat.chat_rate_limiter.rate = 0
+
+    results = []
+    for senders in args.senders:
+        single = ingest_rate(chat, user_ids, senders, args.duration, 0)
+        grouped = ingest_rate(chat, user_ids, senders, args.duration, args.window)
+        results.append({
+            'senders': senders,
+            'single': single,
+            'group_commit': grouped,
+            'speedup': round(grouped['rps'] / single['rps'], 2) if single['rps'] else 0.0,
+        })
+
+    print(json.dumps({
+        'window_ms': args.window * 1000,
+        'max_batch': chat.chat_ingest.max_batch,
+        'pool': chat.DB_POOL_SIZE,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Общие утилиты бенчмарков: загрузка функций из backend/, фикстуры tests.json, наполнение базы,
+статистика и сохранение результатов для сравнения между коммитами
+"""
+import copy
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import time
+from datetime import datetime
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def get_conn():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def load_handler(name: str):
+    spec = importlib.util.spec_from_file_location(f'backend_{name}', os.path.join(ROOT, 'backend', name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_event(method: str, params: dict = None, body: dict = None, headers: dict = None) -> dict:
+    return {
+        'httpMethod': method,
+        'queryStringParameters': params or {},
+        'headers': headers or {},
+        'body': json.dumps(body) if body is not None else '',
+    }
+
+
+def load_fixtures(name: str) -> dict:
+    """Кейсы backend/<name>/tests.json по имени"""
+    with open(os.path.join(ROOT, 'backend', name, 'tests.json')) as f:
+        return {case['name']: case for case in json.load(f)['tests']}
+
+
+def fixture_event(case: dict, params: dict = None, body: dict = None, headers: dict = None) -> dict:
+    """Событие из кейса tests.json; params и body дополняют и переопределяют поля фикстуры"""
+    merged_params = dict(case.get('queryStringParameters') or {}, **(params or {}))
+    merged_body = None
+    if 'body' in case or body:
+        merged_body = dict(copy.deepcopy(case.get('body') or {}), **(body or {}))
+    return make_event(case.get('method', 'GET'), merged_params, merged_body, headers)
+
+
+def seed(users: int, titles_per_user: int = 3, messages: int = 0, prefix: str = 'bench_') -> list:
+    """Создает пользователей с префиксом prefix (повторный запуск их не дублирует) и возвращает их id"""
+    conn = get_conn()
+    cur = conn.cursor()
+    
+    cur.execute("""
+        INSERT INTO users (username, password_hash, coins, last_login)
+        SELECT %s || g, 'x', 1000 + g %% 5000, NOW() - (g %% 600) * INTERVAL '1 minute'
+        FROM generate_series(1, %s) g
+        ON CONFLICT (username) DO NOTHING
+    """, (prefix, users))
+    cur.execute("SELECT id FROM users WHERE username LIKE %s ORDER BY id", (prefix + '%',))
+    user_ids = [r[0] for r in cur.fetchall()]
+    
+    cur.execute("""
+        INSERT INTO user_titles (user_id, title_id)
+        SELECT u.id, t.id
+        FROM users u
+        JOIN LATERAL (SELECT id FROM titles ORDER BY random() LIMIT %s) t ON TRUE
+        WHERE u.username LIKE %s
+        ON CONFLICT DO NOTHING
+    """, (titles_per_user, prefix + '%'))
+    cur.execute("""
+        INSERT INTO user_quests (user_id, quest_id, progress)
+        SELECT u.id, q.id, (random() * q.target_value)::int
+        FROM users u CROSS JOIN quests q
+        WHERE u.username LIKE %s AND random() < 0.3
+        ON CONFLICT DO NOTHING
+    """, (prefix + '%',))
+    cur.execute("""
+        INSERT INTO daily_logins (user_id, login_date, day_streak, reward_claimed)
+        SELECT u.id, CURRENT_DATE - 1, 1 + u.id %% 7, TRUE
+        FROM users u
+        WHERE u.username LIKE %s
+        ON CONFLICT DO NOTHING
+    """, (prefix + '%',))
+    cur.execute("""
+        INSERT INTO user_stats (user_id, day_streak, last_claim_date)
+        SELECT u.id, 1 + u.id %% 7, CURRENT_DATE - 1
+        FROM users u
+        WHERE u.username LIKE %s
+        ON CONFLICT DO NOTHING
+    """, (prefix + '%',))
+    
+    if messages:
+        cur.execute("""
+            INSERT INTO chat_messages (user_id, username, message, created_at)
+            SELECT u.id, u.username, 'bench message ' || g, NOW() - (%s - g) * INTERVAL '1 second'
+            FROM generate_series(1, %s) g
+            JOIN users u ON u.id = (%s::int[])[1 + g %% %s]
+        """, (messages, messages, user_ids, len(user_ids)))
+    
+    conn.commit()
+    cur.close()
+    conn.close()
+    return user_ids
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def timed(fn, iterations: int) -> dict:
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples, time.perf_counter() - started)
+
+
+def pick(user_ids: list) -> int:
+    return random.choice(user_ids)
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', 'backend'], cwd=ROOT) != 0
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(kind: str, results: dict) -> str:
+    """Пишет benchmarks/results/<kind>-<время>-<коммит>.json и возвращает путь"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f'{kind}-{stamp}-{results.get("revision", "unknown")}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def compare_results(baseline: dict, current: dict, keys=('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')) -> dict:
+    """Относительные изменения по операциям: {'op': {'rps': '+12.5%', ...}}"""
+    diff = {}
+    for op, stats in current.get('ops', {}).items():
+        before = baseline.get('ops', {}).get(op)
+        if not before:
+            continue
+        diff[op] = {}
+        for key in keys:
+            if before.get(key) and stats.get(key) is not None:
+                diff[op][key] = f'{(stats[key] - before[key]) / before[key] * 100:+.1f}%'
+    return diff
@@ -0,0 +1,275 @@
+"""
+Нагрузочный прогон функций backend/ в процессе поверх фикстур tests.json.
+
+Каждая операция сценария строится из кейса tests.json соответствующей функции (подставляются
+пользователь, токен сессии и курсоры), так что фикстуры и нагрузка не расходятся. Сценарии:
+  chat      — чат с частым опросом по курсору, немного отправки и профиля
+  shop      — профиль, покупка и продажа титулов, таблица лидеров
+  daily     — «полночь»: все пользователи разом забирают ежедневную награду
+  fixtures  — все кейсы всех tests.json по кругу
+
+Отчет: req/s, p50/p95/p99 по операциям, SQL-запросов на запрос (по метрикам функций), статусы.
+Результат сохраняется в benchmarks/results/ с коммитом в имени; --compare сравнивает с прошлым.
+
+Запуск: DATABASE_URL=... python benchmarks/load_test.py --scenario chat --users 2000 --titles 3 \
+            --messages 5000 --threads 8 --processes 2 --duration 20 [--compare results/<файл>.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+from common import (
+    compare_results, fixture_event, get_conn, git_revision, load_fixtures, load_handler, make_event,
+    save_results, seed, summarize
+)
+
+FUNCTIONS = ('api', 'auth', 'chat', 'admin')
+
+SCENARIOS = {
+    'chat': [(75, 'chat_poll'), (5, 'chat_latest'), (10, 'chat_post'), (10, 'profile')],
+    'shop': [(40, 'profile'), (35, 'buy_title'), (15, 'sell_title'), (10, 'leaderboard')],
+    'daily': [(70, 'claim_daily'), (30, 'profile')],
+    'fixtures': None,
+}
+
+# Маршрут функции, которым обслуживается операция: по нему берется число запросов из метрик
+OP_ROUTES = {
+    'chat_poll': 'chat.list_messages',
+    'chat_latest': 'chat.list_messages',
+    'chat_post': 'chat.post_message',
+    'profile': 'api.profile',
+    'buy_title': 'api.buy_title',
+    'sell_title': 'api.sell_title',
+    'leaderboard': 'api.leaderboard',
+    'claim_daily': 'api.claim_daily',
+}
+
+
+class Workload:
+    """Строит события операций для одного процесса; handlers грузятся внутри процесса"""
+
+    def __init__(self, users: dict, titles: list, latest_chat_id: int):
+        self.handlers = {name: load_handler(name) for name in FUNCTIONS}
+        self.fixtures = {name: load_fixtures(name) for name in FUNCTIONS}
+        self.users = users
+        self.user_ids = list(users)
+        self.titles = titles
+        self.latest_chat_id = latest_chat_id
+        self.tokens = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def headers(self, user_id: int) -> dict:
+        token = self.tokens.get(user_id)
+        if token is None:
+            token = self.tokens[user_id] = self.handlers['auth'].sign_session(user_id, self.users[user_id], False)
+        return {'X-Session-Token': token}
+
+    def next_id(self) -> int:
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def build(self, op: str, rng: random.Random):
+        user_id = rng.choice(self.user_ids)
+        headers = self.headers(user_id)
+        if op == 'chat_poll':
+            since_id = max(0, self.latest_chat_id - rng.randint(0, 5))
+            case = self.fixtures['chat']['Get chat messages since cursor']
+            return 'chat', fixture_event(case, {'since_id': str(since_id), 'wait': '0'}, headers=headers)
+        if op == 'chat_latest':
+            return 'chat', fixture_event(self.fixtures['chat']['Get chat messages'], {'limit': '50'}, headers=headers)
+        if op == 'chat_post':
+            case = self.fixtures['chat']['Send chat message']
+            return 'chat', fixture_event(case, body={'user_id': user_id, 'message': f'load {self.next_id()}'}, headers=headers)
+        if op == 'profile':
+            case = self.fixtures['api']['Get user profile']
+            return 'api', fixture_event(case, {'user_id': str(user_id)}, headers=headers)
+        if op == 'leaderboard':
+            case = self.fixtures['api']['Get coins leaderboard']
+            return 'api', fixture_event(case, {'board': rng.choice(['coins', 'titles', 'chat', 'streak'])})
+        if op in ('buy_title', 'sell_title'):
+            body = {'action': op, 'user_id': user_id, 'title_id': rng.choice(self.titles)}
+            return 'api', make_event('POST', body=body, headers=headers)
+        if op == 'claim_daily':
+            return 'api', make_event('POST', body={'action': 'claim_daily', 'user_id': user_id}, headers=headers)
+        raise ValueError(op)
+
+    def fixture_cases(self) -> list:
+        return [(name, case_name) for name in FUNCTIONS for case_name in self.fixtures[name]]
+
+    def build_fixture(self, name: str, case_name: str, rng: random.Random):
+        """Кейс tests.json как есть, с подстановкой существующего пользователя и уникального имени"""
+        case = self.fixtures[name][case_name]
+        user_id = rng.choice(self.user_ids)
+        params = {'user_id': str(user_id)} if 'user_id' in (case.get('queryStringParameters') or {}) else None
+        body = None
+        if 'username' in (case.get('body') or {}):
+            body = {'username': f'load_{os.getpid()}_{self.next_id()}'}
+        elif 'user_id' in (case.get('body') or {}):
+            body = {'user_id': user_id}
+        if case_name.startswith('Long-poll'):
+            params = dict(params or {}, wait='0')
+        return name, fixture_event(case, params, body, self.headers(user_id))
+
+
+def worker(scenario: str, users: dict, titles: list, latest_chat_id: int, threads: int, duration: float, seed_value: int) -> dict:
+    workload = Workload(users, titles, latest_chat_id)
+    for module in workload.handlers.values():
+        module.metrics.routes.clear()
+
+    mix = SCENARIOS[scenario]
+    if mix is None:
+        mix = [(1, f'{name}:{case_name}') for name, case_name in workload.fixture_cases()]
+    ops = [op for _, op in mix]
+    weights = [weight for weight, _ in mix]
+    samples = {op: [] for op in ops}
+    statuses = {op: {} for op in ops}
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def run(index: int):
+        rng = random.Random(seed_value * 1000 + index)
+        local_samples = {op: [] for op in ops}
+        local_statuses = {op: {} for op in ops}
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            op = rng.choices(ops, weights)[0]
+            if ':' in op:
+                name, event = workload.build_fixture(*op.split(':', 1), rng)
+            else:
+                name, event = workload.build(op, rng)
+            t0 = time.perf_counter()
+            response = workload.handlers[name].handler(event, None)
+            local_samples[op].append(time.perf_counter() - t0)
+            status = str(response['statusCode'])
+            local_statuses[op][status] = local_statuses[op].get(status, 0) + 1
+            if op == 'chat_post' and response['statusCode'] == 200:
+                workload.latest_chat_id = max(workload.latest_chat_id, json.loads(response['body'])['id'])
+        with lock:
+            for op in ops:
+                samples[op].extend(local_samples[op])
+                for status, count in local_statuses[op].items():
+                    statuses[op][status] = statuses[op].get(status, 0) + count
+
+    pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for name, module in workload.handlers.items():
+        for route, stats in module.metrics.snapshot().items():
+            routes[f'{name}.{route}'] = {'count': stats['count'], 'queries': stats['queries_per_request'] * stats['count']}
+    return {'samples': samples, 'statuses': statuses, 'elapsed': elapsed, 'routes': routes}
+
+
+def prepare(scenario: str, args) -> tuple:
+    prefix = f'load_{args.users}_'
+    user_ids = seed(args.users, titles_per_user=args.titles, messages=args.messages, prefix=prefix)
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id, username FROM users WHERE id = ANY(%s)", (user_ids,))
+    users = dict(cur.fetchall())
+    if scenario == 'shop':
+        cur.execute("UPDATE users SET coins = 1000000 WHERE id = ANY(%s)", (user_ids,))
+    if scenario == 'daily':
+        # Полночь: у всех вчерашний вход есть, сегодняшнего еще нет
+        cur.execute("DELETE FROM daily_logins WHERE user_id = ANY(%s) AND login_date >= CURRENT_DATE", (user_ids,))
+        cur.execute("UPDATE user_stats SET last_claim_date = CURRENT_DATE - 1 WHERE user_id = ANY(%s)", (user_ids,))
+    cur.execute("SELECT id FROM titles WHERE price > 0 ORDER BY id")
+    titles = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM chat_messages")
+    latest_chat_id = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return users, titles, latest_chat_id
+
+
+def merge(parts: list, scenario: str, args) -> dict:
+    elapsed = max(part['elapsed'] for part in parts)
+    ops = {}
+    all_samples = []
+    routes = {}
+    for part in parts:
+        for route, stats in part['routes'].items():
+            merged = routes.setdefault(route, {'count': 0, 'queries': 0.0})
+            merged['count'] += stats['count']
+            merged['queries'] += stats['queries']
+    for op in parts[0]['samples']:
+        samples = [s for part in parts for s in part['samples'][op]]
+        statuses = {}
+        for part in parts:
+            for status, count in part['statuses'][op].items():
+                statuses[status] = statuses.get(status, 0) + count
+        all_samples.extend(samples)
+        ops[op] = dict(summarize(samples, elapsed), statuses=statuses)
+        route = routes.get(OP_ROUTES.get(op))
+        if route and route['count']:
+            ops[op]['queries_per_request'] = round(route['queries'] / route['count'], 2)
+
+    total_queries = sum(r['queries'] for r in routes.values())
+    total_requests = sum(r['count'] for r in routes.values())
+    return {
+        'scenario': scenario,
+        'revision': git_revision(),
+        'config': {
+            'users': args.users, 'titles': args.titles, 'messages': args.messages,
+            'threads': args.threads, 'processes': args.processes, 'duration': args.duration
+        },
+        'total': dict(
+            summarize(all_samples, elapsed),
+            queries_per_request=round(total_queries / total_requests, 2) if total_requests else 0.0
+        ),
+        'ops': ops,
+        'routes': {
+            route: {'count': r['count'], 'queries_per_request': round(r['queries'] / r['count'], 2)}
+            for route, r in sorted(routes.items()) if r['count']
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='chat')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--titles', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--compare', help='файл прошлого результата для сравнения')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DB_POOL_SIZE', str(args.threads))
+    os.environ.setdefault('SESSION_SECRET', 'benchmark')
+    os.environ.setdefault('METRICS_LOG_INTERVAL', '0')
+    users, titles, latest_chat_id = prepare(args.scenario, args)
+
+    jobs = [(args.scenario, users, titles, latest_chat_id, args.threads, args.duration, n) for n in range(args.processes)]
+    if args.processes == 1:
+        parts = [worker(*jobs[0])]
+    else:
+        with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+            parts = pool.starmap(worker, jobs)
+
+    results = merge(parts, args.scenario, args)
+    if not args.no_save:
+        results['saved_to'] = save_results(f'load-{args.scenario}', results)
+    if args.compare:
+        with open(args.compare) as f:
+            results['compare'] = compare_results(json.load(f), results)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Бенчмарк входа: скорость KDF по числу потоков и логины в секунду через backend/auth.
+
+Показывает, сколько входов в секунду дает одно ядро при текущих PASSWORD_SCRYPT_*,
+и что пул KDF масштабируется по ядрам, а не упирается в GIL.
+
+Запуск: DATABASE_URL=... python benchmarks/login_bench.py --threads 8 --logins 400
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+from common import get_conn, load_handler, make_event, summarize
+
+PASSWORD = 'bench-password'
+
+
+def kdf_rate(auth, threads: int, hashes: int) -> dict:
+    """Чистая стоимость hash_password в threads потоках без базы"""
+    per_thread = max(1, hashes // threads)
+
+    def work():
+        for _ in range(per_thread):
+            auth.hash_password(PASSWORD)
+
+    pool = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    rate = per_thread * threads / elapsed
+    return {'threads': threads, 'hashes_per_sec': round(rate, 1), 'per_thread': round(rate / threads, 1)}
+
+
+def seed_accounts(auth, count: int, prefix: str) -> list:
+    password_hash = auth.hash_password(PASSWORD)
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users (username, password_hash)
+        SELECT %s || g, %s FROM generate_series(1, %s) g
+        ON CONFLICT (username) DO UPDATE SET password_hash = EXCLUDED.password_hash
+    """, (prefix, password_hash, count))
+    conn.commit()
+    conn.close()
+    return [f'{prefix}{i}' for i in range(1, count + 1)]
+
+
+def login_rate(auth, usernames: list, threads: int, logins: int) -> dict:
+    samples = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def work(index: int):
+        for n in range(index, logins, threads):
+            # Разные IP, чтобы лимит неудачных попыток не мешал измерению
+            event = make_event('POST', body={'action': 'login', 'username': usernames[n % len(usernames)], 'password': PASSWORD})
+            event['requestContext'] = {'identity': {'sourceIp': f'10.0.{index}.{n % 250}'}}
+            t0 = time.perf_counter()
+            status = auth.handler(event, None)['statusCode']
+            elapsed = time.perf_counter() - t0
+            with lock:
+                samples.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    pool = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    result = summarize(samples, time.perf_counter() - started)
+    result['statuses'] = statuses
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--accounts', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DB_POOL_SIZE', str(args.threads))
+    os.environ.setdefault('SESSION_SECRET', 'benchmark')
+    auth = load_handler('auth')
+    cores = os.cpu_count() or 1
+
+    started = time.perf_counter()
+    for _ in range(10000):
+        hashlib.sha256(PASSWORD.encode()).hexdigest()
+    legacy_rate = 10000 / (time.perf_counter() - started)
+
+    thread_counts = sorted({1, min(cores, args.threads), args.threads})
+    kdf = [kdf_rate(auth, n, max(40, n * 10)) for n in thread_counts]
+
+    usernames = seed_accounts(auth, args.accounts, f'login_bench_{int(time.time())}_')
+    logins = login_rate(auth, usernames, args.threads, args.logins)
+
+    print(json.dumps({
+        'cores': cores,
+        'kdf_workers': auth.KDF_WORKERS,
+        'scrypt': {'n': auth.PASSWORD_SCRYPT_N, 'r': auth.PASSWORD_SCRYPT_R, 'p': auth.PASSWORD_SCRYPT_P},
+        'legacy_sha256_per_sec': round(legacy_rate, 1),
+        'kdf': kdf,
+        'logins': logins,
+        'logins_per_sec_per_core': round(logins['rps'] / min(cores, auth.KDF_WORKERS), 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
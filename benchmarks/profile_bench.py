@@ -0,0 +1,80 @@
+"""
+Бенчмарк GET api?action=profile: четыре последовательных запроса против одного запроса с CTE.
+
+Запуск: DATABASE_URL=... python benchmarks/profile_bench.py --users 5000 --iterations 2000
+"""
+import argparse
+import json
+from datetime import date, timedelta
+
+from common import get_conn, load_handler, make_event, pick, seed, timed
+
+
+def legacy_profile(cur, user_id: int) -> str:
+    cur.execute("SELECT id, username, coins, is_admin, time_spent_minutes FROM users WHERE id = %s", (user_id,))
+    user = cur.fetchone()
+    
+    cur.execute("""
+        SELECT t.id, t.name, t.price, t.color, t.is_limited,
+               CASE WHEN ut.id IS NOT NULL THEN TRUE ELSE FALSE END as owned
+        FROM titles t
+        LEFT JOIN user_titles ut ON t.id = ut.title_id AND ut.user_id = %s
+        ORDER BY t.display_order
+    """, (user_id,))
+    titles = [{'id': t[0], 'name': t[1], 'price': t[2], 'color': t[3], 'is_limited': t[4], 'owned': t[5]} for t in cur.fetchall()]
+    
+    cur.execute("""
+        SELECT q.id, q.title, q.description, q.reward, q.quest_type, q.target_value,
+               COALESCE(uq.progress, 0) as progress, COALESCE(uq.completed, FALSE) as completed
+        FROM quests q
+        LEFT JOIN user_quests uq ON q.id = uq.quest_id AND uq.user_id = %s
+        ORDER BY q.display_order
+    """, (user_id,))
+    quests = [{
+        'id': q[0], 'title': q[1], 'description': q[2], 'reward': q[3], 'quest_type': q[4],
+        'target_value': q[5], 'progress': min(100, int((q[6] / q[5] * 100) if q[5] > 0 else 0)), 'completed': q[7]
+    } for q in cur.fetchall()]
+    
+    cur.execute("""
+        SELECT day_streak, login_date, reward_claimed
+        FROM daily_logins
+        WHERE user_id = %s
+        ORDER BY login_date DESC
+        LIMIT 1
+    """, (user_id,))
+    daily_login = cur.fetchone()
+    streak = daily_login[0] if daily_login and daily_login[1] >= date.today() - timedelta(days=1) else 0
+    
+    return json.dumps({
+        'user': {'id': user[0], 'username': user[1], 'coins': user[2], 'is_admin': user[3], 'time_spent_minutes': user[4]},
+        'titles': titles,
+        'quests': quests,
+        'daily_streak': streak,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    
+    user_ids = seed(args.users)
+    api = load_handler('api')
+    
+    conn = get_conn()
+    cur = conn.cursor()
+    before = timed(lambda: (legacy_profile(cur, pick(user_ids)), conn.rollback()), args.iterations)
+    cur.close()
+    conn.close()
+    
+    after = timed(
+        lambda: api.handler(make_event('GET', {'action': 'profile', 'user_id': str(pick(user_ids))}), None),
+        args.iterations
+    )
+    
+    print(json.dumps({'before': before, 'after': after}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Стресс-тест покупки титулов: проверка отсутствия двойного списания и пропускная способность.
+
+Сравнивает прежнюю последовательность из восьми запросов без блокировок с buy_title из backend/api.
+
+Запуск: DATABASE_URL=... python benchmarks/purchase_stress.py --threads 16 --rounds 50 --users 500
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from common import get_conn, seed
+
+BUDGET = 250
+
+
+def legacy_buy(conn, user_id: int, title_id: int) -> bool:
+    cur = conn.cursor()
+    cur.execute("SELECT coins FROM users WHERE id = %s", (user_id,))
+    coins = cur.fetchone()[0]
+    cur.execute("SELECT id, name, price FROM titles WHERE id = %s", (title_id,))
+    title = cur.fetchone()
+    cur.execute("SELECT id FROM user_titles WHERE user_id = %s AND title_id = %s", (user_id, title_id))
+    if cur.fetchone() or coins < title[2]:
+        conn.rollback()
+        return False
+    cur.execute("UPDATE users SET coins = coins - %s WHERE id = %s", (title[2], user_id))
+    cur.execute("INSERT INTO user_titles (user_id, title_id) VALUES (%s, %s)", (user_id, title_id))
+    cur.execute("""
+        UPDATE user_quests SET progress = progress + 1
+        WHERE user_id = %s AND quest_id IN (SELECT id FROM quests WHERE quest_type = 'buy_title')
+    """, (user_id,))
+    conn.commit()
+    cur.execute("SELECT coins FROM users WHERE id = %s", (user_id,))
+    cur.fetchone()
+    conn.rollback()
+    return True
+
+
+def handler_buy(api, user_id: int, title_id: int) -> bool:
+    response = api.handler({
+        'httpMethod': 'POST',
+        'queryStringParameters': {},
+        'body': json.dumps({'action': 'buy_title', 'user_id': user_id, 'title_id': title_id}),
+    }, None)
+    return response['statusCode'] == 200
+
+
+def make_buyer(mode: str, api):
+    local = threading.local()
+    
+    def buy(user_id: int, title_id: int) -> bool:
+        if mode == 'handler':
+            return handler_buy(api, user_id, title_id)
+        if not hasattr(local, 'conn'):
+            local.conn = get_conn()
+        try:
+            return legacy_buy(local.conn, user_id, title_id)
+        except Exception:
+            local.conn.rollback()
+            return False
+    
+    return buy
+
+
+def run_threads(threads: int, work) -> float:
+    barrier = threading.Barrier(threads)
+    
+    def worker(index: int):
+        barrier.wait()
+        work(index)
+    
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - started
+
+
+def paid_titles() -> list:
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id, price FROM titles WHERE price >= 100 ORDER BY id")
+    titles = cur.fetchall()
+    conn.close()
+    return titles
+
+
+def double_spend(mode: str, buy, threads: int, rounds: int) -> dict:
+    """Каждый раунд: пользователь с бюджетом на одну покупку, threads потоков покупают разные титулы одновременно"""
+    titles = paid_titles()
+    user_ids = seed(rounds, titles_per_user=0, prefix=f'stress_{mode}_{int(time.time())}_')
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET coins = %s WHERE id = ANY(%s)", (BUDGET, user_ids))
+    conn.commit()
+    
+    for user_id in user_ids:
+        run_threads(threads, lambda i: buy(user_id, titles[i % len(titles)][0]))
+    
+    cur.execute("""
+        SELECT u.id, u.coins, COALESCE(SUM(t.price), 0)
+        FROM users u
+        LEFT JOIN user_titles ut ON ut.user_id = u.id
+        LEFT JOIN titles t ON t.id = ut.title_id
+        WHERE u.id = ANY(%s)
+        GROUP BY u.id, u.coins
+    """, (user_ids,))
+    violations = [row for row in cur.fetchall() if row[1] < 0 or row[1] + row[2] != BUDGET]
+    conn.close()
+    return {'rounds': rounds, 'violations': len(violations)}
+
+
+def throughput(mode: str, buy, threads: int, users: int) -> dict:
+    titles = paid_titles()
+    user_ids = seed(users, titles_per_user=0, prefix=f'tput_{mode}_{int(time.time())}_')
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET coins = 1000000 WHERE id = ANY(%s)", (user_ids,))
+    conn.commit()
+    conn.close()
+    
+    jobs = [(u, t[0]) for u in user_ids for t in titles]
+    done = [0] * threads
+    
+    def work(index: int):
+        for user_id, title_id in jobs[index::threads]:
+            done[index] += buy(user_id, title_id)
+    
+    elapsed = run_threads(threads, work)
+    return {'purchases': sum(done), 'seconds': round(elapsed, 3), 'purchases_per_sec': round(sum(done) / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--users', type=int, default=300)
+    args = parser.parse_args()
+    
+    os.environ.setdefault('DB_POOL_SIZE', str(args.threads))
+    from common import load_handler
+    api = load_handler('api')
+    
+    results = {}
+    for mode in ('legacy', 'handler'):
+        buy = make_buyer(mode, api)
+        results[mode] = {
+            'double_spend': double_spend(mode, buy, args.threads, args.rounds),
+            'throughput': throughput(mode, buy, args.threads, args.users),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+-- Версия справочников titles и quests: функции кэшируют их и перечитывают при смене версии
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO catalog_version (id, version) VALUES (TRUE, 1) ON CONFLICT DO NOTHING;
+
+-- Любое изменение справочников поднимает версию
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE catalog_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS titles_bump_catalog_version ON titles;
+CREATE TRIGGER titles_bump_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON titles
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+DROP TRIGGER IF EXISTS quests_bump_catalog_version ON quests;
+CREATE TRIGGER quests_bump_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON quests
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
@@ -0,0 +1,11 @@
+-- Журнал отложенных приращений квестов (режим QUEST_WRITE_BEHIND):
+-- функции дописывают сюда события, а пачки периодически сворачиваются в user_quests
+CREATE TABLE IF NOT EXISTS quest_events (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    quest_type VARCHAR(50) NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_quest_events_user_id ON quest_events(user_id);
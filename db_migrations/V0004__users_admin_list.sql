@@ -0,0 +1,24 @@
+-- Время последнего изменения строки пользователя: по нему админка забирает только дельту
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+CREATE OR REPLACE FUNCTION touch_users_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_touch_updated_at ON users;
+CREATE TRIGGER users_touch_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW
+    WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION touch_users_updated_at();
+
+CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at);
+
+-- Сортировка и курсор списка пользователей, фильтр «только онлайн»
+CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users ((COALESCE(last_login, '-infinity'::timestamp)) DESC, id DESC);
+
+-- Поиск по префиксу имени (LIKE 'abc%') независимо от локали базы
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users (username varchar_pattern_ops);
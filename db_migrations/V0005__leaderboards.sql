@@ -0,0 +1,94 @@
+-- Сводные счетчики для таблиц лидеров. Поддерживаются триггерами уровня оператора,
+-- поэтому многострочные вставки обновляют каждого пользователя один раз
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    titles_owned INTEGER NOT NULL DEFAULT 0,
+    chat_messages INTEGER NOT NULL DEFAULT 0,
+    day_streak INTEGER NOT NULL DEFAULT 0,
+    last_claim_date DATE
+);
+
+INSERT INTO user_stats (user_id, titles_owned, chat_messages, day_streak, last_claim_date)
+SELECT u.id,
+       (SELECT COUNT(*) FROM user_titles WHERE user_id = u.id),
+       (SELECT COUNT(*) FROM chat_messages WHERE user_id = u.id),
+       COALESCE(ld.day_streak, 0),
+       ld.login_date
+FROM users u
+LEFT JOIN LATERAL (
+    SELECT day_streak, login_date
+    FROM daily_logins
+    WHERE user_id = u.id
+    ORDER BY login_date DESC
+    LIMIT 1
+) ld ON TRUE
+ON CONFLICT (user_id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION user_stats_titles_added() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_stats AS s (user_id, titles_owned)
+    SELECT user_id, COUNT(*) FROM new_rows GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET titles_owned = s.titles_owned + EXCLUDED.titles_owned;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION user_stats_titles_removed() RETURNS trigger AS $$
+BEGIN
+    UPDATE user_stats s SET titles_owned = s.titles_owned - d.removed
+    FROM (SELECT user_id, COUNT(*) AS removed FROM old_rows GROUP BY user_id) d
+    WHERE s.user_id = d.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Удаление сообщений (архивация старых) счетчик не уменьшает: лидерборд считает сообщения за все время
+CREATE OR REPLACE FUNCTION user_stats_chat_added() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_stats AS s (user_id, chat_messages)
+    SELECT user_id, COUNT(*) FROM new_rows GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET chat_messages = s.chat_messages + EXCLUDED.chat_messages;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION user_stats_streak_claimed() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_stats AS s (user_id, day_streak, last_claim_date)
+    SELECT DISTINCT ON (user_id) user_id, day_streak, login_date
+    FROM new_rows
+    ORDER BY user_id, login_date DESC
+    ON CONFLICT (user_id) DO UPDATE SET day_streak = EXCLUDED.day_streak, last_claim_date = EXCLUDED.last_claim_date
+    WHERE s.last_claim_date IS NULL OR s.last_claim_date <= EXCLUDED.last_claim_date;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_titles_stats_insert ON user_titles;
+CREATE TRIGGER user_titles_stats_insert
+    AFTER INSERT ON user_titles
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_stats_titles_added();
+
+DROP TRIGGER IF EXISTS user_titles_stats_delete ON user_titles;
+CREATE TRIGGER user_titles_stats_delete
+    AFTER DELETE ON user_titles
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_stats_titles_removed();
+
+DROP TRIGGER IF EXISTS chat_messages_stats_insert ON chat_messages;
+CREATE TRIGGER chat_messages_stats_insert
+    AFTER INSERT ON chat_messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_stats_chat_added();
+
+DROP TRIGGER IF EXISTS daily_logins_stats_insert ON daily_logins;
+CREATE TRIGGER daily_logins_stats_insert
+    AFTER INSERT ON daily_logins
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_stats_streak_claimed();
+
+CREATE INDEX IF NOT EXISTS idx_users_coins ON users(coins DESC, id);
+CREATE INDEX IF NOT EXISTS idx_user_stats_titles ON user_stats(titles_owned DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_user_stats_chat ON user_stats(chat_messages DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_user_stats_streak ON user_stats(day_streak DESC, user_id);
@@ -0,0 +1,8 @@
+-- Отзыв сессий: токены пользователя, выпущенные раньше revoked_before (мс с эпохи), недействительны.
+-- Функции держат список в памяти и перечитывают его раз в SESSION_REVOCATION_CHECK секунд
+CREATE TABLE IF NOT EXISTS session_revocations (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    revoked_before BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_revocations_revoked_before ON session_revocations(revoked_before);
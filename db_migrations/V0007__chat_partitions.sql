@@ -0,0 +1,129 @@
+-- Помесячные партиции сообщений чата и архив старых месяцев.
+-- Старая таблица переливается в партиционированную, последовательность id сохраняется
+ALTER TABLE chat_messages RENAME TO chat_messages_legacy;
+ALTER INDEX IF EXISTS idx_chat_messages_created_at RENAME TO idx_chat_messages_legacy_created_at;
+ALTER SEQUENCE chat_messages_id_seq OWNED BY NONE;
+
+CREATE TABLE chat_messages (
+    id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+    user_id INTEGER REFERENCES users(id),
+    message TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id;
+
+-- Сюда попадает только то, для чего партиция еще не создана
+CREATE TABLE chat_messages_default PARTITION OF chat_messages DEFAULT;
+
+-- Архив: одна строка на день, сообщения сжаты в jsonb-массив [id, user_id, message, created_at]
+CREATE TABLE IF NOT EXISTS chat_archive (
+    day DATE PRIMARY KEY,
+    messages JSONB NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION chat_messages_add_partition(month DATE) RETURNS void AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    partition_name TEXT := 'chat_messages_p' || to_char(month, 'YYYYMM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    -- Строки из default-партиции за этот месяц не дали бы создать партицию: оставляем месяц там
+    IF EXISTS (
+        SELECT 1 FROM chat_messages_default
+        WHERE created_at >= start_at AND created_at < start_at + INTERVAL '1 month'
+    ) THEN
+        RETURN;
+    END IF;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF chat_messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, start_at, (start_at + INTERVAL '1 month')::date
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Обслуживание: партиции на months_ahead месяцев вперед, месяцы старше keep_months уходят в архив.
+-- Возвращает число архивированных сообщений; параллельный вызов с другого инстанса ничего не делает
+CREATE OR REPLACE FUNCTION chat_messages_maintain(keep_months INTEGER, months_ahead INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    this_month DATE := date_trunc('month', LOCALTIMESTAMP)::date;
+    cutoff DATE := (date_trunc('month', LOCALTIMESTAMP) - make_interval(months => keep_months))::date;
+    part RECORD;
+    archived INTEGER := 0;
+    moved INTEGER;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('chat_messages_maintain')) THEN
+        RETURN 0;
+    END IF;
+
+    FOR n IN 0..months_ahead LOOP
+        PERFORM chat_messages_add_partition((this_month + make_interval(months => n))::date);
+    END LOOP;
+
+    FOR part IN
+        SELECT c.relname
+        FROM pg_inherits inh
+        JOIN pg_class c ON c.oid = inh.inhrelid
+        WHERE inh.inhparent = 'chat_messages'::regclass
+          AND c.relname ~ '^chat_messages_p[0-9]{6}$'
+          AND to_date(substr(c.relname, 16), 'YYYYMM') < cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format($q$
+            INSERT INTO chat_archive AS a (day, messages)
+            SELECT created_at::date, jsonb_agg(jsonb_build_array(id, user_id, message, created_at) ORDER BY id)
+            FROM %I
+            GROUP BY created_at::date
+            ON CONFLICT (day) DO UPDATE SET messages = a.messages || EXCLUDED.messages
+        $q$, part.relname);
+        EXECUTE format('SELECT COUNT(*) FROM %I', part.relname) INTO moved;
+        archived := archived + moved;
+        EXECUTE format('ALTER TABLE chat_messages DETACH PARTITION %I', part.relname);
+        EXECUTE format('DROP TABLE %I', part.relname);
+    END LOOP;
+
+    WITH old AS (
+        DELETE FROM chat_messages_default WHERE created_at < cutoff
+        RETURNING id, user_id, message, created_at
+    ), days AS (
+        INSERT INTO chat_archive AS a (day, messages)
+        SELECT created_at::date, jsonb_agg(jsonb_build_array(id, user_id, message, created_at) ORDER BY id)
+        FROM old
+        GROUP BY created_at::date
+        ON CONFLICT (day) DO UPDATE SET messages = a.messages || EXCLUDED.messages
+    )
+    SELECT COUNT(*) INTO moved FROM old;
+
+    RETURN archived + moved;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    first_month DATE;
+BEGIN
+    SELECT date_trunc('month', COALESCE(MIN(created_at), LOCALTIMESTAMP))::date INTO first_month FROM chat_messages_legacy;
+    WHILE first_month <= date_trunc('month', LOCALTIMESTAMP) + INTERVAL '2 months' LOOP
+        PERFORM chat_messages_add_partition(first_month);
+        first_month := (first_month + INTERVAL '1 month')::date;
+    END LOOP;
+END;
+$$;
+
+INSERT INTO chat_messages (id, user_id, message, created_at)
+SELECT id, user_id, message, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM chat_messages_legacy;
+
+DROP TABLE chat_messages_legacy;
+
+CREATE INDEX IF NOT EXISTS idx_chat_messages_created_at ON chat_messages(created_at DESC);
+
+-- Счетчик сообщений в user_stats: триггер уровня оператора на партиционированной таблице.
+-- Создается после переливки, чтобы перенесенные сообщения не посчитались повторно
+CREATE TRIGGER chat_messages_stats_insert
+    AFTER INSERT ON chat_messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION user_stats_chat_added();
@@ -0,0 +1,62 @@
+-- Имя автора хранится в самом сообщении: чтение чата больше не соединяется с users.
+-- Имена пользователей не меняются, поэтому копия не расходится с оригиналом
+ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS username VARCHAR(50);
+
+UPDATE chat_messages cm SET username = u.username
+FROM users u
+WHERE u.id = cm.user_id AND cm.username IS NULL;
+
+-- Архив дополняется именем автора пятым элементом; ранее архивированные дни остаются с четырьмя
+CREATE OR REPLACE FUNCTION chat_messages_maintain(keep_months INTEGER, months_ahead INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    this_month DATE := date_trunc('month', LOCALTIMESTAMP)::date;
+    cutoff DATE := (date_trunc('month', LOCALTIMESTAMP) - make_interval(months => keep_months))::date;
+    part RECORD;
+    archived INTEGER := 0;
+    moved INTEGER;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('chat_messages_maintain')) THEN
+        RETURN 0;
+    END IF;
+
+    FOR n IN 0..months_ahead LOOP
+        PERFORM chat_messages_add_partition((this_month + make_interval(months => n))::date);
+    END LOOP;
+
+    FOR part IN
+        SELECT c.relname
+        FROM pg_inherits inh
+        JOIN pg_class c ON c.oid = inh.inhrelid
+        WHERE inh.inhparent = 'chat_messages'::regclass
+          AND c.relname ~ '^chat_messages_p[0-9]{6}$'
+          AND to_date(substr(c.relname, 16), 'YYYYMM') < cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format($q$
+            INSERT INTO chat_archive AS a (day, messages)
+            SELECT created_at::date, jsonb_agg(jsonb_build_array(id, user_id, message, created_at, username) ORDER BY id)
+            FROM %I
+            GROUP BY created_at::date
+            ON CONFLICT (day) DO UPDATE SET messages = a.messages || EXCLUDED.messages
+        $q$, part.relname);
+        EXECUTE format('SELECT COUNT(*) FROM %I', part.relname) INTO moved;
+        archived := archived + moved;
+        EXECUTE format('ALTER TABLE chat_messages DETACH PARTITION %I', part.relname);
+        EXECUTE format('DROP TABLE %I', part.relname);
+    END LOOP;
+
+    WITH old AS (
+        DELETE FROM chat_messages_default WHERE created_at < cutoff
+        RETURNING id, user_id, message, created_at, username
+    ), days AS (
+        INSERT INTO chat_archive AS a (day, messages)
+        SELECT created_at::date, jsonb_agg(jsonb_build_array(id, user_id, message, created_at, username) ORDER BY id)
+        FROM old
+        GROUP BY created_at::date
+        ON CONFLICT (day) DO UPDATE SET messages = a.messages || EXCLUDED.messages
+    )
+    SELECT COUNT(*) INTO moved FROM old;
+
+    RETURN archived + moved;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,26 @@
+-- Серия ежедневных входов хранится в user_stats (day_streak, last_claim_date) и обновляется
+-- самим claim_daily; daily_logins остается необязательной историей и больше не читается
+DROP TRIGGER IF EXISTS daily_logins_stats_insert ON daily_logins;
+DROP FUNCTION IF EXISTS user_stats_streak_claimed();
+
+-- Награды за дни серии: справочник, кэшируется функциями вместе с titles и quests
+CREATE TABLE IF NOT EXISTS daily_rewards (
+    day_streak INTEGER PRIMARY KEY,
+    coins INTEGER NOT NULL DEFAULT 0,
+    title_id INTEGER REFERENCES titles(id)
+);
+
+DROP TRIGGER IF EXISTS daily_rewards_bump_catalog_version ON daily_rewards;
+CREATE TRIGGER daily_rewards_bump_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON daily_rewards
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+INSERT INTO daily_rewards (day_streak, coins, title_id) VALUES
+(1, 50, NULL),
+(2, 100, NULL),
+(3, 0, (SELECT id FROM titles WHERE name = '[Третий]')),
+(4, 150, NULL),
+(5, 500, NULL),
+(6, 750, NULL),
+(7, 0, (SELECT id FROM titles WHERE name = '[Ежедневный]'))
+ON CONFLICT (day_streak) DO NOTHING;
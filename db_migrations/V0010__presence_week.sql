@@ -0,0 +1,4 @@
+-- Минуты на сайте за текущую неделю для квеста weekly_time; week_start — понедельник недели,
+-- с новой недели счетчик начинается заново
+ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS week_start DATE;
+ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS week_minutes INTEGER NOT NULL DEFAULT 0;
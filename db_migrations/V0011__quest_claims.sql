@@ -0,0 +1,3 @@
+-- Выплата награды за квест: completed ставит движок квестов, claimed_at — выдача награды.
+-- Квест с claimed_at уже оплачен и повторно не выплачивается
+ALTER TABLE user_quests ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;
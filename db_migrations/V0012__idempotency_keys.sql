@@ -0,0 +1,11 @@
+-- Сохраненные ответы POST по заголовку Idempotency-Key. key — 16 байт sha256 от маршрута,
+-- пользователя и ключа клиента; status IS NULL — запрос еще выполняется
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key BYTEA PRIMARY KEY,
+    fingerprint BYTEA NOT NULL,
+    status SMALLINT,
+    body TEXT,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
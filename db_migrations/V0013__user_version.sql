@@ -0,0 +1,3 @@
+-- Версия данных профиля: увеличивается каждой операцией, меняющей монеты, титулы, серию или прогресс
+-- квестов пользователя. Из нее строится ETag профиля, проверка If-None-Match — одно чтение по ключу
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
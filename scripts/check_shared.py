@@ -0,0 +1,74 @@
+"""
+Проверка общих блоков backend-функций.
+
+Каждая функция в backend/ деплоится отдельной папкой и не может импортировать соседнюю,
+поэтому пул соединений, Router, метрики, сессии, QuestEngine и идемпотентность скопированы
+в несколько index.py. Скрипт сверяет копии: любое имя верхнего уровня (функция, класс,
+присваивание), определенное в нескольких функциях, должно совпадать байт в байт.
+Намеренно разные имена перечислены в ALLOWED_DIFFERENT.
+
+Запуск: python scripts/check_shared.py — код возврата 1 и diff, если копии разошлись.
+"""
+import ast
+import difflib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+
+# router: у каждой функции свой список разрешенных заголовков CORS
+ALLOWED_DIFFERENT = {'router'}
+
+
+def top_level(source: str) -> dict:
+    """Имя -> исходный текст определения вместе с декораторами"""
+    lines = source.splitlines()
+    found = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, ast.Assign):
+            names = [target.id for target in node.targets if isinstance(target, ast.Name)]
+        else:
+            continue
+        start = min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+        text = '\n'.join(lines[start - 1:node.end_lineno]) + '\n'
+        for name in names:
+            found[name] = text
+    return found
+
+
+def main() -> int:
+    functions = sorted(
+        name for name in os.listdir(BACKEND)
+        if os.path.isfile(os.path.join(BACKEND, name, 'index.py'))
+    )
+    copies = {}
+    for function in functions:
+        with open(os.path.join(BACKEND, function, 'index.py'), encoding='utf-8') as f:
+            for name, text in top_level(f.read()).items():
+                copies.setdefault(name, {})[function] = text
+
+    drifted = 0
+    for name, texts in sorted(copies.items()):
+        if len(texts) < 2 or name in ALLOWED_DIFFERENT or len(set(texts.values())) == 1:
+            continue
+        drifted += 1
+        (base, base_text), *rest = texts.items()
+        for function, text in rest:
+            if text == base_text:
+                continue
+            sys.stdout.writelines(difflib.unified_diff(
+                base_text.splitlines(True), text.splitlines(True),
+                f'backend/{base}/index.py:{name}', f'backend/{function}/index.py:{name}'
+            ))
+            print()
+
+    shared = sum(1 for name, texts in copies.items() if len(texts) > 1 and name not in ALLOWED_DIFFERENT)
+    print(f'{shared} общих определений в {len(functions)} функциях, расходится {drifted}')
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,13 @@ const API_URLS = {
   admin: 'https://functions.poehali.dev/b80bc515-7971-430e-8083-5237a4f474e1'
 };
 
+const authHeaders = (): Record<string, string> => {
+  const token = localStorage.getItem('chicken_token');
+  return token
+    ? { 'Content-Type': 'application/json', 'X-Session-Token': token }
+    : { 'Content-Type': 'application/json' };
+};
+
 type Page = 'home' | 'titles' | 'quests' | 'chat' | 'profile' | 'admin';
 
 interface User {
@@ -42,6 +49,7 @@ interface Quest {
   reward: number;
   progress: number;
   completed: boolean;
+  claimed: boolean;
 }
 
 interface ChatMessage {
@@ -68,10 +76,14 @@ export default function Index() {
   const [chatInput, setChatInput] = useState('');
   const [adminUsers, setAdminUsers] = useState<any[]>([]);
   const [selectedUser, setSelectedUser] = useState<any>(null);
+  const [adminSearch, setAdminSearch] = useState('');
+  const [adminCursor, setAdminCursor] = useState<string | null>(null);
   const [coinsInput, setCoinsInput] = useState('');
   const [dailyStreak, setDailyStreak] = useState(0);
   const [canClaimDaily, setCanClaimDaily] = useState(false);
   const chatEndRef = useRef<HTMLDivElement>(null);
+  const lastChatIdRef = useRef<number | null>(null);
+  const adminSinceRef = useRef<string | null>(null);
   const { toast } = useToast();
 
   const FloatingEmoji = ({ emoji, delay }: { emoji: string; delay: number }) => (
@@ -99,19 +111,43 @@ export default function Index() {
 
   useEffect(() => {
     if (currentPage === 'chat' && user) {
-      loadChat();
-      const interval = setInterval(loadChat, 3000);
-      return () => clearInterval(interval);
+      let active = true;
+      const poll = async () => {
+        await loadChat();
+        while (active) {
+          const ok = await loadChat(25);
+          if (!ok) await new Promise(resolve => setTimeout(resolve, 3000));
+        }
+      };
+      poll();
+      return () => {
+        active = false;
+      };
     }
   }, [currentPage, user]);
 
+  useEffect(() => {
+    if (!user) return;
+    const beat = () => {
+      if (document.visibilityState !== 'visible') return;
+      fetch(API_URLS.api, {
+        method: 'POST',
+        headers: authHeaders(),
+        body: JSON.stringify({ action: 'heartbeat', user_id: user.id })
+      }).catch(() => {});
+    };
+    beat();
+    const interval = setInterval(beat, 60000);
+    return () => clearInterval(interval);
+  }, [user?.id]);
+
   useEffect(() => {
     chatEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [chatMessages]);
 
   const loadUserData = async (userId: number) => {
     try {
-      const response = await fetch(`${API_URLS.api}?action=profile&user_id=${userId}`);
+      const response = await fetch(`${API_URLS.api}?action=profile&user_id=${userId}`, { headers: authHeaders() });
       const data = await response.json();
       
       setUser(data.user);
@@ -143,6 +179,7 @@ export default function Index() {
       if (response.ok) {
         setUser(data.user);
         localStorage.setItem('chicken_user', JSON.stringify(data.user));
+        localStorage.setItem('chicken_token', data.token);
         setShowAuth(false);
         loadUserData(data.user.id);
         toast({
@@ -171,7 +208,7 @@ export default function Index() {
     try {
       const response = await fetch(API_URLS.api, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify({
           action: 'buy_title',
           user_id: user.id,
@@ -211,7 +248,7 @@ export default function Index() {
     try {
       const response = await fetch(API_URLS.api, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify({
           action: 'sell_title',
           user_id: user.id,
@@ -251,7 +288,7 @@ export default function Index() {
     try {
       const response = await fetch(API_URLS.api, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify({
           action: 'claim_daily',
           user_id: user.id
@@ -283,13 +320,73 @@ export default function Index() {
     }
   };
 
-  const loadChat = async () => {
+  const handleClaimQuests = async () => {
+    if (!user) return;
+    
     try {
-      const response = await fetch(`${API_URLS.chat}?limit=50`);
+      const response = await fetch(API_URLS.api, {
+        method: 'POST',
+        headers: authHeaders(),
+        body: JSON.stringify({
+          action: 'claim_quests',
+          user_id: user.id
+        })
+      });
+      
       const data = await response.json();
-      setChatMessages(data.messages);
+      
+      if (response.ok) {
+        toast({
+          title: 'Награды за квесты',
+          description: data.message
+        });
+        setUser({ ...user, coins: data.new_coins });
+        loadUserData(user.id);
+      } else {
+        toast({
+          title: 'Ошибка',
+          description: data.error,
+          variant: 'destructive'
+        });
+      }
+    } catch (error) {
+      toast({
+        title: 'Ошибка',
+        description: 'Не удалось получить награды',
+        variant: 'destructive'
+      });
+    }
+  };
+
+  const loadChat = async (wait = 0) => {
+    try {
+      const sinceId = lastChatIdRef.current;
+      const response = await fetch(
+        sinceId !== null
+          ? `${API_URLS.chat}?limit=50&since_id=${sinceId}&wait=${wait}`
+          : `${API_URLS.chat}?limit=50`
+      );
+      const data = await response.json();
+      
+      if (sinceId !== null) {
+        if (data.messages.length > 0) {
+          // Сервер повторяет несколько сообщений перед курсором: опоздавшие по коммиту
+          // вставляются на свое место, уже показанные отбрасываются по id
+          setChatMessages(prev => {
+            const known = new Set(prev.map(m => m.id));
+            const fresh = data.messages.filter((m: ChatMessage) => !known.has(m.id));
+            if (fresh.length === 0) return prev;
+            return [...prev, ...fresh].sort((a, b) => a.id - b.id).slice(-200);
+          });
+        }
+      } else {
+        setChatMessages(data.messages);
+      }
+      lastChatIdRef.current = Math.max(lastChatIdRef.current ?? 0, data.last_id);
+      return true;
     } catch (error) {
       console.error('Error loading chat:', error);
+      return false;
     }
   };
 
@@ -300,7 +397,7 @@ export default function Index() {
     try {
       const response = await fetch(API_URLS.chat, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify({
           user_id: user.id,
           message: chatInput
@@ -316,15 +413,43 @@ export default function Index() {
     }
   };
 
-  const loadAdminData = async () => {
+  const sortAdminUsers = (list: any[]) =>
+    [...list].sort((a, b) => (b.last_login || '').localeCompare(a.last_login || '') || b.id - a.id);
+
+  const loadAdminData = async (cursor: string | null = null) => {
     if (!user) return;
     
     try {
-      const response = await fetch(`${API_URLS.admin}?admin_id=${user.id}`);
+      const params = new URLSearchParams({ admin_id: String(user.id) });
+      if (adminSearch) params.set('search', adminSearch);
+      if (cursor) params.set('cursor', cursor);
+      else if (adminSinceRef.current) params.set('changed_since', adminSinceRef.current);
+      
+      const response = await fetch(`${API_URLS.admin}?${params}`, { headers: authHeaders() });
       const data = await response.json();
       
-      if (response.ok) {
-        setAdminUsers(data.users);
+      if (!response.ok) return;
+      
+      if (data.delta && data.truncated) {
+        adminSinceRef.current = null;
+        loadAdminData();
+        return;
+      }
+      
+      if (data.delta) {
+        if (data.users.length > 0) {
+          setAdminUsers(prev => {
+            const byId = new Map(prev.map(u => [u.id, u]));
+            data.users.forEach((u: any) => byId.set(u.id, u));
+            return sortAdminUsers(Array.from(byId.values()));
+          });
+        }
+      } else {
+        setAdminUsers(prev => cursor ? [...prev, ...data.users] : data.users);
+        setAdminCursor(data.next_cursor);
+      }
+      if (!cursor) {
+        adminSinceRef.current = data.server_time;
       }
     } catch (error) {
       console.error('Error loading admin data:', error);
@@ -337,7 +462,7 @@ export default function Index() {
     try {
       const response = await fetch(API_URLS.admin, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify({
           admin_id: user.id,
           user_id: selectedUser.id,
@@ -372,11 +497,12 @@ export default function Index() {
 
   useEffect(() => {
     if (currentPage === 'admin' && user?.is_admin) {
+      adminSinceRef.current = null;
       loadAdminData();
-      const interval = setInterval(loadAdminData, 5000);
+      const interval = setInterval(() => loadAdminData(), 5000);
       return () => clearInterval(interval);
     }
-  }, [currentPage, user]);
+  }, [currentPage, user, adminSearch]);
 
   if (showAuth) {
     return (
@@ -464,6 +590,7 @@ export default function Index() {
                 size="sm"
                 onClick={() => {
                   localStorage.removeItem('chicken_user');
+                  localStorage.removeItem('chicken_token');
                   window.location.reload();
                 }}
               >
@@ -690,7 +817,17 @@ export default function Index() {
 
         {currentPage === 'quests' && (
           <div className="space-y-6">
-            <h2 className="text-4xl font-bold neon-text text-primary">Квесты</h2>
+            <div className="flex items-center justify-between">
+              <h2 className="text-4xl font-bold neon-text text-primary">Квесты</h2>
+              <Button
+                onClick={handleClaimQuests}
+                disabled={!quests.some(q => q.completed && !q.claimed)}
+                className="neon-border"
+              >
+                <Icon name="Gift" className="mr-2 h-4 w-4" />
+                Забрать награды
+              </Button>
+            </div>
             <div className="space-y-4">
               {quests.map((quest) => (
                 <Card
@@ -719,7 +856,12 @@ export default function Index() {
                       <span className="text-muted-foreground">
                         Прогресс: {quest.progress}%
                       </span>
-                      {quest.completed ? (
+                      {quest.claimed ? (
+                        <Badge variant="outline" className="border-green-500 text-green-500">
+                          <Icon name="CheckCheck" className="h-3 w-3 mr-1" />
+                          Награда получена
+                        </Badge>
+                      ) : quest.completed ? (
                         <Badge variant="outline" className="border-green-500 text-green-500">
                           <Icon name="Check" className="h-3 w-3 mr-1" />
                           Выполнено
@@ -883,6 +1025,12 @@ export default function Index() {
 
                 <div>
                   <h3 className="text-lg font-bold mb-2">Все пользователи</h3>
+                  <Input
+                    placeholder="Поиск по имени"
+                    value={adminSearch}
+                    onChange={(e) => setAdminSearch(e.target.value)}
+                    className="glass mb-2"
+                  />
                   <div className="space-y-2">
                     {adminUsers.map(u => (
                       <div key={u.id} className="glass p-3 rounded-lg">
@@ -924,6 +1072,15 @@ export default function Index() {
                       </div>
                     ))}
                   </div>
+                  {adminCursor && (
+                    <Button
+                      variant="outline"
+                      onClick={() => loadAdminData(adminCursor)}
+                      className="w-full mt-2"
+                    >
+                      Показать ещё
+                    </Button>
+                  )}
                 </div>
               </div>
             </CardContent>